@@ -0,0 +1 @@
+"""Benchmarks for zip_loader and driver. Run from the repository root with `python -m benchmarks.run`"""
@@ -0,0 +1,172 @@
+"""
+Stand-in for the parts of arcpy that zip_loader uses, backed by benchmarks.synthetic datasets.
+
+Install with `install()` before importing zip_loader.
+Copies are file copies so export timing scales with dataset size.
+"""
+import json
+import os
+import re
+import shutil
+import sys
+
+import numpy as np
+
+from benchmarks import synthetic
+
+
+class _Result(list):
+    """Geoprocessing result. Index 0 is the output."""
+
+
+class _Description(object):
+    def __init__(self, path):
+        with open(os.path.join(path, synthetic.DATASET_META), 'r') as meta:
+            self.datasetType = json.load(meta)['type']
+        self.catalogPath = path
+        self.name = os.path.basename(path)
+        self.OIDFieldName = 'OBJECTID'
+
+
+def Exists(path):
+    return os.path.exists(path)
+
+
+def Describe(path):
+    return _Description(path)
+
+
+def CreateFileGDB_management(out_folder_path, out_name):
+    gdb = os.path.join(out_folder_path, out_name + '.gdb')
+    if not os.path.exists(gdb):
+        os.makedirs(gdb)
+    return _Result([gdb])
+
+
+def CopyFeatures_management(in_features, out_feature_class):
+    if os.path.exists(out_feature_class):
+        shutil.rmtree(out_feature_class)
+    shutil.copytree(in_features, out_feature_class)
+    return _Result([out_feature_class])
+
+
+CopyRows_management = CopyFeatures_management
+
+
+class _Field(object):
+    def __init__(self, name, field_type='OID', length=4):
+        self.name = name
+        self.type = field_type
+        self.length = length
+
+
+def _read_records(dataset):
+    with open(os.path.join(dataset, synthetic.DATASET_META), 'r') as meta:
+        return json.load(meta).get('records', [])
+
+
+def ListFields(dataset):
+    """OBJECTID and the fields of the first synthetic record typed from their values."""
+    records = _read_records(dataset)
+    fields = [_Field('OBJECTID')]
+    for name in (n for n in records[0] if '@' not in n) if records else []:
+        values = [r[name] for r in records if r.get(name) is not None]
+        if values and all(isinstance(v, int) for v in values):
+            fields.append(_Field(name, 'Integer', 4))
+        elif values and all(isinstance(v, (int, float)) for v in values):
+            fields.append(_Field(name, 'Double', 8))
+        else:
+            fields.append(_Field(name, 'String', 255))
+
+    return fields
+
+
+_OID_RANGE = re.compile(r'(\w+) >= (\d+) AND \1 <= (\d+)')
+
+
+def _select(records, where_clause):
+    """(object id, record) pairs, object ids count from 1. Understands the object id ranges zip_loader uses."""
+    selected = list(enumerate(records, 1))
+    match = _OID_RANGE.match(where_clause or '')
+    if match:
+        first, last = int(match.group(2)), int(match.group(3))
+        selected = [(oid, r) for oid, r in selected if first <= oid <= last]
+
+    return selected
+
+
+def _value(oid, record, field):
+    if field == 'OID@':
+        return oid
+    if field == 'SHAPE@WKB':
+        #: WKT bytes stand in for WKB
+        wkt = record.get('SHAPE@WKT')
+        return wkt.encode('utf-8') if wkt is not None else None
+    return record.get(field)
+
+
+def GetCount_management(in_rows):
+    with open(os.path.join(in_rows, synthetic.DATASET_META), 'r') as meta:
+        return _Result([str(json.load(meta)['rows'])])
+
+
+class _SearchCursor(object):
+    """Cursor over the optional "records" list in a synthetic dataset."""
+
+    def __init__(self, in_table, field_names, where_clause=None, sql_clause=None):
+        if not os.path.exists(in_table):
+            raise RuntimeError('cannot open {}'.format(in_table))
+        self.records = _select(_read_records(in_table), where_clause)
+        if isinstance(field_names, str):
+            field_names = [field_names]
+        self.fields = list(field_names)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def __iter__(self):
+        for oid, record in self.records:
+            yield tuple(_value(oid, record, field) for field in self.fields)
+
+
+def _TableToNumPyArray(in_table, field_names, where_clause=None, skip_nulls=False, null_value=None):
+    """Structured array typed like ListFields with nulls replaced from null_value."""
+    field_info = dict((field.name, field) for field in ListFields(in_table))
+    field_info['OID@'] = field_info['OBJECTID']
+    null_value = null_value or {}
+    dtypes = {'OID': '<i4', 'Integer': '<i4', 'Double': '<f8'}
+    dtype = [(name, dtypes.get(field_info[name].type, '<U{}'.format(field_info[name].length)))
+             for name in field_names]
+    rows = []
+    for oid, record in _select(_read_records(in_table), where_clause):
+        row = []
+        for name in field_names:
+            value = _value(oid, record, name)
+            if value is None:
+                if name not in null_value:
+                    raise RuntimeError('Null value in {}'.format(name))
+                value = null_value[name]
+            row.append(value)
+        rows.append(tuple(row))
+
+    return np.array(rows, dtype=dtype)
+
+
+def _Walk(top, datatype=None):
+    """Synthetic datasets are the folders holding a dataset.json."""
+    names = [name for name in sorted(os.listdir(top)) if os.path.exists(os.path.join(top, name, synthetic.DATASET_META))]
+    yield top, [], names
+
+
+class da(object):
+    SearchCursor = _SearchCursor
+    Walk = staticmethod(_Walk)
+    TableToNumPyArray = staticmethod(_TableToNumPyArray)
+
+
+def install():
+    """Register this module as arcpy so synthetic workspaces work with or without ArcGIS Pro."""
+    sys.modules['arcpy'] = sys.modules[__name__]
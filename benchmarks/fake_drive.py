@@ -0,0 +1,395 @@
+"""
+In process stand-in for the Drive v3 and Sheets v4 services used by driver.
+
+FakeServer holds the file tree and injects latency, bandwidth limits, server errors and quota errors.
+The service objects mimic the googleapiclient request interface (execute, next_chunk and the http
+object used by MediaIoBaseDownload) so driver.AgrcDriver and driver.AgrcSheets run unchanged.
+"""
+import hashlib
+import json
+import random
+import re
+import threading
+from collections import deque
+from datetime import datetime
+from time import perf_counter, sleep
+
+import httplib2
+from apiclient import errors
+from apiclient.http import MediaUploadProgress
+
+import driver
+
+FOLDER_MIME = 'application/vnd.google-apps.folder'
+_NAME_QUERY = re.compile(r"name='(.+?)'")
+_PARENT_QUERY = re.compile(r"'([^']+)' in parents")
+_RANGE_HEADER = re.compile(r'bytes=(\d+)-(\d+)')
+
+
+def http_error(status, reason=''):
+    """Build the HttpError googleapiclient raises for a failed response."""
+    content = json.dumps({'error': {'code': status, 'errors': [{'reason': reason}]}}).encode('utf-8')
+    return errors.HttpError(httplib2.Response({'status': status}), content)
+
+
+class FakeServer(object):
+    """
+    Shared state and fault injection for fake Drive and Sheets services.
+
+    latency: seconds added to every call
+    bandwidth: bytes per second for uploads and downloads, None for unlimited
+    error_rate: fraction of calls that fail with a 5xx status
+    quota_calls, quota_window: calls allowed per window seconds before quota_status errors
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None, error_rate=0.0, quota_calls=None, quota_window=1.0,
+                 quota_status=403, page_size=100, seed=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.quota_calls = quota_calls
+        self.quota_window = quota_window
+        self.quota_status = quota_status
+        self.page_size = page_size
+        self.files = {}
+        self.sheets = {}
+        self.calls = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._random = random.Random(seed)
+        self._recent = deque()
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def new_id(self):
+        with self._lock:
+            self._next_id += 1
+            return 'fake{:08d}'.format(self._next_id)
+
+    def add_file(self, file_id=None, name='', parents=None, size=0, mime_type='application/zip'):
+        file_id = file_id or self.new_id()
+        self.files[file_id] = {'id': file_id,
+                               'name': name,
+                               'mimeType': mime_type,
+                               'parents': list(parents or []),
+                               'size': size,
+                               'md5Checksum': hashlib.md5(file_id.encode('utf-8')).hexdigest(),
+                               'modifiedTime': datetime.utcnow().isoformat() + 'Z',
+                               'properties': {},
+                               'permissions': []}
+        return file_id
+
+    def seed_from_specs(self, feature_specs, package_specs, size=1024):
+        """Create the files and folders referenced by spec drive ids."""
+        for spec in list(feature_specs) + list(package_specs):
+            for parent_id in spec['parent_ids']:
+                if parent_id not in self.files:
+                    self.add_file(parent_id, spec['name'], mime_type=FOLDER_MIME)
+            is_package = 'sgid_name' not in spec
+            for key in ('gdb_id', 'shape_id', 'hash_id'):
+                file_id = spec.get(key)
+                if file_id and file_id not in self.files:
+                    if is_package:
+                        self.add_file(file_id, '{}_{}'.format(spec['name'], key[:3]), spec['parent_ids'],
+                                      mime_type=FOLDER_MIME)
+                    else:
+                        self.add_file(file_id, '{}_{}.zip'.format(spec['name'], key[:-3]), spec['parent_ids'], size)
+
+    def call(self, method, latency=True):
+        """Apply latency, quota and error injection for one request. Requests inside a batch skip the latency."""
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            now = perf_counter()
+            over_quota = False
+            if self.quota_calls is not None:
+                while self._recent and now - self._recent[0] > self.quota_window:
+                    self._recent.popleft()
+                self._recent.append(now)
+                over_quota = len(self._recent) > self.quota_calls
+            failed = self._random.random() < self.error_rate
+            status = self._random.choice([500, 502, 503])
+        try:
+            if latency and self.latency:
+                sleep(self.latency)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        if over_quota:
+            reason = 'userRateLimitExceeded' if self.quota_status == 403 else 'rateLimitExceeded'
+            raise http_error(self.quota_status, reason)
+        if failed:
+            raise http_error(status, 'backendError')
+
+    def transfer(self, byte_count):
+        if self.bandwidth:
+            sleep(float(byte_count) / self.bandwidth)
+
+    def get(self, file_id):
+        if file_id not in self.files:
+            raise http_error(404, 'notFound')
+        return self.files[file_id]
+
+
+class _Request(object):
+    """Request that completes with execute()."""
+
+    def __init__(self, server, method, handler):
+        self.server = server
+        self.method = method
+        self.methodId = method
+        self.handler = handler
+
+    def execute(self, num_retries=0):
+        self.server.call(self.method)
+        return self.handler()
+
+
+class _UploadRequest(object):
+    """Resumable media request that completes with repeated next_chunk() calls."""
+
+    def __init__(self, server, method, media_body, finish):
+        self.server = server
+        self.method = method
+        self.methodId = method
+        self.media_body = media_body
+        self.finish = finish
+        self.resumable_progress = 0
+
+    def next_chunk(self, num_retries=0):
+        self.server.call(self.method)
+        total = self.media_body.size()
+        chunk_size = self.media_body.chunksize()
+        if chunk_size is None or chunk_size < 0:
+            chunk_size = total
+        data = self.media_body.getbytes(self.resumable_progress, chunk_size)
+        self.server.transfer(len(data))
+        self.resumable_progress += len(data)
+        if self.resumable_progress >= total:
+            return None, self.finish(total)
+
+        return MediaUploadProgress(self.resumable_progress, total), None
+
+    def execute(self, num_retries=0):
+        response = None
+        while response is None:
+            _, response = self.next_chunk()
+
+        return response
+
+
+class _MediaHttp(object):
+    """http object for get_media requests. Serves ranged reads like the Drive download endpoint."""
+
+    def __init__(self, server, file_id):
+        self.server = server
+        self.file_id = file_id
+
+    def request(self, uri, method='GET', headers=None, **kwargs):
+        try:
+            self.server.call('files.get_media')
+            size = self.server.get(self.file_id)['size']
+        except errors.HttpError as e:
+            return e.resp, e.content
+        start, end = 0, size - 1
+        match = _RANGE_HEADER.match((headers or {}).get('range', ''))
+        if match:
+            start, end = int(match.group(1)), min(int(match.group(2)), size - 1)
+        content = b'\0' * max(0, end - start + 1)
+        self.server.transfer(len(content))
+        response = httplib2.Response({'status': 206, 'content-range': 'bytes {}-{}/{}'.format(start, end, size)})
+
+        return response, content
+
+
+class _MediaRequest(object):
+    def __init__(self, server, file_id):
+        self.uri = 'https://fake.drive/files/{}?alt=media'.format(file_id)
+        self.methodId = 'files.get_media'
+        self.headers = {}
+        self.http = _MediaHttp(server, file_id)
+
+
+class _Files(object):
+    def __init__(self, server):
+        self.server = server
+
+    def _update_metadata(self, file_id, body=None, addParents=None, removeParents=None):
+        file_record = self.server.get(file_id)
+        if body and 'properties' in body:
+            file_record['properties'].update(body['properties'])
+        if addParents:
+            for parent_id in addParents.split(','):
+                if parent_id not in file_record['parents']:
+                    file_record['parents'].append(parent_id)
+        if removeParents:
+            for parent_id in removeParents.split(','):
+                if parent_id in file_record['parents']:
+                    file_record['parents'].remove(parent_id)
+        file_record['modifiedTime'] = datetime.utcnow().isoformat() + 'Z'
+
+        return dict(file_record, size=str(file_record['size']))
+
+    def update(self, fileId, fields=None, body=None, media_body=None, addParents=None, removeParents=None):
+        if media_body is not None:
+            def finish(size):
+                self.server.get(fileId)['size'] = size
+                return self._update_metadata(fileId, body, addParents, removeParents)
+            return _UploadRequest(self.server, 'files.update.media', media_body, finish)
+
+        return _Request(self.server, 'files.update',
+                        lambda: self._update_metadata(fileId, body, addParents, removeParents))
+
+    def create(self, body=None, media_body=None, fields=None):
+        body = body or {}
+
+        def finish(size=0):
+            file_id = self.server.add_file(name=body.get('name', ''),
+                                           parents=body.get('parents'),
+                                           size=size,
+                                           mime_type=body.get('mimeType'))
+            return {'id': file_id}
+
+        if media_body is not None:
+            return _UploadRequest(self.server, 'files.create.media', media_body, finish)
+
+        return _Request(self.server, 'files.create', finish)
+
+    def get(self, fileId, fields=None):
+        return _Request(self.server, 'files.get',
+                        lambda: dict(self.server.get(fileId), size=str(self.server.get(fileId)['size'])))
+
+    def get_media(self, fileId):
+        return _MediaRequest(self.server, fileId)
+
+    def list(self, q='', spaces=None, fields=None, pageToken=None, pageSize=None, **kwargs):
+        def handler():
+            name = _NAME_QUERY.search(q)
+            parents = _PARENT_QUERY.findall(q)
+            matches = [f for f in sorted(self.server.files.values(), key=lambda f: f['id'])
+                       if (name is None or f['name'] == name.group(1)) and
+                       (not parents or any(parent in f['parents'] for parent in parents))]
+            page_size = min(pageSize or self.server.page_size, self.server.page_size)
+            start = int(pageToken or 0)
+            page = [dict(f, size=str(f['size'])) for f in matches[start:start + page_size]]
+            response = {'files': page}
+            if start + page_size < len(matches):
+                response['nextPageToken'] = str(start + page_size)
+            return response
+
+        return _Request(self.server, 'files.list', handler)
+
+    def delete(self, fileId):
+        return _Request(self.server, 'files.delete', lambda: self.server.files.pop(self.server.get(fileId)['id']))
+
+
+class _Permissions(object):
+    def __init__(self, server):
+        self.server = server
+
+    def create(self, fileId, body=None, transferOwnership=False, sendNotificationEmail=True, fields=None):
+        def handler():
+            permission = dict(body or {}, id=self.server.new_id())
+            self.server.get(fileId)['permissions'].append(permission)
+            return {'id': permission['id']}
+
+        return _Request(self.server, 'permissions.create', handler)
+
+    def list(self, fileId, fields=None):
+        return _Request(self.server, 'permissions.list',
+                        lambda: {'permissions': list(self.server.get(fileId)['permissions'])})
+
+
+class _Batch(object):
+    """Batch request sent as one round trip. Each inner request still counts against quota and can fail."""
+
+    def __init__(self, server, callback=None):
+        self.server = server
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        if request_id is None:
+            request_id = str(len(self.requests))
+        self.requests.append((request_id, request, callback or self.callback))
+
+    def execute(self):
+        self.server.call('batch')
+        for request_id, request, callback in self.requests:
+            try:
+                self.server.call(request.method, latency=False)
+                response, exception = request.handler(), None
+            except errors.HttpError as e:
+                response, exception = None, e
+            callback(request_id, response, exception)
+
+
+class FakeDriveService(object):
+    def __init__(self, server):
+        self.server = server
+
+    def files(self):
+        return _Files(self.server)
+
+    def permissions(self):
+        return _Permissions(self.server)
+
+    def new_batch_http_request(self, callback=None):
+        return _Batch(self.server, callback)
+
+
+class _Values(object):
+    def __init__(self, server):
+        self.server = server
+
+    def append(self, spreadsheetId, range, body=None, **kwargs):
+        def handler():
+            self.server.sheets.setdefault((spreadsheetId, range.split('!')[0]), []).extend(body['values'])
+            return {'spreadsheetId': spreadsheetId}
+
+        return _Request(self.server, 'sheets.append', handler)
+
+    def get(self, spreadsheetId, range, majorDimension='ROWS', **kwargs):
+        def handler():
+            rows = self.server.sheets.get((spreadsheetId, range.split('!')[0]), [])
+            if majorDimension == 'COLUMNS':
+                return {'values': [list(column) for column in zip(*rows)] or [[]]}
+            return {'values': rows}
+
+        return _Request(self.server, 'sheets.get', handler)
+
+    def update(self, spreadsheetId, range, body=None, **kwargs):
+        return _Request(self.server, 'sheets.update', lambda: {'spreadsheetId': spreadsheetId})
+
+
+class _Spreadsheets(object):
+    def __init__(self, server):
+        self.server = server
+
+    def values(self):
+        return _Values(self.server)
+
+
+class FakeSheetsService(object):
+    def __init__(self, server):
+        self.server = server
+
+    def spreadsheets(self):
+        return _Spreadsheets(self.server)
+
+
+def install(server):
+    """Replace driver.ApiService so modules that build services at import time get fakes backed by server."""
+
+    class FakeApiService(object):
+        def __init__(self, apis, secrets=None, scopes=None, use_oauth=False):
+            self.services = []
+            for api_name, _ in apis:
+                if api_name == driver.APIS.sheets[0]:
+                    self.services.append(FakeSheetsService(server))
+                else:
+                    self.services.append(FakeDriveService(server))
+
+    driver.ApiService = FakeApiService
+    return FakeApiService
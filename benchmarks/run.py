@@ -0,0 +1,370 @@
+"""
+Run zip_loader and driver benchmarks against the fake Drive server and compare with a stored baseline.
+
+python -m benchmarks.run                      run every scenario and check benchmarks/baseline.json
+python -m benchmarks.run --save_baseline      record the current numbers as the baseline
+python -m benchmarks.run zip_folder download_file --latency 0.05 --bandwidth 2000000
+"""
+import argparse
+import copy
+import json
+import os
+import shutil
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from benchmarks import fake_arcpy, fake_drive, synthetic
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+MB = 1048576
+
+
+class Context(object):
+    """Fake services, modules under test and a scratch directory shared by scenarios."""
+
+    def __init__(self, args):
+        fake_arcpy.install()
+        self.server = fake_drive.FakeServer(latency=args.latency,
+                                            bandwidth=args.bandwidth,
+                                            error_rate=args.error_rate,
+                                            quota_calls=args.quota_calls,
+                                            quota_window=args.quota_window,
+                                            quota_status=args.quota_status,
+                                            seed=args.seed)
+        fake_drive.install(self.server)
+
+        import manifest
+        import quota
+        import run_state
+        import spec_manager
+        import tracing
+        import zip_loader
+        self.spec_manager = spec_manager
+        self.tracing = tracing
+        self.zip_loader = zip_loader
+        zip_loader.EXPORT_WORKERS = args.export_workers
+        zip_loader.EXPORT_WORKER_SETUP = fake_arcpy.install
+        if args.upload_cap:
+            zip_loader.driver.upload_governor = zip_loader.driver.UploadGovernor(args.upload_cap * MB)
+
+        self.root = tempfile.mkdtemp(prefix='sgid_bench_')
+        #: Scenarios save specs so work on copies of the tracked json
+        for attribute in ('FEATURE_SPEC_FOLDER', 'PACKAGE_SPEC_FOLDER'):
+            copy = os.path.join(self.root, getattr(spec_manager, attribute))
+            shutil.copytree(getattr(spec_manager, attribute), copy)
+            setattr(spec_manager, attribute, copy)
+        manifest.MANIFEST_FOLDER = os.path.join(self.root, manifest.MANIFEST_FOLDER)
+        run_state.RUN_STATE_FILE = os.path.join(self.root, run_state.RUN_STATE_FILE)
+        quota.QUOTA_FOLDER = os.path.join(self.root, quota.QUOTA_FOLDER)
+        if not args.quota:
+            quota.RATES = dict((bucket, None) for bucket in quota.RATES)
+
+        features = [spec_manager.load_feature_json(p) for p in spec_manager.get_feature_spec_path_list()]
+        packages = [spec_manager.load_feature_json(p) for p in spec_manager.get_package_spec_path_list()]
+        self.server.seed_from_specs(features, packages)
+        #: Packages that list features without specs fail on Drive lookups of empty ids
+        self.packages = [p for p in packages if all(self.has_feature_spec(f) for f in p['feature_classes'])]
+
+    def has_feature_spec(self, sgid_name):
+        spec_name = self.spec_manager.create_feature_spec_name(sgid_name)
+        return os.path.exists(os.path.join(self.spec_manager.FEATURE_SPEC_FOLDER, spec_name))
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def reset_counters(self):
+        self.tracing.tracer = self.tracing.Tracer()
+        self.server.calls = {}
+
+    def api_calls(self):
+        return sum(self.server.calls.values())
+
+    def close(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def _percentile(values, percent):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(percent / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _timed(function, repeat):
+    seconds = []
+    for _ in range(repeat):
+        start = perf_counter()
+        function()
+        seconds.append(perf_counter() - start)
+
+    return seconds
+
+
+def _result(seconds, calls, byte_count=None, operations=None):
+    median = _percentile(seconds, 50)
+    result = {'median_s': round(median, 6),
+              'p95_s': round(_percentile(seconds, 95), 6),
+              'runs': len(seconds),
+              'api_calls': calls // len(seconds)}
+    if byte_count is not None:
+        result['mb_per_s'] = round(byte_count / MB / median, 3) if median else 0
+    if operations is not None:
+        result['ops_per_s'] = round(operations / median, 3) if median else 0
+
+    return result
+
+
+def bench_zip_folder(context, args):
+    results = {}
+    for size in args.sizes:
+        folder = synthetic.make_feature_folder(context.path('zip_folder'), 'Size{}MB'.format(size), size * MB)
+        zip_name = context.path('zip_folder', 'Size{}MB_gdb.zip'.format(size))
+        context.reset_counters()
+        seconds = _timed(lambda: context.zip_loader.zip_folder(folder, zip_name), args.repeat)
+        results['zip_folder[{}MB]'.format(size)] = _result(seconds, context.api_calls(), byte_count=size * MB)
+
+    return results
+
+
+def bench_load_zip_to_drive(context, args):
+    results = {}
+    for size in args.sizes:
+        folder = synthetic.make_feature_folder(context.path('upload'), 'Size{}MB'.format(size), size * MB)
+        zip_name = context.path('upload', 'Size{}MB_gdb.zip'.format(size))
+        context.zip_loader.zip_folder(folder, zip_name)
+        parent_id = context.server.add_file(name='Size{}MB'.format(size), mime_type=fake_drive.FOLDER_MIME)
+        spec = {'gdb_id': ''}
+        context.reset_counters()
+        #: First call creates and transfers ownership, the rest update in place
+        seconds = _timed(lambda: context.zip_loader.load_zip_to_drive(spec, 'gdb_id', zip_name, [parent_id]),
+                         args.repeat)
+        results['load_zip_to_drive[{}MB]'.format(size)] = _result(seconds, context.api_calls(),
+                                                                  byte_count=os.path.getsize(zip_name))
+
+    return results
+
+
+def bench_download_file(context, args):
+    results = {}
+    for size in args.sizes:
+        file_id = context.server.add_file(name='Size{}MB_hash.zip'.format(size), size=size * MB)
+        output = context.path('Size{}MB_download.zip'.format(size))
+        context.reset_counters()
+        seconds = _timed(lambda: context.zip_loader.drive.download_file(file_id, output), args.repeat)
+        results['download_file[{}MB]'.format(size)] = _result(seconds, context.api_calls(), byte_count=size * MB)
+
+    return results
+
+
+def bench_sync_package_and_features(context, args):
+    packages = context.packages[:args.packages] if args.packages else context.packages
+    context.reset_counters()
+
+    def sync_all():
+        for package in packages:
+            context.zip_loader.sync_package_and_features(package)
+
+    seconds = _timed(sync_all, args.repeat)
+
+    return {'sync_package_and_features': _result(seconds, context.api_calls(), operations=len(packages))}
+
+
+def bench_concurrent_calls(context, args):
+    """get_parents for many files through driver.map_calls, use --quota_calls to see the limit back off."""
+    driver = context.zip_loader.driver
+    file_ids = [context.server.add_file(name='concurrent{}.zip'.format(i)) for i in range(args.calls)]
+    context.reset_counters()
+
+    def run():
+        driver.concurrency = driver.ConcurrencyLimit()
+        context.server.max_in_flight = 0
+        driver.map_calls(context.zip_loader.drive.get_parents, file_ids)
+
+    seconds = _timed(run, args.repeat)
+    counters = context.tracing.tracer.counters
+    print('concurrency limit {}, most in flight {}, {} rate limited, {} decreases'.format(
+        counters.get('drive.concurrency_limit'), context.server.max_in_flight, counters.get('drive.rate_limited', 0),
+        counters.get('drive.concurrency_decreases', 0)))
+
+    return {'concurrent_calls': _result(seconds, context.api_calls(), operations=len(file_ids))}
+
+
+def bench_run_packages(context, args):
+    packages = context.packages[:args.packages] if args.packages else context.packages
+    feature_names = sorted(set(f for p in packages for f in p['feature_classes']))
+    workspace = synthetic.make_workspace(context.path('workspace'), feature_names,
+                                         max_rows=args.max_rows, seed=args.seed)
+    package_list = context.path('run_packages.json')
+    with open(package_list, 'w') as f_out:
+        json.dump({'packages': [p['name'] for p in packages]}, f_out)
+    output_directory = context.path('package_temp')
+    byte_count = sum(os.path.getsize(os.path.join(workspace, f, synthetic.DATASET_DATA)) for f in feature_names)
+
+    def run():
+        if os.path.exists(output_directory):
+            shutil.rmtree(output_directory)
+        os.makedirs(output_directory)
+        #: Each repeat is a fresh run
+        context.zip_loader.published_features.clear()
+        context.zip_loader.scratch_spaces.clear()
+        context.zip_loader.workspace_indexes.clear()
+        context.zip_loader.run_packages(workspace, output_directory, package_list)
+
+    context.reset_counters()
+    seconds = _timed(run, args.repeat)
+
+    return {'run_packages': _result(seconds, context.api_calls(), byte_count=byte_count,
+                                    operations=len(feature_names))}
+
+
+def bench_plan(context, args):
+    """Plan an --all run with every spec changed against a snapshot of the fake server, it makes no API calls."""
+    import storage_report
+    feature_names = sorted(f['sgid_name'] for f in context.spec_manager.get_feature_specs() if f['sgid_name'])
+    workspace = context.path('plan_workspace')
+    for sgid_name in feature_names:
+        synthetic.make_dataset(workspace, sgid_name, 1)
+    change_table = context.path('plan_changes.csv')
+    with open(change_table, 'w') as f_out:
+        f_out.write('table_name,last_modified\n')
+        yesterday = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
+        f_out.writelines('{},{}\n'.format(name, yesterday) for name in feature_names)
+    snapshot = {'taken': datetime.now().isoformat(), 'files': copy.deepcopy(context.server.files)}
+    plan_args = argparse.Namespace(check_features=True, check_packages=True, feature_category=None, since=None,
+                                   change_table=change_table, schedule=False, feature_list=None, package_list=None,
+                                   feature=None, package=None, force=False,
+                                   snapshot=storage_report.save_snapshot(snapshot, context.path('snapshots')))
+    plans = []
+
+    def run():
+        context.zip_loader.workspace_indexes.clear()
+        plans.append(context.zip_loader.plan_run(workspace, plan_args))
+
+    context.reset_counters()
+    seconds = _timed(run, args.repeat)
+
+    return {'plan': _result(seconds, context.api_calls(), operations=len(plans[-1]['features']))}
+
+
+def bench_row_hash(context, args):
+    import rowhash
+    rows, wkbs = synthetic.make_rows(args.hash_rows, seed=args.seed)
+    fields = [name for name in rows.dtype.names if name != 'OID@']
+    widths = {'NAME': 50, 'TYPE': 10}
+    context.reset_counters()
+    seconds = _timed(lambda: rowhash.hash_block(rows, fields, wkbs, widths), args.repeat)
+
+    return {'row_hash[{}]'.format(args.hash_rows): _result(seconds, context.api_calls(), operations=args.hash_rows)}
+
+
+SCENARIOS = {
+    'zip_folder': bench_zip_folder,
+    'load_zip_to_drive': bench_load_zip_to_drive,
+    'download_file': bench_download_file,
+    'sync_package_and_features': bench_sync_package_and_features,
+    'concurrent_calls': bench_concurrent_calls,
+    'run_packages': bench_run_packages,
+    'row_hash': bench_row_hash,
+    'plan': bench_plan,
+}
+
+
+def print_table(results):
+    columns = ('median_s', 'p95_s', 'mb_per_s', 'ops_per_s', 'api_calls')
+    print('\n{:<34}'.format('scenario') + ''.join('{:>12}'.format(c) for c in columns))
+    for name in sorted(results):
+        print('{:<34}'.format(name) + ''.join('{:>12}'.format(results[name].get(c, '')) for c in columns))
+
+
+def compare(results, baseline, tolerance):
+    """List scenarios whose median time grew by more than tolerance or that make more API calls than baseline."""
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        current = results[name]
+        expected = baseline[name]
+        if current['median_s'] > expected['median_s'] * (1 + tolerance):
+            regressions.append('{}: median {}s vs baseline {}s'.format(name, current['median_s'],
+                                                                         expected['median_s']))
+        if current['api_calls'] > expected['api_calls']:
+            regressions.append('{}: {} api calls vs baseline {}'.format(name, current['api_calls'],
+                                                                        expected['api_calls']))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark zip_loader against a fake Drive server')
+    parser.add_argument('scenarios', nargs='*', default=[],
+                        help='Scenarios to run, any of {}. Runs all when omitted'.format(', '.join(sorted(SCENARIOS))))
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 8, 32],
+                        help='Synthetic folder sizes in MB')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--packages', type=int, default=None,
+                        help='Limit package scenarios to the first N package specs')
+    parser.add_argument('--max_rows', type=int, default=20000,
+                        help='Largest synthetic dataset in rows for run_packages')
+    parser.add_argument('--export_workers', type=int, default=1, help='Export worker processes for run_packages')
+    parser.add_argument('--upload_cap', type=float, default=None, help='Upload cap in MB per second')
+    parser.add_argument('--calls', type=int, default=400, help='get_parents calls made by concurrent_calls')
+    parser.add_argument('--quota', action='store_true',
+                        help='Apply the shared quota buckets in quota.RATES to fake API calls')
+    parser.add_argument('--hash_rows', type=int, default=1000000, help='Rows hashed by the row_hash scenario')
+    parser.add_argument('--latency', type=float, default=0.005, help='Seconds added to every fake API call')
+    parser.add_argument('--bandwidth', type=float, default=None, help='Fake transfer rate in bytes per second')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Fraction of calls failing with 5xx')
+    parser.add_argument('--quota_calls', type=int, default=None, help='Calls allowed per quota window')
+    parser.add_argument('--quota_window', type=float, default=1.0)
+    parser.add_argument('--quota_status', type=int, default=403, choices=[403, 429])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed fractional slowdown against the baseline median')
+    parser.add_argument('--save_baseline', action='store_true', help='Write results to the baseline file')
+    parser.add_argument('--output', help='Also write results as json to this path')
+    args = parser.parse_args(argv)
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario {}'.format(name))
+
+    context = Context(args)
+    results = {}
+    try:
+        for name in args.scenarios or sorted(SCENARIOS):
+            print('Running', name)
+            results.update(SCENARIOS[name](context, args))
+    finally:
+        context.close()
+
+    print_table(results)
+    if args.output:
+        with open(args.output, 'w') as f_out:
+            json.dump(results, f_out, sort_keys=True, indent=4)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, 'r') as json_file:
+                baseline = json.load(json_file)
+        baseline.update(results)
+        with open(args.baseline, 'w') as f_out:
+            f_out.write(json.dumps(baseline, sort_keys=True, indent=4))
+            f_out.write('\n')
+        print('Baseline saved to', args.baseline)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print('No baseline at {}. Run with --save_baseline to create one.'.format(args.baseline))
+        return 0
+    with open(args.baseline, 'r') as json_file:
+        regressions = compare(results, json.load(json_file), args.tolerance)
+    for regression in regressions:
+        print('REGRESSION', regression)
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
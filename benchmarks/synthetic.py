@@ -0,0 +1,82 @@
+"""Synthetic SGID datasets and feature folders for benchmarks"""
+import json
+import os
+import random
+import struct
+
+import numpy as np
+
+DATASET_META = 'dataset.json'
+DATASET_DATA = 'data.bin'
+#: Roughly what a row costs in a file geodatabase
+BYTES_PER_ROW = 256
+
+
+def _fill(f_out, size, rand):
+    """Write size bytes that compress about as well as attribute data, half noise and half repeats."""
+    block = 65536
+    written = 0
+    while written < size:
+        length = min(block, size - written)
+        noise = rand.getrandbits(8 * 4096).to_bytes(4096, 'little')
+        chunk = (noise * (length // len(noise) + 1))[:length // 2]
+        f_out.write(chunk + b'\0' * (length - len(chunk)))
+        written += length
+
+
+def make_feature_folder(root, name, size_bytes, file_count=8, seed=0):
+    """Create a folder shaped like an exported file geodatabase with size_bytes of content."""
+    rand = random.Random(seed)
+    folder = os.path.join(root, name + '.gdb')
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    per_file = size_bytes // file_count
+    for i in range(file_count):
+        with open(os.path.join(folder, 'a{:08x}.gdbtable'.format(i)), 'wb') as f_out:
+            _fill(f_out, per_file, rand)
+
+    return folder
+
+
+def make_dataset(workspace, sgid_name, rows, is_table=False, seed=0):
+    """Create a dataset readable by benchmarks.fake_arcpy at workspace/sgid_name."""
+    path = os.path.join(workspace, sgid_name)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    with open(os.path.join(path, DATASET_META), 'w') as f_out:
+        json.dump({'rows': rows, 'type': 'Table' if is_table else 'FeatureClass'}, f_out)
+    with open(os.path.join(path, DATASET_DATA), 'wb') as f_out:
+        _fill(f_out, rows * BYTES_PER_ROW, random.Random(seed))
+
+    return path
+
+
+def make_workspace(workspace, sgid_names, min_rows=100, max_rows=20000, seed=0):
+    """Create one synthetic dataset for each sgid name with a log-uniform spread of row counts."""
+    rand = random.Random(seed)
+    for i, sgid_name in enumerate(sgid_names):
+        rows = int(min_rows * (float(max_rows) / min_rows) ** rand.random())
+        make_dataset(workspace, sgid_name, rows, seed=seed + i)
+
+    return workspace
+
+
+def make_rows(rows, seed=0):
+    """
+    Attribute rows shaped like TableToNumPyArray output for an address point layer plus point WKB.
+
+    returns: (structured array, list of WKB bytes)
+    """
+    rand = np.random.default_rng(seed)
+    array = np.zeros(rows, dtype=[('OID@', '<i4'), ('ADDNUM', '<i4'), ('NAME', '<U50'), ('TYPE', '<U10'),
+                                  ('ELEV', '<f8'), ('EDITED', '<M8[us]')])
+    array['OID@'] = np.arange(1, rows + 1)
+    array['ADDNUM'] = rand.integers(1, 20000, rows)
+    array['NAME'] = np.char.add('STREET ', rand.integers(0, 5000, rows).astype('U5'))
+    array['TYPE'] = 'RD'
+    array['ELEV'] = rand.random(rows) * 3000
+    array['EDITED'] = np.datetime64('2020-01-01') + rand.integers(0, 10 ** 6, rows).astype('m8[s]')
+    points = rand.random((rows, 2)) * 500000
+    wkbs = [struct.pack('<BIdd', 1, 1, x, y) for x, y in points.tolist()]
+
+    return array, wkbs
@@ -0,0 +1,120 @@
+"""
+Row level changesets published between full zip refreshes of large, slowly changing features.
+
+Rows are hashed by rowhash and the baseline is the cached manifest of the last full zips, the same hashes and store
+the _hash.zip manifests use, so there is no row hashing or baseline state of its own here.
+"""
+import json
+import os
+import zipfile
+from datetime import datetime
+
+import manifest
+
+#: Days between full zip refreshes of delta features
+FULL_REFRESH_DAYS = 7
+#: Publish full zips instead of a delta when more than this fraction of rows changed
+MAX_CHANGE_RATIO = 0.2
+DATE_FORMAT = '%Y-%m-%d'
+#: 2 carries geometry as WKB hex
+FORMAT_VERSION = 2
+
+
+def is_delta_feature(spec):
+    """Features opt in with "delta": true and a stable "primary_key" field in their spec."""
+    return bool(spec.get('delta')) and bool(spec.get('primary_key'))
+
+
+def load_baseline(sgid_name, folder=None):
+    """
+    Row hashes of the last published full zips from the manifest cache.
+
+    returns: {'base': date, 'primary_key': field, 'hashes': {key: hash}} or None
+    """
+    published = manifest.load_cached(sgid_name, folder)
+    if published is None:
+        return None
+
+    return {'base': datetime.strptime(published.header['created'][:10], DATE_FORMAT).date(),
+            'primary_key': published.header['key_field'],
+            'hashes': published.to_dict()}
+
+
+def needs_full_refresh(baseline, primary_key, today, full_refresh_days=None):
+    """Full zips are due without a baseline, when the key changed or after full_refresh_days."""
+    full_refresh_days = FULL_REFRESH_DAYS if full_refresh_days is None else full_refresh_days
+    if baseline is None or baseline['primary_key'] != primary_key:
+        return True
+
+    return (today - baseline['base']).days >= full_refresh_days
+
+
+def write_changeset(blocks, baseline, changeset_path, header):
+    """
+    Compare rows with baseline hashes and write changed rows as json lines.
+
+    The first line is header plus the change counts. Each following line is
+    {"op": "insert" | "update" | "delete", "key": key, "attributes": {...}, "wkb": hex geometry}.
+    Deletes only carry the key.
+    Changesets are cumulative from the baseline so consumers apply the latest one to the last full zip.
+    blocks: rowhash.Block objects
+    returns: {'insert': n, 'update': n, 'delete': n, 'rows': n, 'duplicate_keys': n, 'hashes': [(key, hash)]}
+        with duplicate_keys counting rows whose key an earlier row already had
+    """
+    previous = baseline['hashes'] if baseline else {}
+    hashes = {}
+    pairs = []
+    duplicate_keys = 0
+    counts = {'insert': 0, 'update': 0, 'delete': 0}
+    body_path = changeset_path + '.body'
+    with open(body_path, 'w') as body:
+        for block in blocks:
+            for index, (key, row_hash) in enumerate(zip(block.keys.tolist(), block.hashes.tolist())):
+                key = manifest.normalize_key(key)
+                if key in hashes:
+                    duplicate_keys += 1
+                hashes[key] = row_hash
+                pairs.append((key, row_hash))
+                if previous.get(key) == row_hash:
+                    continue
+                op = 'update' if key in previous else 'insert'
+                counts[op] += 1
+                wkb = block.wkbs[index] if block.wkbs is not None else None
+                body.write(json.dumps({'op': op,
+                                       'key': key,
+                                       'attributes': block.attributes(index),
+                                       'wkb': bytes(wkb).hex() if wkb is not None else None}, default=str))
+                body.write('\n')
+        for key in previous:
+            if key not in hashes:
+                counts['delete'] += 1
+                body.write(json.dumps({'op': 'delete', 'key': key}))
+                body.write('\n')
+
+    header = dict(header, version=FORMAT_VERSION, **counts)
+    with open(changeset_path, 'w') as f_out:
+        f_out.write(json.dumps(header, sort_keys=True, default=str))
+        f_out.write('\n')
+        with open(body_path, 'r') as body:
+            for line in body:
+                f_out.write(line)
+    os.remove(body_path)
+
+    counts['rows'] = len(pairs)
+    counts['duplicate_keys'] = duplicate_keys
+    counts['hashes'] = pairs
+
+    return counts
+
+
+def change_ratio(counts, baseline):
+    """Changed rows as a fraction of the baseline row count."""
+    changed = counts['insert'] + counts['update'] + counts['delete']
+    base_rows = len(baseline['hashes']) if baseline else 0
+
+    return float(changed) / base_rows if base_rows else 1.0
+
+
+def zip_changeset(changeset_path, zip_name):
+    with zipfile.ZipFile(zip_name, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.write(changeset_path, os.path.basename(changeset_path))
@@ -8,6 +8,7 @@ import csv
 import time
 
 import spec_manager
+import storage_report
 import driver
 api_services = driver.ApiService((driver.APIS.drive, driver.APIS.sheets),
                                  secrets=driver.OAUTH_CLIENT_SECRET_FILE,
@@ -601,82 +602,55 @@ def get_folder_id(name, parent_id):
     return name_id
 
 
+def get_file_sizes():
+    """Get {drive id: bytes} for every SGID file from one listing of the SGID folders."""
+    snapshot = storage_report.get_snapshot(user_drive)
+    return dict((file_id, f['size']) for file_id, f in snapshot['files'].items())
+
+
 def get_hash_size_csv():
     features = spec_manager.get_feature_specs()
+    sizes = get_file_sizes()
     out_csv = 'data/hash_sizes'
     hash_size_records = [['name', 'hash_size', 'cycle']]
     for feature in features:
         if feature['hash_id'] == "":
             continue
         name = feature['sgid_name']
-        print(name)
-        size = user_drive.get_size(feature['hash_id'])
-        time.sleep(0.5)
-        cycle = feature['update_cycle']
-        print('\t', size)
+        size = sizes.get(feature['hash_id'], 0)
+        cycle = feature.get('update_cycle', '')
         hash_size_records.append([name, size, cycle])
 
-    with open(out_csv, 'wb') as out_table:
+    with open(out_csv, 'w', newline='') as out_table:
         table = csv.writer(out_table)
         table.writerows(hash_size_records)
 
 
 def get_spec_property_csv(properties):
     features = spec_manager.get_feature_specs()
+    sizes = get_file_sizes()
     output_rows = []
     out_csv = 'data/properties.csv'
-    count = 0
     for feature in features:
-        if count % 50 == 0:
-            print(count)
-        count += 1
         out_row = [feature[p] for p in properties]
         if feature['gdb_id'] == "":
             print(feature['sgid_name'])
             continue
-        out_row.append(float(user_drive.get_size(feature['gdb_id'])) / 1048576)
-        time.sleep(0.01)
+        out_row.append(float(sizes.get(feature['gdb_id'], 0)) / 1048576)
         output_rows.append(out_row)
 
-    print(count)
-    with open(out_csv, 'wb') as out_table:
+    print(len(features))
+    with open(out_csv, 'w', newline='') as out_table:
         table = csv.writer(out_table)
         table.writerow(properties + ['MB'])
         table.writerows(output_rows)
 
 
 def get_total_data_size():
-    features = spec_manager.get_feature_specs()
-    sizes =[]
-    for feature in features:
-        if feature['gdb_id'] == "" or feature['shape_id'] == "":
-            continue
-        name = feature['sgid_name']
-        print(name)
-        size = user_drive.get_size(feature['gdb_id']) * 0.000001
-        size += user_drive.get_size(feature['shape_id']) * 0.000001
-        time.sleep(0.1)
-        print('\t', size)
-        sizes.append(size)
-        if len(sizes) == 10:
-            return
-
-    print('Total feature MBs:', sum(sizes))
-    packages = spec_manager.get_package_specs()
-    for package in packages:
-        if package['gdb_id'] == "" or package['shape_id'] == "":
-            continue
-        name = package['name']
-        print(name)
-        size = user_drive.get_size(package['gdb_id']) * 0.000001
-        size += user_drive.get_size(package['shape_id']) * 0.000001
-        time.sleep(0.1)
-        print('\t', size)
-        sizes.append(size)
-
-    print('total specs:', len(features) + len(packages))
-    print('total sizes:', len(sizes))
-    print('Total MBs:', sum(sizes))
+    report = storage_report.run_report(user_drive)
+    print('total specs:', len(report['features']) + len(report['packages']))
+    print('Total feature MBs:', sum(r['total_bytes'] for r in report['features'].values()) * 0.000001)
+    print('Total MBs:', report['total_bytes'] * 0.000001)
 
 
 def set_cycle_by_date_in_name():
@@ -755,18 +729,21 @@ def replace_paths_in_stewardship():
     #     print(i, path)
 
 
-def add_permissions(category, user_email):
+def add_permissions(category, user_email, role='writer'):
     features = spec_manager.get_feature_specs()
+    ids = []
     for feature in features:
         if category is None or category.upper() == feature['category'].upper():
-            ids = [
+            ids.extend([
                 feature['gdb_id'],
                 feature['hash_id'],
                 feature['shape_id']
-            ]
-            for file_id in ids:
-                print(user_drive.add_editor(file_id, user_email), feature['name'])
-                time.sleep(0.2)
+            ])
+    result = user_drive.grant_permissions(ids, user_email, role)
+    for file_id in result['failed']:
+        print('failed', file_id, result['failed'][file_id])
+
+    return result
 
 
 def find_id(drive_id):
@@ -1,6 +1,6 @@
 """Code to facilitate interaction with the Google Drive API"""
 from apiclient import errors
-from apiclient.http import MediaFileUpload, MediaIoBaseDownload, MediaIoBaseUpload
+from apiclient.http import DEFAULT_CHUNK_SIZE, MediaFileUpload, MediaIoBaseDownload, MediaIoBaseUpload
 import httplib2
 from apiclient import discovery
 from oauth2client import client
@@ -9,10 +9,23 @@ from oauth2client.file import Storage
 from oauth2client.service_account import ServiceAccountCredentials
 
 import io
+import json
 import os
-from time import sleep
+import socket
+import ssl
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from http.client import HTTPException
+from time import sleep, perf_counter
 from random import uniform
 
+import metrics
+import profiling
+import quota
+import tracing
+
 SCOPES = 'https://www.googleapis.com/auth/drive'
 SERVICE_ACCOUNT_SECRET_FILE = 'service_secret.json'
 # oauth2
@@ -20,6 +33,593 @@ OAUTH_CLIENT_SECRET_FILE = 'client_secret.json'
 APPLICATION_NAME = 'SGID on Drive'
 
 flags = None
+#: Requests per batch call and sustained requests per second for bulk permission changes
+BATCH_SIZE = 50
+BULK_CALLS_PER_SECOND = 10
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+RATE_LIMIT_REASONS = ['rateLimitExceeded', 'userRateLimitExceeded']
+#: Higher rank roles include lower rank roles
+ROLE_RANKS = {'reader': 1, 'commenter': 2, 'writer': 3, 'fileOrganizer': 4, 'organizer': 5, 'owner': 6}
+MB = 1048576
+#: Resumable upload chunks must be a multiple of this many bytes
+CHUNK_ALIGN = 262144
+#: Seconds of upload a paced chunk holds, smaller chunks follow the cap more closely at the cost of more requests
+PACED_CHUNK_SECONDS = 2
+#: Bounds and starting size for adaptive upload chunks. Each chunk is held in memory while it is sent
+MIN_CHUNK = 4 * CHUNK_ALIGN
+MAX_CHUNK = 128 * MB
+INITIAL_CHUNK = 8 * MB
+#: Seconds each upload chunk should take, and at least this many round trips so request overhead stays small
+CHUNK_SECONDS = 10
+CHUNK_ROUND_TRIPS = 20
+#: Bounds and starting point for Drive calls in flight from this process, see ConcurrencyLimit
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 16
+INITIAL_CONCURRENCY = 4
+#: Share of the concurrency limit kept after a rate limit or server error
+CONCURRENCY_DECREASE = 0.5
+#: Attempts for a request that keeps getting rate limited or cut off
+RATE_LIMIT_ATTEMPTS = 5
+#: Seconds a socket waits on Drive or Sheets before the request fails, None waits forever
+HTTP_TIMEOUT = 120
+#: Seconds an upload can go without finishing a chunk before the watchdog aborts it
+UPLOAD_STALL_SECONDS = 300
+#: Circuit breaker: recent requests considered, failure share that opens it, fewest requests to judge on and
+#: seconds it stays open before one probe request, doubling up to the maximum while probes fail
+BREAKER_WINDOW = 20
+BREAKER_FAILURE_RATE = 0.5
+BREAKER_MIN_REQUESTS = 8
+BREAKER_COOLDOWN = 30
+BREAKER_MAX_COOLDOWN = 600
+#: Errors from a connection that failed or was cut off before a response came back
+NETWORK_ERRORS = (socket.timeout, ConnectionError, HTTPException, httplib2.HttpLib2Error, ssl.SSLError)
+
+
+class DriveUnavailable(Exception):
+    """Drive or Sheets is failing requests, raised instead of retrying while the circuit breaker is open."""
+
+
+class UploadStalled(DriveUnavailable):
+    """The watchdog aborted an upload that stopped making progress."""
+
+
+def is_rate_limited(http_error):
+    """True for 429 responses and 403 responses with a rate limit reason."""
+    if http_error.resp.status == 429:
+        return True
+    if http_error.resp.status == 403:
+        try:
+            details = json.loads(http_error.content.decode('utf-8'))['error']['errors']
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return False
+        return any(d.get('reason') in RATE_LIMIT_REASONS for d in details)
+
+    return False
+
+
+def is_retryable(http_error):
+    """True for server errors and rate limit errors that should be retried with backoff."""
+    return http_error.resp.status in RETRY_STATUSES or is_rate_limited(http_error)
+
+
+class RateLimiter(object):
+    """Spread calls so no more than calls_per_second are made from this process."""
+
+    def __init__(self, calls_per_second):
+        self.interval = 1.0 / calls_per_second
+        self.next_time = perf_counter()
+        self._lock = threading.Lock()
+
+    def wait(self, calls=1):
+        with self._lock:
+            now = perf_counter()
+            start = max(now, self.next_time)
+            self.next_time = start + calls * self.interval
+        if start > now:
+            sleep(start - now)
+
+
+bulk_rate_limiter = RateLimiter(BULK_CALLS_PER_SECOND)
+
+
+class ConcurrencyLimit(object):
+    """
+    Additive increase, multiplicative decrease limit on requests in flight from this process.
+
+    Each successful request raises the limit by 1 / limit, about one for every limit requests. A rate limited or 5xx
+    response multiplies it by decrease, once for all the requests that were already in flight when it came back.
+    """
+
+    def __init__(self, initial=INITIAL_CONCURRENCY, minimum=MIN_CONCURRENCY, maximum=MAX_CONCURRENCY,
+                 decrease=CONCURRENCY_DECREASE):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.in_flight = 0
+        self.waiting = 0
+        self.decreases = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def request(self):
+        """Hold one of the allowed requests while the block sends it."""
+        with self._condition:
+            if self.in_flight >= int(self.limit):
+                self.waiting += 1
+                metrics.depth('drive.requests_waiting', self.waiting)
+                while self.in_flight >= int(self.limit):
+                    self._condition.wait()
+                self.waiting -= 1
+                metrics.depth('drive.requests_waiting', self.waiting)
+            self.in_flight += 1
+            decreases = self.decreases
+        try:
+            yield
+        except errors.HttpError as e:
+            if is_retryable(e):
+                self._adjust(decreases, False)
+            raise
+        else:
+            self._adjust(decreases, True)
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                self._condition.notify_all()
+
+    def _adjust(self, decreases, succeeded):
+        with self._condition:
+            if succeeded:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            elif decreases == self.decreases:
+                # Requests sent before the last decrease report the congestion it already answered
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self.decreases += 1
+                tracing.count('drive.concurrency_decreases')
+            tracing.gauge('drive.concurrency_limit', round(self.limit, 2))
+            self._condition.notify_all()
+
+
+concurrency = ConcurrencyLimit()
+
+
+class CircuitBreaker(object):
+    """
+    Fail requests to one API right away while most recent requests to it fail.
+
+    Server errors and network errors count as failures, any other response as a success. While open, check()
+    raises DriveUnavailable. After the cooldown one probe request is let through: success closes the breaker and
+    failure opens it again with double the cooldown.
+    name: API name used in messages and metrics
+    """
+
+    def __init__(self, name, window=BREAKER_WINDOW, failure_rate=BREAKER_FAILURE_RATE,
+                 min_requests=BREAKER_MIN_REQUESTS, cooldown=BREAKER_COOLDOWN, max_cooldown=BREAKER_MAX_COOLDOWN):
+        self.name = name
+        self.window = window
+        self.failure_rate = failure_rate
+        self.min_requests = min_requests
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = cooldown
+        self.results = []
+        self.opened = None
+        self.probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened is not None
+
+    def seconds_until_probe(self):
+        """Seconds until a request will be let through, 0 when one would be now."""
+        with self._lock:
+            if self.opened is None or self.probing:
+                return 0 if self.opened is None else self.cooldown
+            return max(0, self.opened + self.cooldown - perf_counter())
+
+    def check(self):
+        """Raise DriveUnavailable unless a request can be sent."""
+        with self._lock:
+            if self.opened is None:
+                return
+            if not self.probing and perf_counter() - self.opened >= self.cooldown:
+                self.probing = True
+                return
+        raise DriveUnavailable('{} circuit breaker is open after repeated failures'.format(self.name))
+
+    def record(self, succeeded):
+        with self._lock:
+            if self.opened is not None:
+                if not self.probing:
+                    # A request sent before the breaker opened
+                    return
+                self.probing = False
+                if succeeded:
+                    print('{} circuit breaker closed'.format(self.name))
+                    self.opened = None
+                    self.cooldown = self.base_cooldown
+                    self.results = []
+                else:
+                    self.opened = perf_counter()
+                    self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+            else:
+                self.results = (self.results + [succeeded])[-self.window:]
+                failures = self.results.count(False)
+                if len(self.results) >= self.min_requests and failures >= self.failure_rate * len(self.results):
+                    print('{} circuit breaker opened: {} of the last {} requests failed, pausing {}s'.format(
+                        self.name, failures, len(self.results), self.cooldown))
+                    self.opened = perf_counter()
+                    tracing.count('{}.breaker_opened'.format(self.name))
+            tracing.gauge('{}.breaker_open'.format(self.name), int(self.opened is not None))
+
+
+breakers = {'drive': CircuitBreaker('drive'), 'sheets': CircuitBreaker('sheets')}
+
+
+def get_breaker(bucket):
+    """Circuit breaker for the API that quota bucket belongs to."""
+    return breakers['sheets' if bucket == quota.SHEETS else 'drive']
+
+
+def method_id(request):
+    """API method of a request, such as drive.files.update, for metrics."""
+    return getattr(request, 'methodId', None) or 'unknown'
+
+
+def record_call(bucket, method, status):
+    """Count one Drive or Sheets request by method and status in metrics."""
+    metrics.inc('api_calls', api=get_breaker(bucket).name, method=method, status=str(status))
+
+
+def retry_sleep(backoff):
+    """Sleep before a retry, backoff seconds plus jitter, and count the time spent."""
+    seconds = backoff + uniform(.001, .999)
+    tracing.count('drive.retry_sleeps')
+    tracing.count('drive.retry_sleep_seconds', seconds)
+    sleep(seconds)
+
+
+@contextmanager
+def guarded(bucket, method='unknown', calls=1):
+    """
+    Fail fast while the breaker for bucket is open, take calls from the bucket's quota and record how the request
+    sent in the block went.
+
+    Quota is taken after the breaker check so requests that fail fast do not use up calls shared with other processes.
+    method: API method counted with the response status in metrics, see method_id
+    calls: quota calls the block makes, the request count of a batch
+    """
+    breaker = get_breaker(bucket)
+    try:
+        breaker.check()
+    except DriveUnavailable:
+        record_call(bucket, method, 'breaker_open')
+        raise
+    quota.take(bucket, calls)
+    try:
+        yield
+    except errors.HttpError as e:
+        breaker.record(e.resp.status < 500)
+        record_call(bucket, method, e.resp.status)
+        raise
+    except NETWORK_ERRORS:
+        breaker.record(False)
+        record_call(bucket, method, 'network_error')
+        raise
+    else:
+        breaker.record(True)
+        record_call(bucket, method, 'ok')
+
+
+class UploadWatchdog(object):
+    """
+    Abort uploads that stop making progress.
+
+    httplib2 waits on each socket operation for up to HTTP_TIMEOUT, which a connection that still trickles bytes
+    never reaches. A thread checks every watched upload and shuts down the sockets of any that went stall_seconds
+    without finishing a chunk, so its blocked next_chunk call fails and the upload can be queued again.
+    """
+
+    def __init__(self, stall_seconds=UPLOAD_STALL_SECONDS, interval=5):
+        self.stall_seconds = stall_seconds
+        self.interval = interval
+        self.uploads = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def watch(self, key, http):
+        """Start watching an upload sent on http, a httplib2.Http or None when its sockets can not be reached."""
+        with self._lock:
+            self.uploads[key] = {'http': http, 'progress': perf_counter(), 'stalled': False}
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def progress(self, key):
+        with self._lock:
+            self.uploads[key]['progress'] = perf_counter()
+
+    def stalled(self, key):
+        with self._lock:
+            return self.uploads[key]['stalled']
+
+    def done(self, key):
+        with self._lock:
+            self.uploads.pop(key, None)
+
+    def _run(self):
+        while True:
+            sleep(self.interval)
+            with self._lock:
+                stalled = [(key, upload) for key, upload in self.uploads.items()
+                           if not upload['stalled'] and perf_counter() - upload['progress'] > self.stall_seconds]
+                for key, upload in stalled:
+                    upload['stalled'] = True
+            for key, upload in stalled:
+                print('Upload {} made no progress for {}s, aborting it'.format(key[1], self.stall_seconds))
+                tracing.count('drive.uploads_stalled')
+                for connection in list(getattr(upload['http'], 'connections', {}).values()):
+                    if getattr(connection, 'sock', None) is not None:
+                        try:
+                            connection.sock.shutdown(socket.SHUT_RDWR)
+                        except OSError:
+                            pass
+
+
+upload_watchdog = UploadWatchdog()
+_thread_http = threading.local()
+
+
+def _get_thread_http(request):
+    """
+    Authorized Http for pool threads.
+
+    httplib2.Http objects are not thread safe, so map_calls threads send requests on their own Http with the
+    credentials of the request's service. Returns None on the main thread or for services without oauth2client http.
+    """
+    if not getattr(_thread_http, 'pooled', False):
+        return None
+    credentials = getattr(getattr(getattr(request, 'http', None), 'request', None), 'credentials', None)
+    if credentials is None:
+        return None
+    if not hasattr(_thread_http, 'https'):
+        _thread_http.https = {}
+    if id(credentials) not in _thread_http.https:
+        _thread_http.https[id(credentials)] = credentials.authorize(httplib2.Http(timeout=HTTP_TIMEOUT))
+
+    return _thread_http.https[id(credentials)]
+
+
+def execute(request, bucket=quota.READ, idempotent=True, method=None, calls=1):
+    """
+    Execute a Drive or Sheets request within the shared quota, the concurrency limit and the circuit breaker.
+
+    Rate limited responses, server errors and network errors are retried with backoff. Other errors are raised for
+    the caller to handle, and DriveUnavailable is raised while the breaker is open or when server or network errors
+    persist.
+
+    idempotent: False for requests such as creates and appends that may have been applied before a server or network
+        error. Only rate limited responses are retried for these and other failures raise DriveUnavailable at once
+    method: API method counted in metrics, method_id(request) by default
+    calls: quota calls the request makes, the request count of a batch
+    """
+    backoff = 1
+    for attempt in range(RATE_LIMIT_ATTEMPTS):
+        http = _get_thread_http(request)
+        try:
+            with guarded(bucket, method or method_id(request), calls), concurrency.request():
+                return request.execute(http=http) if http is not None else request.execute()
+        except errors.HttpError as e:
+            if not is_retryable(e):
+                raise
+            if not idempotent and not is_rate_limited(e):
+                raise DriveUnavailable('Request may not have been applied: {}'.format(e))
+            if attempt == RATE_LIMIT_ATTEMPTS - 1:
+                if is_rate_limited(e):
+                    raise
+                raise DriveUnavailable('Request failed {} times: {}'.format(RATE_LIMIT_ATTEMPTS, e))
+            tracing.count('drive.rate_limited' if is_rate_limited(e) else 'drive.server_errors')
+        except NETWORK_ERRORS as e:
+            if not idempotent:
+                raise DriveUnavailable('Request may not have been applied: {}'.format(e))
+            if attempt == RATE_LIMIT_ATTEMPTS - 1:
+                raise DriveUnavailable('Request failed {} times: {}'.format(RATE_LIMIT_ATTEMPTS, e))
+            tracing.count('drive.network_errors')
+        retry_sleep(backoff)
+        backoff += backoff
+
+
+def _pooled(function, item):
+    _thread_http.pooled = True
+    return function(item)
+
+
+def map_calls(function, items):
+    """
+    Run function on each item in threads so Drive requests overlap up to the concurrency limit.
+
+    function: callable making requests through execute, such as AgrcDriver.get_parents
+    returns: list of results in the order of items
+    """
+    items = list(items)
+    if len(items) < 2:
+        return [function(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENCY, len(items))) as pool:
+        return list(pool.map(lambda item: _pooled(function, item), items))
+
+
+class UploadGovernor(object):
+    """
+    Share upload bandwidth between every upload in this process.
+
+    bytes_per_second: cap on upload bytes per second, None for no cap
+    schedule: [(start hour, end hour, bytes per second)] caps by local time of day used instead of bytes_per_second.
+        A start hour after the end hour wraps past midnight and a rate of None lifts the cap
+    max_in_flight: bytes of uploads that can be in progress together. An upload larger than this runs on its own
+    """
+
+    def __init__(self, bytes_per_second=None, schedule=None, max_in_flight=None):
+        self.bytes_per_second = bytes_per_second
+        self.schedule = schedule or []
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.next_time = perf_counter()
+        self._condition = threading.Condition()
+
+    def rate(self, now=None):
+        """Bytes per second allowed at now, None for no cap."""
+        hour = (now or datetime.now()).hour
+        for start, end, bytes_per_second in self.schedule:
+            if start <= hour < end or (start > end and (hour >= start or hour < end)):
+                return bytes_per_second
+
+        return self.bytes_per_second
+
+    def chunk_size(self, default=DEFAULT_CHUNK_SIZE):
+        """Upload chunk size small enough for pacing to hold the cap, default when there is no cap now."""
+        rate = self.rate()
+        if rate is None:
+            return default
+        chunk = max(CHUNK_ALIGN, int(rate * PACED_CHUNK_SECONDS) // CHUNK_ALIGN * CHUNK_ALIGN)
+
+        return chunk if default < 0 else min(default, chunk)
+
+    def start(self, byte_count):
+        """Wait until byte_count more upload bytes fit under max_in_flight and count them as in flight."""
+        waited = perf_counter()
+        with self._condition:
+            while self.max_in_flight is not None and self.in_flight and \
+                    self.in_flight + byte_count > self.max_in_flight:
+                self._condition.wait()
+            self.in_flight += byte_count
+            metrics.depth('drive.upload_bytes_in_flight', self.in_flight)
+
+        return perf_counter() - waited
+
+    def finish(self, byte_count):
+        with self._condition:
+            self.in_flight -= byte_count
+            metrics.depth('drive.upload_bytes_in_flight', self.in_flight)
+            self._condition.notify_all()
+
+    def throttle(self, byte_count):
+        """Wait for the next opening to send byte_count bytes at the current cap and return the seconds waited."""
+        rate = self.rate()
+        with self._condition:
+            now = perf_counter()
+            if rate is None:
+                self.next_time = now
+                return 0
+            start = max(now, self.next_time)
+            self.next_time = start + float(byte_count) / rate
+        if start > now:
+            sleep(start - now)
+
+        return start - now
+
+
+upload_governor = UploadGovernor()
+
+
+class ChunkSizer(object):
+    """
+    Choose resumable upload chunk sizes from the throughput and round trip time of chunks already sent.
+
+    Each chunk costs a round trip, and a failed chunk is sent again in full, so chunks aim to take CHUNK_SECONDS or
+    CHUNK_ROUND_TRIPS round trips, whichever is longer, within MIN_CHUNK and MAX_CHUNK.
+    smoothing: weight of the newest chunk in the moving averages
+    """
+
+    def __init__(self, smoothing=0.3):
+        self.smoothing = smoothing
+        self.bytes_per_second = None
+        self.round_trip = None
+        self._lock = threading.Lock()
+
+    def size(self):
+        """Chunk size for the next chunk of any upload in bytes."""
+        with self._lock:
+            if self.bytes_per_second is None:
+                return INITIAL_CHUNK
+            seconds = max(CHUNK_SECONDS, (self.round_trip or 0) * CHUNK_ROUND_TRIPS)
+            chunk = int(self.bytes_per_second * seconds) // CHUNK_ALIGN * CHUNK_ALIGN
+
+        return min(MAX_CHUNK, max(MIN_CHUNK, chunk))
+
+    def observe(self, byte_count, seconds):
+        """
+        Add a sent chunk to the averages.
+
+        The round trip is the time a chunk takes beyond transferring its bytes at the average rate. Short final
+        chunks mostly measure the round trip and full chunks mostly the rate.
+        """
+        if seconds <= 0 or byte_count <= 0:
+            return
+        with self._lock:
+            rate = byte_count / seconds
+            if self.bytes_per_second is None:
+                self.bytes_per_second = rate
+            else:
+                round_trip = max(0.0, seconds - byte_count / self.bytes_per_second)
+                self.round_trip = round_trip if self.round_trip is None else \
+                    self.round_trip + self.smoothing * (round_trip - self.round_trip)
+                self.bytes_per_second += self.smoothing * (rate - self.bytes_per_second)
+
+    def failed(self):
+        """Halve the rate estimate after a failed chunk so retries resend less."""
+        with self._lock:
+            if self.bytes_per_second is not None:
+                self.bytes_per_second /= 2
+
+
+chunk_sizer = ChunkSizer()
+
+
+def get_chunk_size():
+    """Next upload chunk size from chunk_sizer, reduced by upload_governor while a cap is in effect."""
+    return upload_governor.chunk_size(chunk_sizer.size())
+
+
+class _ChunkSized(object):
+    """
+    Media upload sending chunks of chunk_size bytes.
+
+    googleapiclient reads chunksize() for every next_chunk call, so setting chunk_size between chunks changes the size
+    of the next one.
+    """
+
+    chunk_size = None
+
+    def chunksize(self):
+        return self.chunk_size or super(_ChunkSized, self).chunksize()
+
+
+class SizedFileUpload(_ChunkSized, MediaFileUpload):
+    """MediaFileUpload with a chunk size set between chunks, see _ChunkSized."""
+
+
+class SizedIoUpload(_ChunkSized, MediaIoBaseUpload):
+    """MediaIoBaseUpload with a chunk size set between chunks, see _ChunkSized."""
+
+
+def parse_upload_schedule(text):
+    """
+    Parse caps by time of day written as start-end:MB/s pairs separated by commas.
+
+    '7-18:2,18-7:' caps uploads at 2 MB/s from 7:00 to 18:00 and lifts the cap overnight
+    returns: schedule list for UploadGovernor
+    """
+    schedule = []
+    for period in text.split(','):
+        try:
+            hours, rate = period.split(':')
+            start, end = [int(hour) for hour in hours.split('-')]
+        except ValueError:
+            raise Exception('Upload schedule periods look like 7-18:2, not {}'.format(period))
+        schedule.append((start, end, float(rate) * MB if rate.strip() else None))
+
+    return schedule
 
 
 class APIS(object):
@@ -83,7 +683,7 @@ class ApiService(object):
 
     def setup_oauth_service(self, secrets, scopes, api_name, api_version):
         credentials = self.get_oauth_credentials(secrets, scopes)
-        http = credentials.authorize(httplib2.Http())
+        http = credentials.authorize(httplib2.Http(timeout=HTTP_TIMEOUT))
         service = discovery.build(api_name, api_version, http=http)
 
         return service
@@ -91,7 +691,7 @@ class ApiService(object):
     def setup_account_service(self, secrets, scopes, api_name, api_version):
         # get auth
         credentials = self.get_credentials(secrets, scopes)
-        http = credentials.authorize(httplib2.Http())
+        http = credentials.authorize(httplib2.Http(timeout=HTTP_TIMEOUT))
         service = discovery.build(api_name, api_version, http=http)
 
         return service
@@ -103,21 +703,25 @@ class AgrcDriver(object):
     def __init__(self, api_service):
         self.service = api_service
 
+    @tracing.traced('drive.set_property')
     def set_property(self, file_id, property_dict):
         if not self.service:
             self.service = self.setup_account_service()
-        file_name = self.service.files().update(fileId=file_id,
-                                                fields='name',
-                                                body={'properties': property_dict}).execute()
+        file_name = execute(self.service.files().update(fileId=file_id,
+                                                        fields='name',
+                                                        body={'properties': property_dict}), quota.WRITE)
         return file_name
 
+    @tracing.traced('drive.get_property')
     def get_property(self, file_id, property_name):
         if not self.service:
             self.service = self.setup_account_service()
-        file_property = self.service.files().get(fileId=file_id,
-                                                 fields='properties({})'.format(property_name)).execute()
+        file_property = execute(self.service.files().get(fileId=file_id,
+                                                         fields='properties({})'.format(property_name)))
         return file_property['properties'][property_name]
 
+    @tracing.traced('drive.download_file')
+    @profiling.memory_stage('download_file')
     def download_file(self, file_id, output):
         import shutil
         request = self.service.files().get_media(fileId=file_id)
@@ -128,21 +732,25 @@ class AgrcDriver(object):
         backoff = 1
         while response is False:
             try:
-                status, response = downloader.next_chunk()
+                with guarded(quota.READ, method_id(request)):
+                    status, response = downloader.next_chunk()
+            except NETWORK_ERRORS as e:
+                raise DriveUnavailable('Download Failed: {}'.format(e))
             except errors.HttpError as e:
                 if e.resp.status in [404]:
                     # Start the upload all over again.
                     raise Exception('Download Failed 404')
                 elif e.resp.status in [500, 502, 503, 504]:
                     if backoff > 8:
-                        raise Exception('Download Failed: {}'.format(e))
+                        raise DriveUnavailable('Download Failed: {}'.format(e))
                     print('Retrying download in: {} seconds'.format(backoff))
-                    sleep(backoff + uniform(.001, .999))
+                    retry_sleep(backoff)
                     backoff += backoff
                 else:
                     msg = "Download Failed \n{}".format(e)
                     raise Exception(msg)
 
+        tracing.count('drive.bytes_downloaded', fh.tell())
         fh.seek(0)
         with open(output, 'wb') as out_zip:
             shutil.copyfileobj(fh, out_zip, length=131072)
@@ -176,130 +784,158 @@ class AgrcDriver(object):
 
     #     return response.get('id')
 
+    def _run_upload(self, request, media_body, name):
+        """
+        Send a resumable upload paced by upload_governor, retrying server and network errors, and report throughput.
+
+        Raises UploadStalled when upload_watchdog aborts it and DriveUnavailable while the Drive breaker is open.
+        returns: the Drive response for the finished upload
+        """
+        byte_count = media_body.size()
+        watch_key = (threading.get_ident(), name)
+        with tracing.span('drive.upload', file=name, bytes=byte_count) as span:
+            waited = upload_governor.start(byte_count)
+            upload_watchdog.watch(watch_key, getattr(request, 'http', None))
+            start = perf_counter()
+            chunks = 0
+            largest_chunk = 0
+            try:
+                response = None
+                backoff = 1
+                while response is None:
+                    # Sized uploads read chunk_size for each next_chunk call so it can change between chunks
+                    media_body.chunk_size = get_chunk_size()
+                    sent = request.resumable_progress
+                    chunk = min(media_body.chunksize(), byte_count - sent)
+                    waited += upload_governor.throttle(chunk)
+                    try:
+                        with guarded(quota.WRITE, method_id(request)):
+                            # Timed after any quota wait so chunk sizes follow the measured transfer rate
+                            chunk_start = perf_counter()
+                            status, response = request.next_chunk()
+                    except NETWORK_ERRORS as e:
+                        if upload_watchdog.stalled(watch_key):
+                            raise UploadStalled('Upload of {} stalled'.format(name))
+                        if backoff > 8:
+                            raise DriveUnavailable('Upload Failed: {}'.format(e))
+                        chunk_sizer.failed()
+                        print('Retrying upload after {} in: {} seconds'.format(type(e).__name__, backoff))
+                        retry_sleep(backoff)
+                        backoff += backoff
+                        continue
+                    except errors.HttpError as e:
+                        if e.resp.status in [404]:  # TODO restart on 410 gone
+                            # Start the upload all over again or error.
+                            raise Exception('Upload Failed 404')
+                        elif e.resp.status in [500, 502, 503, 504]:
+                            if backoff > 8:
+                                raise DriveUnavailable('Upload Failed: {}'.format(e))
+                            chunk_sizer.failed()
+                            print('Retrying upload in: {} seconds'.format(backoff))
+                            retry_sleep(backoff)
+                            backoff += backoff
+                        else:
+                            raise Exception('Upload Failed\n{}'.format(e))
+                        continue
+                    upload_watchdog.progress(watch_key)
+                    chunks += 1
+                    largest_chunk = max(largest_chunk, chunk)
+                    done = byte_count if response is not None else request.resumable_progress
+                    chunk_sizer.observe(done - sent, perf_counter() - chunk_start)
+                    # Only bytes Drive acknowledged, failed and retried chunks are not counted
+                    tracing.count('drive.bytes_uploaded', done - sent)
+            finally:
+                upload_watchdog.done(watch_key)
+                upload_governor.finish(byte_count)
+            seconds = perf_counter() - start
+            span.args['waited_s'] = round(waited, 3)
+            span.args['mb_per_s'] = round(byte_count / MB / seconds, 3) if seconds else 0
+            span.args['chunks'] = chunks
+            span.args['chunk_mb'] = round(largest_chunk / MB, 2)
+        tracing.count('drive.upload_wait_seconds', waited)
+        tracing.count('drive.upload_chunks', chunks)
+        print('Uploaded {} {:.1f} MB at {:.2f} MB/s in {} chunks of up to {:.1f} MB{}'.format(
+            name, byte_count / MB, span.args['mb_per_s'], chunks, largest_chunk / MB,
+            ', waited {:.1f}s for bandwidth'.format(waited) if waited >= 0.1 else ''))
+
+        return response
+
+    @tracing.traced('drive.update_file')
     def update_file(self, file_id, local_file, mime_type):
-        media_body = MediaFileUpload(local_file,
+        media_body = SizedFileUpload(local_file,
                                      mimetype=mime_type,
+                                     chunksize=get_chunk_size(),
                                      resumable=True)
 
         request = self.service.files().update(fileId=file_id,
                                               media_body=media_body)
-
-        response = None
-        backoff = 1
-        while response is None:
-            try:
-                status, response = request.next_chunk()
-            except errors.HttpError as e:
-                if e.resp.status in [404]:  # TODO restart on 410 gone
-                    # Start the upload all over again.
-                    raise Exception('Upload Failed 404')
-                elif e.resp.status in [500, 502, 503, 504]:
-                    if backoff > 8:
-                        raise Exception('Upload Failed: {}'.format(e))
-                    print('Retrying upload in: {} seconds'.format(backoff))
-                    sleep(backoff + uniform(.001, .999))
-                    backoff += backoff
-                else:
-                    msg = "Upload Failed \n{}".format(e)
-                    raise Exception(msg)
+        response = self._run_upload(request, media_body, os.path.basename(local_file))
 
         return response.get('id')
 
 
+    @tracing.traced('drive.create_drive_file_from_io')
     def create_drive_file_from_io(self, name, parent_ids, io_bytes, mime_type, description=None, propertyDict=None):
         file_metadata = {'name': name,
                          'description': description,
                          'mimeType': mime_type,
                          'parents': parent_ids}
 
-        media_body = MediaIoBaseUpload(io_bytes,
-                                       chunksize=-1,
-                                       mimetype=mime_type,
-                                       resumable=True)
+        media_body = SizedIoUpload(io_bytes,
+                                   chunksize=get_chunk_size(),
+                                   mimetype=mime_type,
+                                   resumable=True)
         request = self.service.files().create(body=file_metadata,
                                               media_body=media_body,
                                               fields="id")
-
-        response = None
-        backoff = 1
-        while response is None:
-            try:
-                status, response = request.next_chunk()
-                # if status:
-                #     print('{} percent {}'.format(name, int(status.progress() * 100)))
-            except errors.HttpError as e:
-                if e.resp.status in [404]:
-                    # Start the upload all over again or error.
-                    raise Exception('Upload Failed 404')
-                elif e.resp.status in [500, 502, 503, 504]:
-                    if backoff > 8:
-                        raise Exception('Upload Failed: {}'.format(e))
-                    print('Retrying upload in: {} seconds'.format(backoff))
-                    sleep(backoff + uniform(.001, .999))
-                    backoff += backoff
-                else:
-                    msg = 'Upload Failed\n{}'.format(e)
-                    raise Exception(msg)
+        response = self._run_upload(request, media_body, name)
         if propertyDict:
             self.set_property(response.get('id'), propertyDict)
 
         return response.get('id')
 
+    @tracing.traced('drive.create_drive_file')
     def create_drive_file(self, name, parent_ids, local_file, mime_type, propertyDict=None):
         file_metadata = {'name': name,
                          'mimeType': mime_type,
                          'parents': parent_ids}
 
-        media_body = MediaFileUpload(local_file,
+        media_body = SizedFileUpload(local_file,
                                      mimetype=mime_type,
+                                     chunksize=get_chunk_size(),
                                      resumable=True)
         request = self.service.files().create(body=file_metadata,
                                               media_body=media_body,
                                               fields="id")
-
-        response = None
-        backoff = 1
-        while response is None:
-            try:
-                status, response = request.next_chunk()
-                # if status:
-                #     print('{} percent {}'.format(name, int(status.progress() * 100)))
-            except errors.HttpError as e:
-                if e.resp.status in [404]:
-                    # Start the upload all over again or error.
-                    raise Exception('Upload Failed 404')
-                elif e.resp.status in [500, 502, 503, 504]:
-                    if backoff > 8:
-                        raise Exception('Upload Failed: {}'.format(e))
-                    print('Retrying upload in: {} seconds'.format(backoff))
-                    sleep(backoff + uniform(.001, .999))
-                    backoff += backoff
-                else:
-                    raise Exception('Upload Failed')
+        response = self._run_upload(request, media_body, name)
         if propertyDict:
             self.set_property(response.get('id'), propertyDict)
 
         return response.get('id')
 
+    @tracing.traced('drive.get_file_id_by_name_and_directory')
     def get_file_id_by_name_and_directory(self, name, parent_id):
-        response = self.service.files().list(q="name='{}' and '{}' in parents  and explicitlyTrashed=false".format(name,
-                                                                                                              parent_id),
-                                             spaces='drive',
-                                             fields='files(id)').execute()
+        request = self.service.files().list(q="name='{}' and '{}' in parents  and explicitlyTrashed=false".format(name,
+                                                                                                             parent_id),
+                                            spaces='drive',
+                                            fields='files(id)')
+        response = execute(request)
         files = response.get('files', [])
         if len(files) > 0:
             return files[0].get('id')
         else:
             return None
 
+    @tracing.traced('drive.list_files_in_directory')
     def list_files_in_directory(self, parent_id):
         files = []
         page_token = None
         while True:
-            response = self.service.files().list(q="'{}' in parents  and explicitlyTrashed=false".format(parent_id),
-                                                 spaces='drive',
-                                                 fields='nextPageToken, files(id, name)',
-                                                 pageToken=page_token).execute()
+            request = self.service.files().list(q="'{}' in parents  and explicitlyTrashed=false".format(parent_id),
+                                                spaces='drive',
+                                                fields='nextPageToken, files(id, name)',
+                                                pageToken=page_token)
+            response = execute(request)
             for file in response.get('files', []):
                 # Process change
                 files.append((file.get('name'), file.get('id')))
@@ -310,11 +946,37 @@ class AgrcDriver(object):
 
         return files
 
+    @tracing.traced('drive.list_files')
+    def list_files(self, query="trashed=false", fields='id, name, parents', page_size=1000):
+        """
+        List every file matching query with as few paginated requests as possible.
+
+        fields: file fields to return such as 'id, size, md5Checksum, modifiedTime'
+        returns: list of file resource dicts
+        """
+        files = []
+        page_token = None
+        while True:
+            request = self.service.files().list(q=query,
+                                                spaces='drive',
+                                                pageSize=page_size,
+                                                fields='nextPageToken, files({})'.format(fields),
+                                                pageToken=page_token)
+            response = execute(request)
+            files.extend(response.get('files', []))
+            page_token = response.get('nextPageToken', None)
+            if page_token is None:
+                break
+
+        return files
+
+    @tracing.traced('drive.get_size')
     def get_size(self, file_id):
-        file_size = self.service.files().get(fileId=file_id,
-                                             fields='size').execute()
+        file_size = execute(self.service.files().get(fileId=file_id,
+                                                     fields='size'))
         return int(file_size.get('size'))
 
+    @tracing.traced('drive.create_drive_folder')
     def create_drive_folder(self, name, parent_ids):
         # existing_file_id = get_file_id_by_name_and_directory(name, parent_ids[0], service)
         # if existing_file_id:
@@ -326,114 +988,62 @@ class AgrcDriver(object):
                          'mimeType': 'application/vnd.google-apps.folder',
                          'parents': parent_ids}
 
-        response = self.service.files().create(body=file_metadata,
-                                               fields="id").execute()
-
-        return response.get('id')
-
+        backoff = 1
+        for attempt in range(RATE_LIMIT_ATTEMPTS):
+            try:
+                response = execute(self.service.files().create(body=file_metadata,
+                                                               fields="id"), quota.WRITE, idempotent=False)
+                return response.get('id')
+            except DriveUnavailable:
+                if attempt == RATE_LIMIT_ATTEMPTS - 1:
+                    raise
+            # The failed create may still have made the folder, so look for it before sending another
+            retry_sleep(backoff)
+            backoff += backoff
+            existing_id = self.get_file_id_by_name_and_directory(name, parent_ids[0])
+            if existing_id:
+                return existing_id
+
+    @tracing.traced('drive.get_parents')
     def get_parents(self, file_id):
         request = self.service.files().update(fileId=file_id,
                                               fields='id, parents')
 
-        response = None
-        backoff = 1
-        while response is None:
-            try:
-                response = request.execute()
-            except errors.HttpError as e:
-                if e.resp.status in [404]:
-                    # Start the upload all over again.
-                    raise Exception('Upload Failed 404')
-                elif e.resp.status in [500, 502, 503, 504]:
-                    if backoff > 8:
-                        raise Exception('Upload Failed: {}'.format(e))
-                    print('Retrying upload in: {} seconds'.format(backoff))
-                    sleep(backoff + uniform(.001, .999))
-                    backoff += backoff
-                else:
-                    msg = "Upload Failed \n{}".format(e)
-                    raise Exception(msg)
+        response = execute(request, quota.WRITE)
 
         return response.get('parents')
 
+    @tracing.traced('drive.change_file_parent')
     def change_file_parent(self, file_id, old_parent_id, new_parent_id):
         request = self.service.files().update(fileId=file_id,
                                               addParents=new_parent_id,
                                               removeParents=old_parent_id,
                                               fields='id')
 
-        response = None
-        backoff = 1
-        while response is None:
-            try:
-                response = request.execute()
-            except errors.HttpError as e:
-                if e.resp.status in [404]:
-                    # Start the upload all over again.
-                    raise Exception('Upload Failed 404')
-                elif e.resp.status in [500, 502, 503, 504]:
-                    if backoff > 8:
-                        raise Exception('Upload Failed: {}'.format(e))
-                    print('Retrying upload in: {} seconds'.format(backoff))
-                    sleep(backoff + uniform(.001, .999))
-                    backoff += backoff
-                else:
-                    msg = "Upload Failed \n{}".format(e)
-                    raise Exception(msg)
+        response = execute(request, quota.WRITE)
 
         return response.get('id')
 
+    @tracing.traced('drive.add_file_parent')
     def add_file_parent(self, file_id, new_parent_id):
         request = self.service.files().update(fileId=file_id,
                                               addParents=new_parent_id,
                                               fields='id')
-        response = None
-        backoff = 1
-        while response is None:
-            try:
-                response = request.execute()
-            except errors.HttpError as e:
-                if e.resp.status in [404]:
-                    # Start the upload all over again.
-                    raise Exception('Upload Failed 404')
-                elif e.resp.status in [500, 502, 503, 504]:
-                    if backoff > 8:
-                        raise Exception('Upload Failed: {}'.format(e))
-                    print('Retrying upload in: {} seconds'.format(backoff))
-                    sleep(backoff + uniform(.001, .999))
-                    backoff += backoff
-                else:
-                    msg = "Upload Failed \n{}".format(e)
-                    raise Exception(msg)
+        response = execute(request, quota.WRITE)
 
         return response.get('id')
 
+    @tracing.traced('drive.remove_file_parent')
     def remove_file_parent(self, file_id, parent_id):
         request = self.service.files().update(fileId=file_id,
                                               removeParents=parent_id,
                                               fields='id')
 
-        response = None
-        backoff = 1
-        while response is None:
-            try:
-                response = request.execute()
-            except errors.HttpError as e:
-                if e.resp.status in [404]:
-                    # Start the upload all over again.
-                    raise Exception('Upload Failed 404')
-                elif e.resp.status in [500, 502, 503, 504]:
-                    if backoff > 8:
-                        raise Exception('Upload Failed: {}'.format(e))
-                    print('Retrying upload in: {} seconds'.format(backoff))
-                    sleep(backoff + uniform(.001, .999))
-                    backoff += backoff
-                else:
-                    msg = "Upload Failed \n{}".format(e)
-                    raise Exception(msg)
+        response = execute(request, quota.WRITE)
 
         return response.get('id')
 
+    @tracing.traced('drive.create_owner')
     def create_owner(self, file_id, email):
         """Transfer ownership of a file."""
         domain_permission = {
@@ -449,8 +1059,9 @@ class AgrcDriver(object):
             fields="id"
         )
 
-        req.execute()
+        execute(req, quota.WRITE)
 
+    @tracing.traced('drive.add_editor')
     def add_editor(self, file_id, email):
         domain_permission = {
             'type': 'user',
@@ -465,11 +1076,116 @@ class AgrcDriver(object):
             fields="id"
         )
 
-        return req.execute()
+        return execute(req, quota.WRITE)
 
+    def execute_batch(self, keyed_requests, rate_limiter=None, bucket=quota.WRITE):
+        """
+        Execute requests in batch calls of BATCH_SIZE, retrying rate limited and server errors with backoff.
+
+        Each batch call goes through execute so failures of the whole batch are retried and count against the breaker
+        and the concurrency limit, requests that fail inside a batch are retried in the next batch.
+
+        keyed_requests: list of (key, request)
+        bucket: quota bucket each request in a batch is taken from
+        returns: ({key: response}, {key: HttpError})
+        """
+        rate_limiter = rate_limiter or bulk_rate_limiter
+        responses = {}
+        failures = {}
+        pending = list(keyed_requests)
+        backoff = 1
+        while pending:
+            retry = []
+            for start in range(0, len(pending), BATCH_SIZE):
+                chunk = dict((str(i), keyed) for i, keyed in enumerate(pending[start:start + BATCH_SIZE]))
+
+                def callback(request_id, response, exception, chunk=chunk):
+                    key, request = chunk[request_id]
+                    record_call(bucket, method_id(request), 'ok' if exception is None else
+                                getattr(getattr(exception, 'resp', None), 'status', type(exception).__name__))
+                    if exception is None:
+                        responses[key] = response
+                    elif isinstance(exception, errors.HttpError) and is_retryable(exception):
+                        retry.append((key, request))
+                        failures[key] = exception
+                    else:
+                        failures[key] = exception
+
+                batch = self.service.new_batch_http_request(callback=callback)
+                for request_id in chunk:
+                    batch.add(chunk[request_id][1], request_id=request_id)
+                rate_limiter.wait(len(chunk))
+                tracing.count('drive.batch.requests', len(chunk))
+                with tracing.span('drive.batch', requests=len(chunk)):
+                    execute(batch, bucket, method='batch', calls=len(chunk))
+            if retry and backoff <= 8:
+                print('Retrying {} batched requests in: {} seconds'.format(len(retry), backoff))
+                retry_sleep(backoff)
+                backoff += backoff
+                for key, _ in retry:
+                    del failures[key]
+                pending = retry
+            else:
+                pending = []
+
+        return responses, failures
+
+    def list_permissions(self, file_ids):
+        """Get {file_id: [permission]} for file_ids using batch calls."""
+        requests = [(file_id, self.service.permissions().list(fileId=file_id,
+                                                              fields='permissions(id,type,role,emailAddress)'))
+                    for file_id in set(file_ids)]
+        responses, failures = self.execute_batch(requests, bucket=quota.READ)
+        for file_id in failures:
+            print('Permission list failed: {} {}'.format(file_id, failures[file_id]))
+
+        return dict((file_id, responses[file_id].get('permissions', [])) for file_id in responses)
+
+    def grant_permissions(self, file_ids, email, role):
+        """
+        Give email at least role on every file in file_ids.
+
+        Current permissions are fetched in batches and only missing grants are sent. A role of owner transfers ownership.
+        returns: {'checked': int, 'granted': [file_id], 'failed': {file_id: error}}
+        """
+        file_ids = [file_id for file_id in set(file_ids) if file_id]
+        current = self.list_permissions(file_ids)
+        missing = []
+        for file_id in file_ids:
+            has_role = any(p.get('emailAddress', '').lower() == email.lower() and
+                           ROLE_RANKS.get(p.get('role'), 0) >= ROLE_RANKS[role]
+                           for p in current.get(file_id, []))
+            if not has_role:
+                missing.append(file_id)
+
+        permission = {
+            'type': 'user',
+            'role': role,
+            'emailAddress': email
+        }
+        requests = []
+        for file_id in missing:
+            if role == 'owner':
+                request = self.service.permissions().create(fileId=file_id,
+                                                            body=permission,
+                                                            transferOwnership=True,
+                                                            fields='id')
+            else:
+                request = self.service.permissions().create(fileId=file_id,
+                                                            body=permission,
+                                                            sendNotificationEmail=False,
+                                                            fields='id')
+            requests.append((file_id, request))
+        responses, failures = self.execute_batch(requests)
+        print('{} {}: {} files checked, {} granted, {} failed'.format(email, role, len(file_ids),
+                                                                      len(responses), len(failures)))
+
+        return {'checked': len(file_ids), 'granted': sorted(responses), 'failed': failures}
+
+    @tracing.traced('drive.delete_file')
     def delete_file(self, file_id):
         try:
-            self.service.files().delete(fileId=file_id).execute()
+            execute(self.service.files().delete(fileId=file_id), quota.WRITE)
             return True
         except errors.HttpError as e:
             if e.resp.status in [404]:
@@ -494,6 +1210,7 @@ class AgrcSheets(object):
     def __init__(self, api_service):
         self.service = api_service
 
+    @tracing.traced('sheets.append_row')
     def append_row(self, spreadsheet_id, sheet_name, row_values, inputOption='USER_ENTERED'):
         # The ID of the spreadsheet to update.
         spreadsheet_id = spreadsheet_id
@@ -518,8 +1235,9 @@ class AgrcSheets(object):
                                                               insertDataOption=insert_data_option,
                                                               fields='spreadsheetId,updates(updatedRange)',
                                                               body=value_range_body)
-        response = request.execute()
+        response = execute(request, quota.SHEETS, idempotent=False)
 
+    @tracing.traced('sheets.get_range')
     def get_range(self, spreadsheet_id, sheet_name, a1_range):
         # The ID of the spreadsheet to update.
         spreadsheet_id = spreadsheet_id
@@ -530,8 +1248,9 @@ class AgrcSheets(object):
         request = self.service.spreadsheets().values().get(spreadsheetId=spreadsheet_id,
                                                            range=range_,
                                                            majorDimension='ROWS')
-        return request.execute()['values']
+        return execute(request, quota.SHEETS)['values']
 
+    @tracing.traced('sheets.get_column')
     def get_column(self, spreadsheet_id, sheet_name, column_letter):
         # The ID of the spreadsheet to update.
         spreadsheet_id = spreadsheet_id
@@ -542,8 +1261,9 @@ class AgrcSheets(object):
         request = self.service.spreadsheets().values().get(spreadsheetId=spreadsheet_id,
                                                            range=range_,
                                                            majorDimension='COLUMNS')
-        return request.execute()['values'][0]
+        return execute(request, quota.SHEETS)['values'][0]
 
+    @tracing.traced('sheets.replace_column')
     def replace_column(self, spreadsheet_id, sheet_name, column_letter, values):
         # The ID of the spreadsheet to update.
         spreadsheet_id = spreadsheet_id
@@ -564,7 +1284,7 @@ class AgrcSheets(object):
                                                               range=range_,
                                                               valueInputOption=value_input_option,
                                                               body=value_range_body)
-        response = request.execute()
+        response = execute(request, quota.SHEETS)
         print(response)
 
 
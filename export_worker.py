@@ -0,0 +1,184 @@
+"""
+Copy features out of the workspace and zip them, in this process or in a pool of worker processes.
+
+arcpy geoprocessing holds the interpreter while it runs so threads do not overlap exports. Worker processes each
+import arcpy once and are replaced after a number of jobs to contain arcpy memory growth.
+"""
+import multiprocessing
+import ntpath
+import os
+import traceback
+import zipfile
+from time import perf_counter
+
+import profiling
+import tracing
+
+
+@profiling.memory_stage('zip_folder')
+def zip_folder(folder_path, zip_name):
+    """Zip a folder with compression to reduce storage size."""
+    with tracing.span('zip_folder', zip=ntpath.basename(zip_name)) as span:
+        zf = zipfile.ZipFile(zip_name, "w", zipfile.ZIP_DEFLATED)
+        for root, _, files in os.walk(folder_path):
+            for filename in files:
+                if not filename.endswith('.lock'):
+                    zf.write(os.path.join(root, filename),
+                             os.path.relpath(os.path.join(root, filename), os.path.join(folder_path, '..')))
+        original_size = 0
+        compress_size = 0
+        for info in zf.infolist():
+            original_size += info.file_size
+            compress_size += info.compress_size
+        zf.close()
+        span.args['bytes_in'] = original_size
+        span.args['bytes_out'] = compress_size
+    tracing.count('bytes_zipped', original_size)
+    tracing.count('bytes_compressed', compress_size)
+
+
+def unzip(zip_path, output_path):
+    """Unzip a folder that was zipped by zip_folder."""
+    with zipfile.ZipFile(zip_path, 'r', zipfile.ZIP_DEFLATED) as zipped:
+        zipped.extractall(output_path)
+
+
+def _get_copier(is_table):
+    import arcpy
+    if is_table:
+        return arcpy.CopyRows_management
+    else:
+        return arcpy.CopyFeatures_management
+
+
+@profiling.memory_stage('create_outputs')
+def create_outputs(output_directory, input_feature, output_name):
+    """Create output file GDB and directory with shapefile."""
+    import arcpy
+    # Create output GDB and feature class
+    is_table = arcpy.Describe(input_feature).datasetType.lower() == 'table'
+    copier = _get_copier(is_table)
+
+    with tracing.span('create_outputs.gdb', feature=output_name) as span:
+        output_gdb = arcpy.CreateFileGDB_management(output_directory, output_name)[0]
+        output_fc = copier(input_feature, os.path.join(output_gdb, output_name))[0]
+        rows = int(arcpy.GetCount_management(output_fc)[0])
+        span.args['rows'] = rows
+    tracing.count('rows_exported', rows)
+    # Create directory to contain shape file
+    with tracing.span('create_outputs.shp', feature=output_name):
+        shape_directory = os.path.join(output_directory, output_name)
+        if not os.path.exists(shape_directory):
+            os.makedirs(shape_directory)
+        copier(output_fc, os.path.join(shape_directory, output_name))
+
+    return (output_gdb, shape_directory)
+
+
+def export_feature(workspace, feature_name, output_name, feature_directory, gdb_zip, shape_zip):
+    """
+    Copy feature_name to a file GDB and shapefile in feature_directory and zip both.
+
+    returns: (gdb directory, shapefile directory)
+    """
+    print('Copying...')
+    fc_directory, shape_directory = create_outputs(feature_directory,
+                                                   os.path.join(workspace, feature_name),
+                                                   output_name)
+    print('Zipping...')
+    zip_folder(fc_directory, gdb_zip)
+    zip_folder(shape_directory, shape_zip)
+
+    return fc_directory, shape_directory
+
+
+def _init_worker(setup=None):
+    """
+    Prepare a worker process once before its first job.
+
+    setup: picklable function run before arcpy is imported, such as benchmarks.fake_arcpy.install
+    """
+    if setup is not None:
+        setup()
+    import arcpy
+
+
+def _run_job(job):
+    """Run export_feature for one job dict in a worker and return its outputs, timings and any error."""
+    tracing.tracer = tracing.Tracer()
+    profiling.configure(**job.pop('profiling'))
+    start = perf_counter()
+    result = {'feature_name': job['feature_name'], 'pid': os.getpid(), 'error': None}
+    try:
+        with profiling.feature(job['feature_name'], '.export'):
+            result['fc_directory'], result['shape_directory'] = export_feature(**job)
+    except Exception:
+        result['error'] = traceback.format_exc()
+    result['seconds'] = perf_counter() - start
+    result['trace'] = (tracing.tracer.origin, tracing.tracer.spans, tracing.tracer.counters,
+                       sorted(tracing.tracer.gauges))
+
+    return result
+
+
+class ExportPool(object):
+    """
+    Worker processes running export_feature jobs keyed by feature name.
+
+    processes: number of worker processes
+    jobs_per_worker: jobs a worker runs before it is replaced, None to keep workers for the whole run
+    timeout: seconds to wait for one result before it is reported as an error
+    setup: function each worker runs before importing arcpy
+    """
+
+    def __init__(self, processes, jobs_per_worker=None, timeout=None, setup=None):
+        self.processes = processes
+        self.timeout = timeout
+        self.pending = {}
+        #: Feature names whose exports timed out, their workers may still be writing until close terminates them
+        self.timed_out = []
+        self._pool = multiprocessing.Pool(processes,
+                                          initializer=_init_worker,
+                                          initargs=(setup,),
+                                          maxtasksperchild=jobs_per_worker)
+
+    def __contains__(self, feature_name):
+        return feature_name in self.pending
+
+    def __len__(self):
+        return len(self.pending)
+
+    def submit(self, **job):
+        """Queue export_feature(**job) and return right away, the worker profiles it like this process would."""
+        job['profiling'] = profiling.settings()
+        self.pending[job['feature_name']] = self._pool.apply_async(_run_job, (job,))
+
+    def result(self, feature_name):
+        """
+        Wait for the export of feature_name and add its spans and counters to the run trace.
+
+        returns: {'fc_directory', 'shape_directory', 'seconds', 'pid', 'error'} with error None on success,
+            'timed_out' is True when the export is still running
+        """
+        async_result = self.pending.pop(feature_name)
+        try:
+            result = async_result.get(self.timeout)
+        except multiprocessing.TimeoutError:
+            self.timed_out.append(feature_name)
+            return {'feature_name': feature_name,
+                    'error': 'Export timed out after {}s'.format(self.timeout),
+                    'timed_out': True}
+        except Exception:
+            return {'feature_name': feature_name, 'error': traceback.format_exc()}
+        tracing.tracer.merge(*result.pop('trace'))
+
+        return result
+
+    def close(self):
+        """Stop the workers. Exports that were never collected or timed out are abandoned."""
+        if self.pending or self.timed_out:
+            self._pool.terminate()
+        else:
+            self._pool.close()
+        self._pool.join()
+        self.pending.clear()
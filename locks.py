@@ -0,0 +1,131 @@
+"""Exclusive file locks shared by threads and processes on one machine"""
+import os
+import threading
+from time import perf_counter, sleep
+
+if os.name == 'nt':
+    import msvcrt
+
+    def _try_lock(lock_file):
+        lock_file.seek(0)
+        try:
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+        return True
+
+    def _unlock(lock_file):
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def _try_lock(lock_file):
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        return True
+
+    def _unlock(lock_file):
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+#: Seconds between attempts to take a lock held by another process
+POLL_SECONDS = 0.05
+#: Seconds replace() retries while readers have the destination open
+REPLACE_TIMEOUT = 10
+_held = {}
+_held_guard = threading.Lock()
+
+
+class _Held(object):
+    """Thread lock and open lock file for one path in this process."""
+
+    def __init__(self):
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+        self.lock_file = None
+
+
+class FileLock(object):
+    """
+    Lock on path held by one thread of one process at a time.
+
+    The same thread can take the lock again while it holds it. The lock file is left in place so waiting
+    processes always lock the same file.
+    path: lock file, its folder is created when missing
+    timeout: seconds to wait before raising, None waits for as long as it takes
+    """
+
+    def __init__(self, path, timeout=None):
+        self.path = os.path.abspath(path)
+        self.timeout = timeout
+        with _held_guard:
+            self._held = _held.setdefault(os.path.normcase(self.path), _Held())
+
+    def acquire(self):
+        start = perf_counter()
+        if not self._held.thread_lock.acquire(timeout=-1 if self.timeout is None else self.timeout):
+            raise Exception('Timed out waiting for lock {}'.format(self.path))
+        if self._held.depth:
+            self._held.depth += 1
+            return self
+        try:
+            if not os.path.exists(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            lock_file = open(self.path, 'a+b')
+            while not _try_lock(lock_file):
+                if self.timeout is not None and perf_counter() - start > self.timeout:
+                    lock_file.close()
+                    raise Exception('Timed out waiting for lock {}'.format(self.path))
+                sleep(POLL_SECONDS)
+        except BaseException:
+            self._held.thread_lock.release()
+            raise
+        self._held.lock_file = lock_file
+        self._held.depth = 1
+
+        return self
+
+    def release(self):
+        self._held.depth -= 1
+        if not self._held.depth:
+            _unlock(self._held.lock_file)
+            self._held.lock_file.close()
+            self._held.lock_file = None
+        self._held.thread_lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+
+def replace(temp_path, path, timeout=None):
+    """
+    Replace path with temp_path, retrying while another process has path open.
+
+    On Windows os.replace raises PermissionError while a reader has the destination open, readers finish quickly so
+    the replace is retried for up to timeout seconds, REPLACE_TIMEOUT by default. The temp file is removed when it
+    still fails.
+    """
+    deadline = perf_counter() + (REPLACE_TIMEOUT if timeout is None else timeout)
+    while True:
+        try:
+            os.replace(temp_path, path)
+            return
+        except PermissionError:
+            if perf_counter() > deadline:
+                os.remove(temp_path)
+                raise
+            sleep(POLL_SECONDS)
+
+
+def atomic_write(path, text):
+    """Write text to a temp file next to path and replace path with it so readers never see a partial file."""
+    temp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    with open(temp_path, 'w') as f_out:
+        f_out.write(text)
+    replace(temp_path, path)
@@ -0,0 +1,240 @@
+"""
+Row hash manifests: one xxh64 per row keyed by a stable primary key.
+
+A manifest is columnar so it stays small and reads fast:
+    MAGIC
+    uint32 header length, header json (version, algorithm, key_field, key_type, rows, ...)
+    keys: int64 per row, or uint64 offsets (rows + 1) followed by utf-8 bytes for str keys
+    hashes: uint64 per row
+All numbers are little endian. Rows are sorted by key so two manifests are compared with one merge join.
+"""
+import json
+import os
+import struct
+import sys
+import zipfile
+from array import array
+from datetime import datetime
+
+import numpy as np
+
+import locks
+
+MAGIC = b'SGIDHASH'
+#: 2 hashes rows with rowhash
+VERSION = 2
+ALGORITHM = 'xxh64'
+#: Key for features without a primary_key in their spec. SGID reloads reassign object ids so manifests keyed by them
+#: are published but never compared
+DEFAULT_KEY_FIELD = 'OBJECTID'
+#: Last published manifest for each feature
+MANIFEST_FOLDER = 'manifests'
+#: Where rows were read: the workspace, or the file GDB copy made by the export. Manifests without one read the
+#: workspace. Copies can store values differently so only manifests read from the same source are compared
+SOURCE_WORKSPACE = 'workspace'
+SOURCE_EXPORT = 'export'
+
+
+def normalize_key(key):
+    """Integer keys stay ints, anything else is compared as a string."""
+    if isinstance(key, int) and not isinstance(key, bool):
+        return key
+
+    return str(key)
+
+
+class Manifest(object):
+    """Sorted keys and row hashes for one feature plus the header they were written with."""
+
+    def __init__(self, keys, hashes, header):
+        self.keys = keys
+        self.hashes = hashes
+        self.header = header
+
+    def __len__(self):
+        return len(self.keys)
+
+    def to_dict(self):
+        return dict(zip(self.keys, self.hashes))
+
+
+def from_blocks(blocks, key_field, **header):
+    """
+    Manifest from rowhash.Block objects.
+
+    Integer and text keys stay in numpy arrays and are ordered with one lexsort, other keys go through from_pairs.
+    header: extra values stored in the header such as sgid_name
+    """
+    keys = []
+    hashes = []
+    for block in blocks:
+        keys.append(np.asarray(block.keys))
+        hashes.append(np.asarray(block.hashes, dtype=np.uint64))
+    if not keys:
+        return _from_arrays(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint64), key_field, header)
+    if all(block_keys.dtype.kind in 'iu' for block_keys in keys):
+        keys = np.concatenate([block_keys.astype(np.int64, copy=False) for block_keys in keys])
+    elif all(block_keys.dtype.kind == 'U' for block_keys in keys):
+        keys = np.concatenate(keys)
+    else:
+        return from_pairs(zip(np.concatenate(keys).tolist(), np.concatenate(hashes).tolist()), key_field, **header)
+
+    return _from_arrays(keys, np.concatenate(hashes), key_field, header)
+
+
+def from_pairs(pairs, key_field, **header):
+    """Manifest from (key, hash) pairs in any order. Rows sharing a key are kept and counted in duplicate_keys."""
+    pairs = [(normalize_key(key), row_hash) for key, row_hash in pairs]
+    if all(isinstance(key, int) for key, _ in pairs):
+        keys = np.array([key for key, _ in pairs], dtype=np.int64)
+    else:
+        keys = np.array([str(key) for key, _ in pairs], dtype=str)
+
+    return _from_arrays(keys, np.array([row_hash for _, row_hash in pairs], dtype=np.uint64), key_field, header)
+
+
+def _from_arrays(keys, hashes, key_field, header):
+    """Manifest from int64 or text key and uint64 hash arrays, rows ordered by key then hash."""
+    order = np.lexsort((hashes, keys))
+    keys = keys[order]
+    hashes = hashes[order]
+    header.update({'version': VERSION,
+                   'algorithm': ALGORITHM,
+                   'key_field': key_field,
+                   'key_type': 'int' if keys.dtype.kind == 'i' else 'str',
+                   'rows': len(keys),
+                   'duplicate_keys': int(np.count_nonzero(keys[1:] == keys[:-1])),
+                   'created': header.get('created', datetime.now().isoformat())})
+
+    return Manifest(keys.tolist(), hashes.tolist(), header)
+
+
+def _little_endian(values):
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+def write(manifest, path):
+    header = json.dumps(manifest.header, sort_keys=True).encode('utf-8')
+    with open(path, 'wb') as f_out:
+        f_out.write(MAGIC)
+        f_out.write(struct.pack('<I', len(header)))
+        f_out.write(header)
+        if manifest.header['key_type'] == 'int':
+            _little_endian(array('q', manifest.keys)).tofile(f_out)
+        else:
+            encoded = [key.encode('utf-8') for key in manifest.keys]
+            offsets = array('Q', [0])
+            for key in encoded:
+                offsets.append(offsets[-1] + len(key))
+            _little_endian(offsets).tofile(f_out)
+            f_out.write(b''.join(encoded))
+        _little_endian(array('Q', manifest.hashes)).tofile(f_out)
+
+    return path
+
+
+def _read_array(f_in, typecode, count):
+    values = array(typecode)
+    values.fromfile(f_in, count)
+    return _little_endian(values)
+
+
+def read(path):
+    with open(path, 'rb') as f_in:
+        if f_in.read(len(MAGIC)) != MAGIC:
+            raise Exception('Not a row hash manifest: {}'.format(path))
+        header_length, = struct.unpack('<I', f_in.read(4))
+        header = json.loads(f_in.read(header_length).decode('utf-8'))
+        if header['version'] > VERSION or header['algorithm'] != ALGORITHM:
+            raise Exception('Unsupported manifest {} {}: {}'.format(header['algorithm'], header['version'], path))
+        rows = header['rows']
+        if header['key_type'] == 'int':
+            keys = _read_array(f_in, 'q', rows).tolist()
+        else:
+            offsets = _read_array(f_in, 'Q', rows + 1)
+            blob = f_in.read(offsets[-1])
+            keys = [blob[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(rows)]
+        hashes = _read_array(f_in, 'Q', rows).tolist()
+
+    return Manifest(keys, hashes, header)
+
+
+def comparable(old, new):
+    """Both manifests are keyed by the same stable, unique key."""
+    return old is not None and \
+        old.header['version'] == new.header['version'] and \
+        old.header['key_field'] == new.header['key_field'] != DEFAULT_KEY_FIELD and \
+        old.header['key_type'] == new.header['key_type'] and \
+        old.header.get('source', SOURCE_WORKSPACE) == new.header.get('source', SOURCE_WORKSPACE) and \
+        not old.header.get('duplicate_keys') and not new.header.get('duplicate_keys')
+
+
+def diff(old, new):
+    """
+    Count rows added, changed, deleted and unchanged from old to new with a merge join over the sorted keys.
+
+    returns: dict of counts or None when old is missing, keyed differently or either is not keyed uniquely
+    """
+    if not comparable(old, new):
+        return None
+    counts = {'added': 0, 'changed': 0, 'deleted': 0, 'unchanged': 0}
+    i = j = 0
+    old_keys, new_keys = old.keys, new.keys
+    while i < len(old_keys) and j < len(new_keys):
+        if old_keys[i] == new_keys[j]:
+            counts['unchanged' if old.hashes[i] == new.hashes[j] else 'changed'] += 1
+            i += 1
+            j += 1
+        elif old_keys[i] < new_keys[j]:
+            counts['deleted'] += 1
+            i += 1
+        else:
+            counts['added'] += 1
+            j += 1
+    counts['deleted'] += len(old_keys) - i
+    counts['added'] += len(new_keys) - j
+
+    return counts
+
+
+def cache_path(sgid_name, folder=None):
+    return os.path.join(folder or MANIFEST_FOLDER, sgid_name + '.manifest')
+
+
+def load_cached(sgid_name, folder=None):
+    """Last published manifest for sgid_name or None."""
+    path = cache_path(sgid_name, folder)
+    if not os.path.exists(path):
+        return None
+
+    return read(path)
+
+
+def save_cached(sgid_name, manifest_path, folder=None):
+    """Keep a published manifest as the one the next run compares against."""
+    path = cache_path(sgid_name, folder)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(manifest_path, 'rb') as f_in, open(path + '.tmp', 'wb') as f_out:
+        f_out.write(f_in.read())
+    locks.replace(path + '.tmp', path)
+
+
+def zip_manifest(manifest_path, zip_name):
+    with zipfile.ZipFile(zip_name, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.write(manifest_path, os.path.basename(manifest_path))
+
+
+def extract_zip(zip_name, output_directory):
+    """Extract the manifest in a _hash.zip and return its path. Raises for hash zips in any other format."""
+    with zipfile.ZipFile(zip_name, 'r') as zf:
+        names = [name for name in zf.namelist() if name.endswith('.manifest')]
+        if not names:
+            raise Exception('No manifest in {}'.format(zip_name))
+        return zf.extract(names[0], output_directory)
+
+
+def read_zip(zip_name, output_directory):
+    return read(extract_zip(zip_name, output_directory))
@@ -0,0 +1,139 @@
+"""
+Run health metrics in the Prometheus text format.
+
+Labeled counters recorded here, such as Drive calls by method and status, are written together with the tracing
+counters and gauges and a histogram of tracing span durations by stage, so the node_exporter textfile collector can
+pick up a file written at the end of each run.
+"""
+import os
+import re
+import threading
+
+import locks
+import tracing
+
+PREFIX = 'zip_loader'
+#: Help text for labeled metrics, tracing counters are described by their name
+HELP = {'api_calls': 'Drive and Sheets requests by api, method and status',
+        'features': 'Features handled by outcome: published, zipped, deferred, skipped or failed',
+        'stage_seconds': 'Duration of traced stages such as exports, zips and uploads'}
+
+
+def metric_name(name):
+    """Prometheus name for a dotted tracing name such as drive.bytes_uploaded."""
+    return '{}_{}'.format(PREFIX, re.sub('[^a-zA-Z0-9_]', '_', name))
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = ('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for key, value in labels)
+
+    return '{' + ','.join(escaped) + '}'
+
+
+def _key(name, labels):
+    """Registry key for a series, label values are kept as strings so series with int and str values sort."""
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry(object):
+    """Labeled counters and gauges for series tracing can not name on its own."""
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    def depth(self, name, value, **labels):
+        """Set a queue depth gauge and raise its <name>_peak gauge, a file written after a run shows the peak."""
+        key = _key(name, labels)
+        peak_key = (name + '_peak', key[1])
+        with self._lock:
+            self.gauges[key] = value
+            self.gauges[peak_key] = max(value, self.gauges.get(peak_key, value))
+
+    def render(self, tracer=None):
+        """Text format exposition of this registry and the counters, gauges and spans of tracer."""
+        tracer = tracer or tracing.tracer
+        families = {}
+        with self._lock:
+            for (name, labels), value in self.counters.items():
+                families.setdefault((name, 'counter'), []).append((labels, value))
+            for (name, labels), value in self.gauges.items():
+                families.setdefault((name, 'gauge'), []).append((labels, value))
+        with tracer._lock:
+            counters = dict(tracer.counters)
+            gauges = set(tracer.gauges)
+            stages = dict((name, (calls, seconds, list(buckets)))
+                          for name, (calls, seconds, buckets) in tracer.stages.items())
+        for name, value in counters.items():
+            families[(name, 'gauge' if name in gauges else 'counter')] = [((), value)]
+
+        lines = []
+        for name, kind in sorted(families):
+            full_name = metric_name(name) + ('_total' if kind == 'counter' else '')
+            lines.append('# HELP {} {}'.format(full_name, HELP.get(name, name)))
+            lines.append('# TYPE {} {}'.format(full_name, kind))
+            for labels, value in sorted(families[(name, kind)]):
+                lines.append('{}{} {}'.format(full_name, _labels(labels), _value(value)))
+        if stages:
+            full_name = metric_name('stage_seconds')
+            lines.append('# HELP {} {}'.format(full_name, HELP['stage_seconds']))
+            lines.append('# TYPE {} histogram'.format(full_name))
+            for stage in sorted(stages):
+                calls, seconds, buckets = stages[stage]
+                for bound, count in zip(tracing.STAGE_BUCKETS, buckets):
+                    lines.append('{}_bucket{} {}'.format(full_name, _labels((('stage', stage), ('le', bound))), count))
+                lines.append('{}_bucket{} {}'.format(full_name, _labels((('stage', stage), ('le', '+Inf'))), calls))
+                lines.append('{}_sum{} {}'.format(full_name, _labels((('stage', stage),)), repr(float(seconds))))
+                lines.append('{}_count{} {}'.format(full_name, _labels((('stage', stage),)), calls))
+
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path, tracer=None):
+        """Replace path with the current metrics so a collector never reads a partly written file."""
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'w') as f_out:
+            f_out.write(self.render(tracer))
+        locks.replace(temp_path, path)
+
+
+registry = Registry()
+
+
+def inc(name, value=1, **labels):
+    """Add value to a labeled counter on the module registry."""
+    registry.inc(name, value, **labels)
+
+
+def set_gauge(name, value, **labels):
+    """Set a labeled gauge on the module registry."""
+    registry.set(name, value, **labels)
+
+
+def depth(name, value, **labels):
+    """Set a queue depth and its peak on the module registry."""
+    registry.depth(name, value, **labels)
+
+
+def write_textfile(path):
+    """Write the module registry and tracer to path, use a .prom path in the node_exporter textfile directory."""
+    registry.write_textfile(path)
@@ -0,0 +1,241 @@
+"""
+Work out what a zip_loader run would do without exporting anything.
+
+Specs say which zips a feature uploads, a storage_report snapshot says which folders and parents already exist on
+Drive and how big the last zips were, and the API calls are counted the way zip_loader and driver make them.
+"""
+import math
+import os
+from datetime import datetime
+
+import delta
+import manifest
+import quota
+import storage_report
+
+FOLDER_MIME = storage_report.FOLDER_MIME
+ADD = 'add'
+REMOVE = 'remove'
+#: Older snapshots searched for the size of files missing from the latest one
+HISTORY_SNAPSHOTS = 3
+#: Spec id key and zip suffix of the zips a full export uploads
+FULL_ZIPS = (('gdb_id', '_gdb.zip'), ('shape_id', '_shp.zip'), ('hash_id', '_hash.zip'))
+
+
+class DriveIndex(object):
+    """Files in a snapshot by id, parent and folder name, with sizes from older snapshots as a fallback."""
+
+    def __init__(self, snapshot, history=()):
+        self.taken = snapshot['taken'] if snapshot else None
+        self.files = snapshot['files'] if snapshot else {}
+        self.history = list(history)
+        self.children = {}
+        self.folders = {}
+        for f in self.files.values():
+            for parent_id in f.get('parents', []):
+                self.children.setdefault(parent_id, []).append(f)
+                if f.get('mimeType') == FOLDER_MIME:
+                    self.folders[(parent_id, f['name'])] = f['id']
+
+    def folder(self, name, parent_id):
+        """Id of the folder name in parent_id, None when it would be created."""
+        return self.folders.get((parent_id, name))
+
+    def parents(self, file_id):
+        return self.files[file_id].get('parents', []) if file_id in self.files else []
+
+    def size(self, file_id):
+        """Size of file_id in the latest snapshot that has it, None when no snapshot does."""
+        if not file_id:
+            return None
+        for snapshot in [{'files': self.files}] + self.history:
+            if file_id in snapshot['files']:
+                return int(snapshot['files'][file_id].get('size', 0))
+
+        return None
+
+    def modified(self, file_id):
+        if file_id not in self.files or not self.files[file_id].get('modifiedTime'):
+            return None
+
+        return datetime.strptime(self.files[file_id]['modifiedTime'][:10], '%Y-%m-%d').date()
+
+
+def load_drive_index(snapshot_path=None):
+    """DriveIndex of snapshot_path or the latest saved snapshot, with earlier snapshots for missing sizes."""
+    paths = [snapshot_path] if snapshot_path else storage_report.list_snapshots()[-HISTORY_SNAPSHOTS - 1:][::-1]
+    snapshots = [storage_report.load_snapshot(p) for p in paths]
+
+    return DriveIndex(snapshots[0] if snapshots else None, snapshots[1:])
+
+
+class _Plan(object):
+
+    def __init__(self, drive_index, chunk_bytes):
+        self.drive = drive_index
+        self.chunk_bytes = chunk_bytes
+        self.folders = []
+        self.parent_changes = []
+        self.calls = {quota.READ: 0, quota.WRITE: 0, quota.SHEETS: 0}
+        self.created_files = 0
+        self._created = {}
+
+    def folder(self, name, parent_id, path):
+        """Count the lookup for folder name and plan it when it is missing. returns: its id or a placeholder"""
+        self.calls[quota.READ] += 1
+        if parent_id in self._created.values() or self.drive.folder(name, parent_id) is None:
+            if path not in self._created:
+                self._created[path] = 'new:' + path
+                self.folders.append(path)
+                self.calls[quota.WRITE] += 1
+                self.created_files += 1
+            return self._created[path]
+
+        return self.drive.folder(name, parent_id)
+
+    def upload(self, size):
+        """Count the session request and chunks of one resumable upload."""
+        self.calls[quota.WRITE] += 1 + max(1, int(math.ceil(float(size) / self.chunk_bytes)))
+
+    def parent(self, action, file_id, parent_id, reason):
+        self.calls[quota.WRITE] += 1
+        self.parent_changes.append({'action': action, 'file': file_id, 'parent': parent_id, 'reason': reason})
+
+
+def _zips(spec, drive_index, today, force, full_refresh_days):
+    """(id key, zip suffix) for each zip update_feature would upload for spec."""
+    if not delta.is_delta_feature(spec):
+        return FULL_ZIPS
+    delta_zip = ('delta_id', '_delta.zip')
+    last_full = drive_index.modified(spec['gdb_id'])
+    if not force and last_full is not None and (today - last_full).days < full_refresh_days:
+        return (delta_zip,)
+
+    return FULL_ZIPS + (delta_zip,)
+
+
+def plan_run(feature_specs, package_specs, drive_index, root_id, chunk_bytes, today, force=False,
+             full_refresh_days=None, sync_packages=True, all_package_specs=(), feature_index=None):
+    """
+    Plan a run that publishes feature_specs after syncing package_specs.
+
+    drive_index: DriveIndex of the latest snapshot, an empty one plans every folder as new and every size unknown
+    root_id: zip_loader.UTM_DRIVE_FOLDER that category folders are found in
+    chunk_bytes: resumable upload chunk size used to count upload requests
+    sync_packages: package_specs are synced first, as run_packages does
+    all_package_specs: every package spec, to find the packages a feature would be removed from
+    feature_index: spec_manager.get_feature_spec_index() for package members that are not published
+    returns: {'features': [{'sgid_name', 'zips', 'upload_bytes', 'unknown_sizes'}], 'packages': names,
+        'folders': paths created, 'parent_changes': [{'action', 'file', 'parent', 'reason'}], 'upload_bytes',
+        'estimated_bytes': part of upload_bytes guessed for zips with no known size, 'calls': {bucket: count},
+        'quota_seconds': least time the calls take at quota.RATES, 'snapshot': snapshot time or None}
+    """
+    full_refresh_days = delta.FULL_REFRESH_DAYS if full_refresh_days is None else full_refresh_days
+    plan = _Plan(drive_index, chunk_bytes)
+    packages_by_name = dict((p['name'], p) for p in all_package_specs)
+    feature_index = feature_index or dict((f['sgid_name'].lower(), f) for f in feature_specs)
+
+    for package in package_specs if sync_packages else []:
+        if len(package['parent_ids']) == 0 or package['gdb_id'] == '' or package['shape_id'] == '':
+            path = package['category']
+            category_id = plan.folder(package['category'], root_id, path)
+            packages_id = plan.folder('packages', category_id, path + '/packages')
+            folder_id = plan.folder(package['name'], packages_id, path + '/packages/' + package['name'])
+            path += '/packages/' + package['name']
+            gdb_folder = plan.folder(package['name'] + '_gdb', folder_id, path + '_gdb')
+            shp_folder = plan.folder(package['name'] + '_shp', folder_id, path + '_shp')
+        else:
+            gdb_folder, shp_folder = package['gdb_id'], package['shape_id']
+        members = [feature_index.get(f.lower()) for f in package['feature_classes']]
+        current = set()
+        for feature in [f for f in members if f is not None]:
+            for key, package_folder in (('gdb_id', gdb_folder), ('shape_id', shp_folder)):
+                plan.calls[quota.WRITE] += 1
+                current.add(feature[key])
+                if package_folder not in drive_index.parents(feature[key]):
+                    plan.parent(ADD, feature[key], package_folder, package['name'])
+        for package_folder in (gdb_folder, shp_folder):
+            plan.calls[quota.READ] += 1
+            for f in drive_index.children.get(package_folder, []):
+                if f['id'] not in current and f.get('mimeType') != FOLDER_MIME:
+                    plan.parent(REMOVE, f['id'], package_folder, package['name'])
+
+    features = []
+    known_sizes = {}
+    for spec in feature_specs:
+        for package_name in spec['packages']:
+            package = packages_by_name.get(package_name)
+            if package is not None and spec['sgid_name'].lower() not in [f.lower() for f in package['feature_classes']]:
+                for key in ('gdb_id', 'shape_id'):
+                    plan.calls[quota.WRITE] += 1
+                    if package[key] in drive_index.parents(spec[key]):
+                        plan.parent(REMOVE, spec[key], package[key], package_name)
+        category_id = plan.folder(spec['category'], root_id, spec['category'])
+        plan.folder(spec['name'], category_id, spec['category'] + '/' + spec['name'])
+        if spec.get('primary_key') and not os.path.exists(manifest.cache_path(spec['sgid_name'])) and \
+                spec.get('hash_id'):
+            plan.calls[quota.READ] += 1
+        zips = []
+        for key, suffix in _zips(spec, drive_index, today, force, full_refresh_days):
+            size = drive_index.size(spec.get(key))
+            if size is not None:
+                known_sizes.setdefault(suffix, []).append(size)
+            if not spec.get(key):
+                plan.created_files += 1
+            zips.append((spec['name'] + suffix, suffix, size))
+        features.append({'sgid_name': spec['sgid_name'], 'zips': zips})
+        plan.calls[quota.SHEETS] += 1
+
+    # Zips never uploaded before are guessed at the median size of the same kind of zip
+    medians = dict((suffix, sorted(sizes)[len(sizes) // 2]) for suffix, sizes in known_sizes.items())
+    upload_bytes = 0
+    estimated_bytes = 0
+    for feature in features:
+        feature['unknown_sizes'] = sum(1 for _, _, size in feature['zips'] if size is None)
+        feature['upload_bytes'] = 0
+        for _, suffix, size in feature['zips']:
+            if size is None:
+                size = medians.get(suffix, 0)
+                estimated_bytes += size
+            feature['upload_bytes'] += size
+            plan.upload(size)
+        feature['zips'] = [name for name, _, _ in feature['zips']]
+        upload_bytes += feature['upload_bytes']
+    # Ownership of everything created moves to the owner account in batched permission requests
+    plan.calls[quota.WRITE] += plan.created_files
+
+    return {'features': features,
+            'packages': [p['name'] for p in package_specs] if sync_packages else [],
+            'folders': plan.folders,
+            'parent_changes': plan.parent_changes,
+            'upload_bytes': upload_bytes,
+            'estimated_bytes': estimated_bytes,
+            'calls': plan.calls,
+            'quota_seconds': max([0] + [float(count) / quota.RATES[bucket][0]
+                                        for bucket, count in plan.calls.items() if quota.RATES.get(bucket)]),
+            'snapshot': drive_index.taken}
+
+
+def print_plan(plan, limit=20):
+    """Print plan totals and the largest uploads, limit of them or all when None."""
+    print('\nPlan: {} features, {} packages{}'.format(
+        len(plan['features']), len(plan['packages']),
+        ' from the snapshot taken {}'.format(plan['snapshot'][:16]) if plan['snapshot'] else
+        ', no Drive snapshot so every folder is new and sizes are unknown, run storage_report.py'))
+    print('Upload about {:.1f} MB ({:.1f} MB guessed for {} zips without a size)'.format(
+        plan['upload_bytes'] / 1048576.0, plan['estimated_bytes'] / 1048576.0,
+        sum(f['unknown_sizes'] for f in plan['features'])))
+    print('API calls: {} Drive reads, {} Drive writes, {} Sheets, at least {:.0f}s at the quota rates'.format(
+        plan['calls'][quota.READ], plan['calls'][quota.WRITE], plan['calls'][quota.SHEETS], plan['quota_seconds']))
+    print('{} Drive folders to create'.format(len(plan['folders'])))
+    for path in plan['folders'][:limit]:
+        print('    ' + path)
+    print('{} parent changes'.format(len(plan['parent_changes'])))
+    for change in plan['parent_changes'][:limit]:
+        print('    {action:<8}{file} in {parent} ({reason})'.format(**change))
+    largest = sorted(plan['features'], key=lambda f: f['upload_bytes'], reverse=True)
+    for feature in largest[:limit]:
+        print('{:<60}{:>10.1f} MB  {}'.format(feature['sgid_name'], feature['upload_bytes'] / 1048576.0,
+                                              ' '.join(feature['zips'])))
+    if limit is not None and len(largest) > limit:
+        print('...and {} more'.format(len(largest) - limit))
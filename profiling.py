@@ -0,0 +1,140 @@
+"""
+cProfile and tracemalloc hooks for zip_loader runs, off until configure is called from the command line.
+
+Profiles cover the thread that runs zip_loader. Export workers get the settings with each job and write their own
+<feature>.export.pstats files.
+"""
+import cProfile
+import os
+import re
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+
+import tracing
+
+#: Folder for .pstats files, None leaves cProfile off
+PROFILE_FOLDER = None
+#: Lowercase sgid names to profile, None profiles every feature and the rest of the run
+PROFILE_FEATURES = None
+#: Record tracemalloc peaks and top allocators around stages decorated with memory_stage
+TRACK_MEMORY = False
+#: Allocation sites printed for each stage
+TOP_ALLOCATORS = 5
+#: Frames kept for each traced allocation
+MEMORY_FRAMES = 1
+
+_run_profile = None
+#: Peak traced bytes of each open memory stage, innermost last, so nested stages do not hide outer peaks
+_open_peaks = []
+
+
+def configure(folder=None, features=None, memory=False):
+    """
+    Turn profiling on.
+
+    folder: write .pstats files here
+    features: sgid names to profile, None for every feature and a run.pstats for the whole run
+    memory: track memory around the stages decorated with memory_stage
+    """
+    global PROFILE_FOLDER, PROFILE_FEATURES, TRACK_MEMORY
+    PROFILE_FOLDER = folder
+    PROFILE_FEATURES = None if features is None else set(f.strip().lower() for f in features)
+    TRACK_MEMORY = memory
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+
+
+def settings():
+    """configure keyword arguments matching this process, for export workers."""
+    return {'folder': PROFILE_FOLDER,
+            'features': None if PROFILE_FEATURES is None else sorted(PROFILE_FEATURES),
+            'memory': TRACK_MEMORY}
+
+
+def _pstats_path(name):
+    return os.path.join(PROFILE_FOLDER, re.sub(r'[^\w.-]', '_', name) + '.pstats')
+
+
+def start_run():
+    """Profile the run outside of features when every feature is profiled."""
+    global _run_profile
+    if PROFILE_FOLDER is None or PROFILE_FEATURES is not None:
+        return
+    _run_profile = cProfile.Profile()
+    _run_profile.enable()
+
+
+def stop_run():
+    """Write run.pstats for a profile started by start_run."""
+    global _run_profile
+    if _run_profile is None:
+        return
+    _run_profile.disable()
+    _run_profile.dump_stats(_pstats_path('run'))
+    print('Profile written to {}'.format(_pstats_path('run')))
+    _run_profile = None
+
+
+@contextmanager
+def feature(sgid_name, suffix=''):
+    """
+    Profile a block working on one feature into <sgid_name><suffix>.pstats when it is selected.
+
+    The run profile is paused meanwhile, cProfile allows one active profiler per thread.
+    """
+    if PROFILE_FOLDER is None or (PROFILE_FEATURES is not None and sgid_name.lower() not in PROFILE_FEATURES):
+        yield
+        return
+    if _run_profile is not None:
+        _run_profile.disable()
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(_pstats_path(sgid_name + suffix))
+        if _run_profile is not None:
+            _run_profile.enable()
+
+
+def memory_stage(name):
+    """
+    Decorate a function to record its tracemalloc peak and top allocators when TRACK_MEMORY is on.
+
+    tracemalloc runs only while a decorated call does, so the run is not slowed between stages and snapshots hold
+    just the stage's allocations. The peak is the most memory the call had allocated at once, including other
+    threads. Top allocators are the lines holding the most new memory when it returns.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not TRACK_MEMORY:
+                return function(*args, **kwargs)
+            outermost = not tracemalloc.is_tracing()
+            with tracing.span('memory.' + name) as span:
+                if outermost:
+                    tracemalloc.start(MEMORY_FRAMES)
+                start_snapshot = None if outermost else tracemalloc.take_snapshot()
+                start_bytes = tracemalloc.get_traced_memory()[0]
+                _open_peaks.append(start_bytes)
+                tracemalloc.reset_peak()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    peak = max(tracemalloc.get_traced_memory()[1], _open_peaks.pop())
+                    if _open_peaks:
+                        _open_peaks[-1] = max(_open_peaks[-1], peak)
+                    snapshot = tracemalloc.take_snapshot()
+                    if outermost:
+                        tracemalloc.stop()
+                        top = snapshot.statistics('lineno')
+                    else:
+                        top = [stat for stat in snapshot.compare_to(start_snapshot, 'lineno') if stat.size_diff > 0]
+                    span.args['peak_mb'] = round((peak - start_bytes) / 1048576.0, 2)
+                    print('{} peak {:.1f} MB'.format(name, (peak - start_bytes) / 1048576.0))
+                    for stat in top[:TOP_ALLOCATORS]:
+                        print('    {}'.format(stat))
+        return wrapper
+    return decorator
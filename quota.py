@@ -0,0 +1,92 @@
+"""
+Token buckets for Drive and Sheets calls shared by every process on this machine.
+
+Drive and Sheets quotas are per user, so runs, service jobs and workers using the same account draw from one set of
+buckets. Bucket state is a small json file per bucket read and written under a locks.FileLock.
+"""
+import json
+import os
+from time import sleep, time
+
+import locks
+import tracing
+
+READ = 'read'
+WRITE = 'write'
+SHEETS = 'sheets'
+#: (calls per second, burst) for each bucket, None instead of a tuple for no limit
+RATES = {READ: (20, 40),
+         WRITE: (10, 20),
+         SHEETS: (1, 10)}
+#: Bucket state and lock files, shared by processes with the same working directory
+QUOTA_FOLDER = '.quota'
+#: Seconds to wait for another process to update a bucket
+LOCK_TIMEOUT = 60
+
+
+def _paths(bucket):
+    return os.path.join(QUOTA_FOLDER, bucket + '.json'), os.path.join(QUOTA_FOLDER, bucket + '.lock')
+
+
+def _load(state_path):
+    try:
+        with open(state_path, 'r') as json_file:
+            return json.load(json_file)
+    except (IOError, OSError, ValueError):
+        # A missing or unreadable state file starts a full bucket
+        return None
+
+
+def take(bucket, count=1):
+    """
+    Wait until count calls are available in bucket and take them.
+
+    A count larger than the burst is taken once the bucket is full, leaving it in debt so later calls wait.
+    returns: seconds waited
+    """
+    if RATES.get(bucket) is None:
+        return 0
+    rate, burst = RATES[bucket]
+    state_path, lock_path = _paths(bucket)
+    waited = 0
+    while True:
+        with locks.FileLock(lock_path, LOCK_TIMEOUT):
+            now = time()
+            state = _load(state_path) or {'tokens': burst, 'time': now, 'calls': 0, 'waits': 0, 'waited': 0.0}
+            state['tokens'] = min(burst, state['tokens'] + max(0, now - state['time']) * rate)
+            state['time'] = now
+            if state['tokens'] >= min(count, burst):
+                state['tokens'] -= count
+                state['calls'] += count
+                if waited:
+                    state['waits'] += 1
+                    state['waited'] += waited
+                # Replaced whole, get_stats reads without the lock
+                locks.atomic_write(state_path, json.dumps(state, sort_keys=True))
+                break
+            delay = (min(count, burst) - state['tokens']) / rate
+        sleep(delay)
+        waited += delay
+    tracing.count('quota.{}.calls'.format(bucket), count)
+    if waited:
+        tracing.count('quota.{}.waits'.format(bucket))
+        tracing.count('quota.{}.wait_seconds'.format(bucket), waited)
+
+    return waited
+
+
+def get_stats():
+    """{bucket: {'tokens', 'calls', 'waits', 'waited'}} for every bucket used on this machine so far."""
+    stats = {}
+    for bucket in sorted(RATES):
+        state = _load(_paths(bucket)[0])
+        if state is not None:
+            stats[bucket] = state
+
+    return stats
+
+
+if __name__ == '__main__':
+    for bucket, state in get_stats().items():
+        print('{:<8}{:>10} calls{:>8} waits{:>10.1f}s waiting{:>8.1f} tokens'.format(
+            bucket, state['calls'], state['waits'], state['waited'], state['tokens']))
@@ -0,0 +1,238 @@
+"""
+Vectorized row hashing over NumPy structured arrays.
+
+Columns are read as contiguous (rows, width) byte buffers and hashed with a vectorized xxh64 that gives the
+same digest as xxhash.xxh64(row_bytes).intdigest() one row at a time. Columns up to 8 bytes wide are used as is,
+wider columns and WKB geometry are reduced to their xxh64. A row hash is xxh64 over those words.
+"""
+import numpy as np
+from xxhash import xxh64
+
+PRIME64_1 = np.uint64(0x9E3779B185EBCA87)
+PRIME64_2 = np.uint64(0xC2B2AE3D27D4EB4F)
+PRIME64_3 = np.uint64(0x165667B19E3779F9)
+PRIME64_4 = np.uint64(0x85EBCA77C2B2AE63)
+PRIME64_5 = np.uint64(0x27D4EB2F165667C5)
+#: WKB lengths shared by fewer rows than this are hashed one row at a time
+MIN_GROUP_ROWS = 64
+
+
+def _rotl(values, bits):
+    """Rotate left in place."""
+    carry = values >> np.uint64(64 - bits)
+    values <<= np.uint64(bits)
+    values |= carry
+    return values
+
+
+def _round(acc, lane):
+    """xxh64 round updating acc in place."""
+    acc += lane * PRIME64_2
+    _rotl(acc, 31)
+    acc *= PRIME64_1
+    return acc
+
+
+def _merge(acc, value):
+    acc ^= _round(np.zeros_like(value), value)
+    acc *= PRIME64_1
+    acc += PRIME64_4
+    return acc
+
+
+def _lanes(data, start, count, dtype):
+    """Little endian integers of dtype read from count consecutive positions starting at byte start of each row."""
+    dtype = np.dtype(dtype).newbyteorder('<')
+    width = dtype.itemsize
+    if data.flags.c_contiguous and data.shape[1] % width == 0 and start % width == 0:
+        words = data.view(dtype)[:, start // width:start // width + count]
+    else:
+        words = np.ascontiguousarray(data[:, start:start + count * width]).view(dtype)
+
+    return words.astype(np.uint64, copy=False)
+
+
+def xxh64_rows(data, seed=0):
+    """
+    xxh64 of each row of a (rows, width) uint8 array.
+
+    returns: uint64 array with one digest per row
+    """
+    rows, length = data.shape
+    seed = np.uint64(seed)
+    position = 0
+    with np.errstate(over='ignore'):
+        if length >= 32:
+            stripes = length // 32
+            lanes = _lanes(data, 0, stripes * 4, np.uint64).reshape(rows, stripes, 4)
+            # The four accumulators side by side so each stripe is one contiguous update
+            accs = np.empty((rows, 4), dtype=np.uint64)
+            accs[:] = [seed + PRIME64_1 + PRIME64_2, seed + PRIME64_2, seed, seed - PRIME64_1]
+            for stripe in range(stripes):
+                _round(accs, lanes[:, stripe, :])
+            h = _rotl(accs[:, 0].copy(), 1) + _rotl(accs[:, 1].copy(), 7) + \
+                _rotl(accs[:, 2].copy(), 12) + _rotl(accs[:, 3].copy(), 18)
+            for i in range(4):
+                _merge(h, accs[:, i])
+            position = stripes * 32
+        else:
+            h = np.full(rows, seed + PRIME64_5, dtype=np.uint64)
+        h += np.uint64(length)
+
+        words = (length - position) // 8
+        if words:
+            lanes = _lanes(data, position, words, np.uint64)
+            for word in range(words):
+                h ^= _round(np.zeros(rows, dtype=np.uint64), lanes[:, word])
+                _rotl(h, 27)
+                h *= PRIME64_1
+                h += PRIME64_4
+            position += words * 8
+        if length - position >= 4:
+            h ^= _lanes(data, position, 1, np.uint32)[:, 0] * PRIME64_1
+            _rotl(h, 23)
+            h *= PRIME64_2
+            h += PRIME64_3
+            position += 4
+        for byte in range(position, length):
+            h ^= data[:, byte].astype(np.uint64) * PRIME64_5
+            _rotl(h, 11)
+            h *= PRIME64_1
+
+        h ^= h >> np.uint64(33)
+        h *= PRIME64_2
+        h ^= h >> np.uint64(29)
+        h *= PRIME64_3
+        h ^= h >> np.uint64(32)
+
+    return h
+
+
+def _column_bytes(column, width=None):
+    """
+    View one column as a contiguous (rows, itemsize) byte buffer.
+
+    width: characters for text columns so the buffer does not depend on the longest value in a block
+    """
+    if column.dtype.kind == 'O':
+        column = column.astype('U')
+    if column.dtype.kind == 'U' and width and column.dtype != np.dtype('<U{}'.format(width)):
+        column = column.astype('<U{}'.format(width))
+    elif column.dtype.byteorder == '>':
+        column = column.astype(column.dtype.newbyteorder('<'))
+    column = np.ascontiguousarray(column)
+
+    return column.view(np.uint8).reshape(len(column), column.dtype.itemsize)
+
+
+def _hash_text(column, width=None):
+    """Hash text one byte per character when every character is Latin-1, which is most rows, otherwise as UCS-4."""
+    data = _column_bytes(column, width)
+    codes = data.view('<u4')
+    if not codes.size or codes.max() < 256:
+        return xxh64_rows(codes.astype(np.uint8))
+    narrow = (codes < 256).all(axis=1)
+    hashes = xxh64_rows(data)
+    hashes[narrow] = xxh64_rows(codes[narrow].astype(np.uint8))
+
+    return hashes
+
+
+def _column_words(column, width=None):
+    """One uint64 per row: the value itself for columns up to 8 bytes wide, otherwise its xxh64."""
+    if column.dtype.kind in 'OU':
+        return _hash_text(column, width)
+    data = _column_bytes(column)
+    if data.shape[1] > 8:
+        return xxh64_rows(data)
+    padded = np.zeros((len(data), 8), dtype=np.uint8)
+    padded[:, :data.shape[1]] = data
+
+    return padded.view('<u8')[:, 0].astype(np.uint64)
+
+
+def hash_columns(block, fields, widths=None):
+    """
+    Reduce each field of a structured array to one uint64 per row.
+
+    widths: {field: characters} for text fields
+    returns: (rows, len(fields)) uint64 array
+    """
+    widths = widths or {}
+    words = np.empty((len(block), len(fields)), dtype=np.uint64)
+    for i, field in enumerate(fields):
+        words[:, i] = _column_words(block[field], widths.get(field))
+
+    return words
+
+
+def hash_wkb(wkbs):
+    """
+    Hash geometry from WKB bytes or bytearrays, None for empty geometry.
+
+    Rows with the same WKB length, such as every point in a layer, are hashed together.
+    returns: uint64 array
+    """
+    if None in wkbs:
+        wkbs = [b'' if wkb is None else wkb for wkb in wkbs]
+    hashes = np.empty(len(wkbs), dtype=np.uint64)
+    lengths = np.array(list(map(len, wkbs)), dtype=np.int64)
+    for length in np.unique(lengths):
+        rows = np.flatnonzero(lengths == length)
+        if len(rows) >= MIN_GROUP_ROWS:
+            group = wkbs if len(rows) == len(wkbs) else [wkbs[i] for i in rows]
+            data = np.frombuffer(b''.join(group), dtype=np.uint8).reshape(len(rows), int(length))
+            hashes[rows] = xxh64_rows(data)
+        else:
+            for i in rows:
+                hashes[i] = xxh64(wkbs[i]).intdigest()
+
+    return hashes
+
+
+def hash_block(block, fields, wkbs=None, widths=None):
+    """
+    Hash each row of a structured array from its field values and optional WKB geometry.
+
+    block: structured array with at least fields
+    wkbs: WKB bytes aligned with block rows or None for tables
+    returns: uint64 array
+    """
+    columns = hash_columns(block, fields, widths)
+    if wkbs is not None:
+        columns = np.column_stack([columns, hash_wkb(wkbs)])
+    columns = np.ascontiguousarray(columns.astype('<u8'))
+
+    return xxh64_rows(columns.view(np.uint8).reshape(len(block), columns.shape[1] * 8))
+
+
+class Block(object):
+    """
+    Rows read together with their keys and row hashes.
+
+    rows: structured array holding at least fields
+    null_masks: {field: bool array} true for the rows where field is null. Nulls are read as a stand-in value, so
+        fields without a mask have no nulls
+    """
+
+    def __init__(self, keys, hashes, rows, fields, wkbs=None, null_masks=None):
+        self.keys = keys
+        self.hashes = hashes
+        self.rows = rows
+        self.fields = fields
+        self.wkbs = wkbs
+        self.null_masks = null_masks or {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def attributes(self, index):
+        """Field values of one row as python values with nulls restored."""
+        attributes = {}
+        for field in self.fields:
+            if field in self.null_masks and self.null_masks[field][index]:
+                attributes[field] = None
+            else:
+                attributes[field] = self.rows[field][index].item()
+
+        return attributes
@@ -0,0 +1,106 @@
+"""State that zip_loader keeps between runs"""
+import json
+import os
+from datetime import date, datetime, timedelta
+
+import locks
+
+RUN_STATE_FILE = 'run_state.json'
+DATE_FORMAT = '%Y-%m-%d'
+#: Seconds to wait for another run to finish saving state
+LOCK_TIMEOUT = 60
+#: Change detection modes with their own watermark, --all checks features and --all_packages checks packages
+FEATURES = 'features'
+PACKAGES = 'packages'
+
+
+def load_state(path=None):
+    """Saved state from path, RUN_STATE_FILE by default, or {} before the first run."""
+    path = path or RUN_STATE_FILE
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as json_file:
+        return json.load(json_file)
+
+
+def save_state(state, path=None):
+    """Write state to a temp file and swap it in so a crash never leaves a partial file. path: RUN_STATE_FILE"""
+    path = path or RUN_STATE_FILE
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f_out:
+        f_out.write(json.dumps(state, sort_keys=True, indent=4))
+        f_out.write('\n')
+    locks.replace(temp_path, path)
+
+
+def update_state(change, path=None):
+    """
+    Apply change to the saved state and save it while holding the state lock.
+
+    change: function that edits the state dict in place
+    path: state file, RUN_STATE_FILE by default
+    returns: the saved state
+    """
+    path = path or RUN_STATE_FILE
+    with locks.FileLock(path + '.lock', LOCK_TIMEOUT):
+        state = load_state(path)
+        change(state)
+        save_state(state, path)
+
+    return state
+
+
+def get_watermark(state, mode=FEATURES):
+    """
+    Last change detection date whose changes were all published for mode or None.
+
+    mode: FEATURES for --all or PACKAGES for --all_packages, each keeps its own watermark
+    """
+    # States saved before watermarks were kept by mode have one watermark for both
+    watermark = state.get('watermarks', {}).get(mode) or state.get('watermark')
+    if not watermark:
+        return None
+
+    return datetime.strptime(watermark, DATE_FORMAT).date()
+
+
+def set_watermark(state, watermark, mode=FEATURES):
+    watermarks = state.setdefault('watermarks', {})
+    if state.get('watermark'):
+        for legacy_mode in (FEATURES, PACKAGES):
+            watermarks.setdefault(legacy_mode, state['watermark'])
+        del state['watermark']
+    watermarks[mode] = watermark.strftime(DATE_FORMAT)
+
+
+def get_change_window(state, end_date, since=None, mode=FEATURES):
+    """
+    Get the (start, end) change detection window for a run of mode.
+
+    Starts at since when given, otherwise the day after the mode's watermark so missed nights are caught up.
+    A run without a watermark only looks at end_date.
+    """
+    start_date = since
+    if start_date is None:
+        watermark = get_watermark(state, mode)
+        start_date = watermark + timedelta(days=1) if watermark else end_date
+
+    return start_date, end_date
+
+
+def get_published(state, sgid_name):
+    """Date sgid_name was last published by zip_loader or None."""
+    published = state.get('published', {}).get(sgid_name.lower())
+    if not published:
+        return None
+
+    return datetime.strptime(published, DATE_FORMAT).date()
+
+
+def set_published(state, sgid_name, published):
+    state.setdefault('published', {})[sgid_name.lower()] = published.strftime(DATE_FORMAT)
+
+
+def record_publish(sgid_name, published=None, path=None):
+    """Save that sgid_name was published on published, today by default."""
+    update_state(lambda state: set_published(state, sgid_name, published or date.today()), path)
@@ -0,0 +1,146 @@
+"""Choose the features a change detection run publishes from their update_cycle and last publish date"""
+import argparse
+import json
+import zlib
+from datetime import date, datetime
+
+import run_state
+import spec_manager
+
+CYCLES = spec_manager.UPDATE_CYCLES
+#: Days between refreshes for each update_cycle. Other cycles, such as never and demand, are not refreshed on a
+#: schedule and only publish when change detection sees them change
+CYCLE_DAYS = {CYCLES.DAY: 1,
+              CYCLES.WEEK: 7,
+              CYCLES.MONTH: 30,
+              CYCLES.QUARTER: 91,
+              CYCLES.BIANNUAL: 182,
+              CYCLES.ANNUAL: 365}
+#: Changed features publish in this order so frequently used layers are not held up by rarely updated ones
+PRIORITY = (CYCLES.DAY, CYCLES.WEEK, CYCLES.MONTH, CYCLES.QUARTER, CYCLES.BIANNUAL, '', CYCLES.ANNUAL,
+            CYCLES.DEMAND, CYCLES.NEVER)
+#: update_cycle for specs without one, None leaves them to change detection alone
+DEFAULT_CYCLE = None
+#: Overdue features refresh on their own day of this many, or on the next run once they are this many days late
+SPREAD_DAYS = 7
+
+
+def get_cycle(spec):
+    """Lowercase update_cycle of spec, DEFAULT_CYCLE when it has none."""
+    return (spec.get('update_cycle') or DEFAULT_CYCLE or '').lower()
+
+
+def _priority(cycle):
+    return PRIORITY.index(cycle) if cycle in PRIORITY else PRIORITY.index('')
+
+
+def refresh_slot(sgid_name):
+    """Day out of SPREAD_DAYS on which sgid_name gets its scheduled refresh, stable between runs and machines."""
+    return zlib.crc32(sgid_name.lower().encode('utf-8')) % SPREAD_DAYS
+
+
+def is_refresh_day(sgid_name, day):
+    return day.toordinal() % SPREAD_DAYS == refresh_slot(sgid_name)
+
+
+def get_status(spec, state, day):
+    """
+    Refresh status of one feature spec on day.
+
+    returns: {'sgid_name', 'cycle', 'last_published', 'days_overdue'} where days_overdue is None for features
+        without a refresh cycle or a recorded publish, and below 1 for features that are up to date
+    """
+    cycle = get_cycle(spec)
+    last_published = run_state.get_published(state, spec['sgid_name'])
+    days_overdue = None
+    if cycle in CYCLE_DAYS and last_published is not None:
+        days_overdue = (day - last_published).days - CYCLE_DAYS[cycle]
+
+    return {'sgid_name': spec['sgid_name'],
+            'cycle': cycle,
+            'last_published': last_published.strftime(run_state.DATE_FORMAT) if last_published else None,
+            'days_overdue': days_overdue}
+
+
+def is_overdue(status):
+    """True when a feature with a refresh cycle is past it or has never been published by zip_loader."""
+    if status['cycle'] not in CYCLE_DAYS:
+        return False
+
+    return status['last_published'] is None or status['days_overdue'] > 0
+
+
+def plan_features(specs, state, day, changed_tables=()):
+    """
+    Order the features to publish on day.
+
+    Changed features publish first, ordered by update_cycle so never and demand layers go last. Overdue features
+    that did not change are refreshed on their refresh_slot day, so rebuilding every layer is spread over
+    SPREAD_DAYS runs, or on the next run once they are SPREAD_DAYS days late.
+    specs: feature specs to consider
+    state: run_state dict with publish dates
+    changed_tables: lowercase sgid names from change detection
+    returns: {'features': sgid names in publish order, 'changed': [...], 'scheduled': [...], 'overdue': statuses}
+    """
+    changed_tables = set(changed_tables)
+    changed = []
+    scheduled = []
+    overdue = []
+    for spec in specs:
+        if spec['sgid_name'] == '':
+            continue
+        status = get_status(spec, state, day)
+        if spec['sgid_name'].lower() in changed_tables:
+            changed.append(status)
+            status['planned'] = True
+        elif is_overdue(status):
+            late = status['days_overdue'] is not None and status['days_overdue'] >= SPREAD_DAYS
+            status['planned'] = late or is_refresh_day(spec['sgid_name'], day)
+            if status['planned']:
+                scheduled.append(status)
+        if is_overdue(status):
+            overdue.append(status)
+
+    changed.sort(key=lambda s: (_priority(s['cycle']), s['sgid_name'].lower()))
+    scheduled.sort(key=lambda s: (-(s['days_overdue'] or 0), s['sgid_name'].lower()))
+    overdue.sort(key=lambda s: (s['days_overdue'] is None, -(s['days_overdue'] or 0), s['sgid_name'].lower()))
+    changed = [s['sgid_name'] for s in changed]
+    scheduled = [s['sgid_name'] for s in scheduled]
+
+    return {'features': changed + scheduled,
+            'changed': changed,
+            'scheduled': scheduled,
+            'overdue': overdue}
+
+
+def print_plan(plan, limit=None):
+    """Print plan counts and the most overdue features, limit of them or all when None."""
+    print('{} changed features, {} scheduled refreshes, {} overdue features'.format(
+        len(plan['changed']), len(plan['scheduled']), len(plan['overdue'])))
+    for status in plan['overdue'][:limit]:
+        print('{:<60}{:<10}{:<12}{:>6}  {}'.format(status['sgid_name'], status['cycle'],
+                                                   status['last_published'] or 'unknown',
+                                                   '' if status['days_overdue'] is None else status['days_overdue'],
+                                                   'planned' if status['planned'] else ''))
+    if limit is not None and len(plan['overdue']) > limit:
+        print('...and {} more'.format(len(plan['overdue']) - limit))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report overdue features and the scheduled refreshes for a day')
+    parser.add_argument('--date', action='store', dest='day', type=lambda d: datetime.strptime(d, '%Y-%m-%d').date(),
+                        default=date.today(), help='Day to plan for as YYYY-MM-DD, defaults to today')
+    parser.add_argument('--category', action='store', dest='category', help='Only features in this category')
+    parser.add_argument('--default_cycle', action='store', dest='default_cycle',
+                        help='update_cycle for specs without one')
+    parser.add_argument('--json', action='store', dest='json_path', help='Write the plan as json to this path')
+    args = parser.parse_args()
+
+    DEFAULT_CYCLE = args.default_cycle
+    specs = [s for s in spec_manager.get_feature_specs()
+             if args.category is None or args.category.upper() == s['category'].upper()]
+    plan = plan_features(specs, run_state.load_state(), args.day)
+    print_plan(plan)
+    if args.json_path:
+        with open(args.json_path, 'w') as f_out:
+            f_out.write(json.dumps(plan, sort_keys=True, indent=4))
@@ -0,0 +1,187 @@
+"""Manage package_temp: a scratch directory per feature, a disk budget and a small cache of recent zips"""
+import json
+import os
+import shutil
+import threading
+
+WORK_FOLDER = 'work'
+ZIP_INDEX = 'zips.json'
+#: Seconds reserve() waits for another thread to release temp space before going ahead over budget
+RESERVE_TIMEOUT = 600
+
+
+def folder_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for filename in files:
+            try:
+                total += os.path.getsize(os.path.join(root, filename))
+            except OSError:
+                pass
+
+    return total
+
+
+class ScratchSpace(object):
+    """
+    Scratch space rooted at a temp directory such as package_temp.
+
+    Each feature exports into root/work/<name> which is removed once its zips are made and uploaded.
+    Zips are written to root so --upload_zip can find them. The keep_zips most recent uploaded zips stay on disk;
+    zips that were not uploaded are pinned until an upload succeeds.
+    budget_bytes: reserve() holds back new exports while root uses more than this. None for no limit.
+    """
+
+    def __init__(self, root, budget_bytes=None, keep_zips=8):
+        self.root = root
+        self.work_root = os.path.join(root, WORK_FOLDER)
+        self.budget_bytes = budget_bytes
+        self.keep_zips = keep_zips
+        #: Reserved feature names and the thread that holds each reservation
+        self.active = {}
+        self._condition = threading.Condition()
+        self._zips, self._runs = self._load_index()
+
+    def _index_path(self):
+        return os.path.join(self.root, ZIP_INDEX)
+
+    def _load_index(self):
+        if not os.path.exists(self._index_path()):
+            return [], {}
+        with open(self._index_path(), 'r') as json_file:
+            index = json.load(json_file)
+        zips = [(name, pinned) for name, pinned in index['zips'] if os.path.exists(os.path.join(self.root, name))]
+
+        return zips, index.get('runs', {})
+
+    def _save_index(self):
+        with open(self._index_path(), 'w') as f_out:
+            f_out.write(json.dumps({'zips': self._zips, 'runs': self._runs}, indent=4))
+
+    def reset(self):
+        """Remove everything under root except cached zips and recreate the work folder."""
+        keep = set(name for name, _ in self._zips)
+        keep.add(ZIP_INDEX)
+        if os.path.exists(self.root):
+            for name in os.listdir(self.root):
+                if name in keep:
+                    continue
+                path = os.path.join(self.root, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+        os.makedirs(self.work_root, exist_ok=True)
+        print('Temp directory reset, {} cached zips kept'.format(len(self._zips)))
+
+    def usage(self):
+        return folder_size(self.root)
+
+    def feature_dir(self, name):
+        """Empty scratch directory for one feature."""
+        path = os.path.join(self.work_root, name)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+
+        return path
+
+    def zip_path(self, name, suffix):
+        return os.path.join(self.root, '{}_{}.zip'.format(name, suffix))
+
+    def _evict_one(self):
+        """Delete the least recently used unpinned zip. Returns False when there is nothing to evict."""
+        for i, (name, pinned) in enumerate(self._zips):
+            if not pinned:
+                del self._zips[i]
+                path = os.path.join(self.root, name)
+                if os.path.exists(path):
+                    os.remove(path)
+                self._save_index()
+                return True
+
+        return False
+
+    def reserve(self, name, timeout=RESERVE_TIMEOUT):
+        """
+        Wait for room under the budget before name starts exporting.
+
+        Cached zips are evicted first. Then the call waits up to timeout seconds for other threads to release their
+        scratch directories. Reservations held by the calling thread can not be released while it waits, so when
+        there are no others nothing can free space and the export goes ahead over budget.
+        """
+        with self._condition:
+            if self.budget_bytes is not None:
+                while self.usage() >= self.budget_bytes:
+                    if self._evict_one():
+                        continue
+                    if all(owner == threading.get_ident() for owner in self.active.values()):
+                        print('Temp space over budget with nothing to free, continuing: {}'.format(name))
+                        break
+                    if not self._condition.wait(timeout):
+                        print('Timed out waiting for temp space, continuing: {}'.format(name))
+                        break
+            self.active[name] = threading.get_ident()
+
+    def try_reserve(self, name):
+        """
+        Reserve space for name without waiting, for exports queued ahead of time.
+
+        returns: False when root is still over budget after evicting cached zips and other exports hold space
+        """
+        with self._condition:
+            if self.budget_bytes is not None:
+                while self.usage() >= self.budget_bytes:
+                    if self._evict_one():
+                        continue
+                    if self.active:
+                        return False
+                    break
+            self.active[name] = threading.get_ident()
+
+            return True
+
+    def release(self, name):
+        """Delete the scratch directory for name and wake exports waiting on the budget."""
+        path = os.path.join(self.work_root, name)
+        if os.path.exists(path):
+            shutil.rmtree(path, ignore_errors=True)
+        with self._condition:
+            self.active.pop(name, None)
+            self._condition.notify_all()
+
+    def record_run(self, name, zip_paths):
+        """Record the zips the latest run made for name, replacing those of earlier runs. [] before it starts."""
+        with self._condition:
+            self._runs[name] = [os.path.basename(zip_path) for zip_path in zip_paths]
+            self._save_index()
+
+    def run_zips(self, name):
+        """
+        Paths of the zips the latest run made for name that are still on disk.
+
+        Cached zips of earlier runs are left out so they are never uploaded again as new ones.
+        returns: list of paths or None when no run of name was recorded
+        """
+        with self._condition:
+            if name not in self._runs:
+                return None
+            paths = [os.path.join(self.root, zip_name) for zip_name in self._runs[name]]
+
+        return [path for path in paths if os.path.exists(path)]
+
+    def keep_zip(self, zip_path, pinned=False):
+        """
+        Record zip_path as most recently used.
+
+        pinned: keep the zip until it is recorded again unpinned, used for zips that still need uploading
+        """
+        name = os.path.basename(zip_path)
+        with self._condition:
+            self._zips = [z for z in self._zips if z[0] != name]
+            self._zips.append((name, pinned))
+            unpinned = [z for z in self._zips if not z[1]]
+            for _ in range(len(unpinned) - self.keep_zips):
+                self._evict_one()
+            self._save_index()
+            self._condition.notify_all()
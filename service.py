@@ -0,0 +1,258 @@
+"""
+Keep zip_loader resident and send it jobs from a local client.
+
+zip_loader.py --serve imports arcpy, builds the Drive and Sheets clients and loads credentials once, then runs
+change detection polls and jobs sent by `python service.py --feature ...` one at a time. Clients connect on a
+localhost port and authenticate with a key file only the service account can read.
+"""
+import argparse
+import getpass
+import os
+import queue
+import subprocess
+import threading
+import traceback
+from datetime import datetime
+from multiprocessing.connection import AuthenticationError, Client, Listener
+from time import perf_counter, time
+
+import metrics
+
+PORT = 6010
+AUTHKEY_FILE = 'service_key'
+#: Windows accounts that may hold access to the key besides the service account
+WINDOWS_KEY_ADMINS = ('NT AUTHORITY\\SYSTEM', 'BUILTIN\\Administrators')
+POLL_MINUTES = 60
+#: zip_loader options a job can set, with the value used when a job leaves them out
+JOB_DEFAULTS = {'feature': None,
+                'package': None,
+                'feature_list': None,
+                'package_list': None,
+                'zip_feature': None,
+                'check_features': False,
+                'check_packages': False,
+                'feature_category': None,
+                'schedule': False,
+                'since': None,
+                'delete_feature': None}
+#: Options clients can send, deletes ask for confirmation so they are not taken from clients
+JOB_KEYS = tuple(key for key in JOB_DEFAULTS if key != 'delete_feature') + ('force', 'load')
+
+
+def _windows_user():
+    domain = os.environ.get('USERDOMAIN')
+
+    return '{}\\{}'.format(domain, getpass.getuser()) if domain else getpass.getuser()
+
+
+def _restrict_to_user(path):
+    """Remove inherited access to path on Windows, where os.open ignores the file mode."""
+    if os.name == 'nt':
+        subprocess.check_call(['icacls', path, '/inheritance:r', '/grant:r', '{}:F'.format(_windows_user())],
+                              stdout=subprocess.DEVNULL)
+
+
+def get_key_readers(path):
+    """Accounts or classes of users other than the current user that have access to path."""
+    if os.name != 'nt':
+        status = os.stat(path)
+        readers = []
+        if status.st_uid != os.getuid():
+            readers.append('owner uid {}'.format(status.st_uid))
+        if status.st_mode & 0o070:
+            readers.append('group')
+        if status.st_mode & 0o007:
+            readers.append('others')
+        return readers
+    allowed = set(name.lower() for name in WINDOWS_KEY_ADMINS + (_windows_user(), getpass.getuser()))
+    readers = []
+    for line in subprocess.check_output(['icacls', path], universal_newlines=True).splitlines():
+        entry = line.strip()
+        if entry.startswith(path):
+            entry = entry[len(path):].strip()
+        if ':(' in entry and entry.split(':(')[0].lower() not in allowed:
+            readers.append(entry.split(':(')[0])
+
+    return readers
+
+
+def get_authkey(path=AUTHKEY_FILE, create=False):
+    """
+    Read the shared service key.
+
+    Anyone who can read the key can send the service pickled jobs, which run as the service account.
+    create: write a new random key readable only by this account when there is none, and refuse a key others can
+        read, used when the service starts
+    """
+    if not os.path.exists(path):
+        if not create:
+            raise Exception('No service key at {}, start zip_loader.py --serve first'.format(path))
+        key_file = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            _restrict_to_user(path)
+            os.write(key_file, os.urandom(32).hex().encode('utf-8'))
+        finally:
+            os.close(key_file)
+    if create:
+        readers = get_key_readers(path)
+        if readers:
+            raise Exception('Service key {} can be read by {}. Delete it or limit it to this account'.format(
+                path, ', '.join(readers)))
+    with open(path, 'r') as key_file:
+        return key_file.read().strip().encode('utf-8')
+
+
+def validate_job(job):
+    if not isinstance(job, dict):
+        raise Exception('Jobs are dicts of zip_loader options')
+    unknown = sorted(set(job) - set(JOB_KEYS) - set(['stop']))
+    if unknown:
+        raise Exception('Unknown job options: {}'.format(', '.join(unknown)))
+
+
+def _describe(job):
+    return ', '.join('{}={}'.format(key, job[key]) for key in sorted(job)) or 'empty job'
+
+
+class Service(object):
+    """
+    Run jobs from local clients and a repeating poll job in one thread.
+
+    run_job: function taking a job dict, zip_loader runs it with its options overridden by the job
+    poll_job: job run at start and every poll_minutes, None for no polling
+    """
+
+    def __init__(self, run_job, poll_job=None, poll_minutes=POLL_MINUTES, address=('localhost', PORT),
+                 authkey_file=AUTHKEY_FILE):
+        self.run_job = run_job
+        self.poll_job = poll_job
+        self.poll_seconds = poll_minutes * 60
+        self.address = address
+        self.authkey = get_authkey(authkey_file, create=True)
+        self.jobs = queue.Queue()
+        self.stopping = threading.Event()
+
+    def _accept(self, listener):
+        while not self.stopping.is_set():
+            try:
+                connection = listener.accept()
+            except (AuthenticationError, EOFError, OSError) as e:
+                if not self.stopping.is_set():
+                    print('Rejected service connection: {}'.format(e))
+                continue
+            threading.Thread(target=self._receive, args=(connection,), daemon=True).start()
+
+    def _receive(self, connection):
+        """Read one job from a client, reply with its place in the queue and queue it."""
+        try:
+            job = connection.recv()
+            validate_job(job)
+        except Exception as e:
+            connection.send({'status': 'rejected', 'error': str(e)})
+            connection.close()
+            return
+        connection.send({'status': 'queued', 'ahead': self.jobs.qsize()})
+        self.jobs.put((job, connection))
+        metrics.depth('service.jobs_queued', self.jobs.qsize())
+
+    def _run(self, job):
+        print('\n{} service job: {}'.format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), _describe(job)))
+        start = perf_counter()
+        try:
+            self.run_job(job)
+        except Exception:
+            print(traceback.format_exc())
+            return {'status': 'failed', 'error': traceback.format_exc(), 'seconds': perf_counter() - start}
+
+        return {'status': 'done', 'seconds': perf_counter() - start}
+
+    def serve(self):
+        """Run jobs until a client sends a stop job."""
+        listener = Listener(self.address, authkey=self.authkey)
+        threading.Thread(target=self._accept, args=(listener,), daemon=True).start()
+        print('Service listening on {}:{}'.format(*self.address))
+        next_poll = time()
+        try:
+            while not self.stopping.is_set():
+                timeout = max(0, next_poll - time()) if self.poll_job is not None else None
+                try:
+                    job, connection = self.jobs.get(timeout=timeout)
+                    metrics.depth('service.jobs_queued', self.jobs.qsize())
+                except queue.Empty:
+                    self._run(self.poll_job)
+                    next_poll = time() + self.poll_seconds
+                    continue
+                if job.get('stop'):
+                    self.stopping.set()
+                    result = {'status': 'stopped'}
+                else:
+                    result = self._run(job)
+                try:
+                    connection.send(result)
+                    connection.close()
+                except (EOFError, OSError):
+                    pass
+        finally:
+            self.stopping.set()
+            listener.close()
+        print('Service stopped')
+
+
+def submit(job, port=PORT, authkey_file=AUTHKEY_FILE, wait=True):
+    """
+    Send job to a running service.
+
+    wait: wait for the job to finish, otherwise return once it is queued
+    returns: the service reply, status is queued, rejected, done, failed or stopped
+    """
+    validate_job(job)
+    connection = Client(('localhost', port), authkey=get_authkey(authkey_file))
+    try:
+        connection.send(job)
+        reply = connection.recv()
+        if wait and reply['status'] == 'queued':
+            reply = connection.recv()
+    finally:
+        connection.close()
+
+    return reply
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Send a job to zip_loader.py --serve')
+    parser.add_argument('-f', action='store_true', dest='force',
+                        help='Force unchanged features and packages to create zip files')
+    parser.add_argument('-n', action='store_false', dest='load',
+                        help='Do not upload any files to drive')
+    parser.add_argument('--feature', action='store', dest='feature', help='SGID feature name to update')
+    parser.add_argument('--package', action='store', dest='package', help='Package name to update')
+    parser.add_argument('--feature_list', action='store', dest='feature_list',
+                        help='json file with array named "features", as a path the service can read')
+    parser.add_argument('--package_list', action='store', dest='package_list',
+                        help='json file with array named "packages", as a path the service can read')
+    parser.add_argument('--upload_zip', action='store', dest='zip_feature',
+                        help='Upload zip files left in package_temp for a feature')
+    parser.add_argument('--poll', action='store_true', dest='poll',
+                        help='Check change detection now with --all and --all_packages')
+    parser.add_argument('--stop', action='store_true', dest='stop', help='Stop the service after queued jobs')
+    parser.add_argument('--no_wait', action='store_false', dest='wait',
+                        help='Return once the job is queued')
+    parser.add_argument('--port', action='store', dest='port', type=int, default=PORT)
+    args = parser.parse_args()
+
+    if args.stop:
+        job = {'stop': True}
+    else:
+        job = dict((key, getattr(args, key)) for key in ('feature', 'package', 'feature_list', 'package_list',
+                                                         'zip_feature') if getattr(args, key))
+        if args.poll:
+            job.update({'check_features': True, 'check_packages': True})
+        if not job:
+            parser.error('Give a job such as --feature, --package or --poll')
+        job.update({'force': args.force, 'load': args.load})
+
+    start = perf_counter()
+    reply = submit(job, port=args.port, wait=args.wait)
+    print('{} in {:.1f}s'.format(reply['status'], perf_counter() - start))
+    if reply.get('error'):
+        print(reply['error'])
@@ -0,0 +1,235 @@
+"""Check every feature and package spec for consistency in one pass over the spec index"""
+import argparse
+import json
+import sys
+from time import perf_counter
+
+import spec_manager
+import spec_store
+import storage_report
+
+ERROR = 'error'
+WARNING = 'warning'
+#: Checks and the severity reported for them
+CHECKS = {
+    'invalid_parent_ids': ERROR,
+    'duplicate_sgid_name': ERROR,
+    'package_feature_without_spec': ERROR,
+    'feature_package_not_found': ERROR,
+    'feature_package_not_listed': WARNING,
+    'package_not_listing_feature': WARNING,
+    'duplicate_drive_id': ERROR,
+    'empty_drive_id': WARNING,
+    'drive_file_not_found': ERROR,
+    'drive_parent_mismatch': WARNING,
+    'package_link_missing': WARNING,
+}
+REQUIRED_ID_KEYS = ('gdb_id', 'shape_id')
+FILE_ID_KEYS = ('gdb_id', 'shape_id', 'hash_id', 'delta_id')
+
+
+def _problem(check, kind, name, detail, **values):
+    problem = {'check': check,
+               'severity': CHECKS[check],
+               'kind': kind,
+               'name': name,
+               'detail': detail}
+    problem.update(values)
+
+    return problem
+
+
+def _spec_ids(spec):
+    """Yield (key, drive id) for every drive id in spec."""
+    for key in FILE_ID_KEYS:
+        if spec.get(key):
+            yield key, spec[key]
+    for parent_id in spec['parent_ids']:
+        yield 'parent_ids', parent_id
+
+
+def check_specs(feature_specs, package_specs, snapshot=None):
+    """
+    Find inconsistencies within and between specs, and against a storage_report snapshot when one is given.
+
+    returns: list of {'check', 'severity', 'kind', 'name', 'detail', ...} ordered by check, kind and name
+    """
+    problems = []
+    features = {}
+    for spec in feature_specs:
+        key = spec['sgid_name'].lower()
+        if key in features:
+            problems.append(_problem('duplicate_sgid_name', 'feature', spec['sgid_name'],
+                                     'More than one feature spec has this sgid_name'))
+        features[key] = spec
+    packages = dict((spec['name'].lower(), spec) for spec in package_specs)
+
+    owners = {}
+    for kind, specs in (('feature', feature_specs), ('package', package_specs)):
+        for spec in specs:
+            name = spec['sgid_name'] if kind == 'feature' else spec['name']
+            if '' in spec['parent_ids']:
+                problems.append(_problem('invalid_parent_ids', kind, name, 'parent_ids contains an empty id'))
+            for key in REQUIRED_ID_KEYS:
+                if not spec.get(key):
+                    problems.append(_problem('empty_drive_id', kind, name, '{} is empty'.format(key), key=key))
+            for key, drive_id in _spec_ids(spec):
+                owners.setdefault(drive_id, []).append((kind, name, key))
+
+    for package in package_specs:
+        feature_classes = package['feature_classes'] if package['feature_classes'] != '' else []
+        for feature_class in feature_classes:
+            feature = features.get(feature_class.lower())
+            if feature is None:
+                problems.append(_problem('package_feature_without_spec', 'package', package['name'],
+                                         'Lists {} which has no feature spec'.format(feature_class),
+                                         feature=feature_class))
+            elif package['name'].lower() not in [p.lower() for p in feature['packages']]:
+                problems.append(_problem('feature_package_not_listed', 'feature', feature['sgid_name'],
+                                         'Listed by package {} but not in packages'.format(package['name']),
+                                         package=package['name']))
+
+    for feature in feature_specs:
+        for package_name in feature['packages']:
+            package = packages.get(package_name.lower())
+            if package is None:
+                problems.append(_problem('feature_package_not_found', 'feature', feature['sgid_name'],
+                                         'Claims package {} which has no spec'.format(package_name),
+                                         package=package_name))
+            elif feature['sgid_name'].lower() not in [f.lower() for f in package['feature_classes']]:
+                problems.append(_problem('package_not_listing_feature', 'feature', feature['sgid_name'],
+                                         'Claims package {} which does not list it'.format(package_name),
+                                         package=package_name))
+
+    for drive_id, uses in owners.items():
+        if len(uses) > 1:
+            for kind, name, key in uses:
+                problems.append(_problem('duplicate_drive_id', kind, name,
+                                         '{} {} is also used by {}'.format(key, drive_id, ', '.join(
+                                             '{} {}'.format(n, k) for _, n, k in uses if n != name or k != key)),
+                                         key=key, drive_id=drive_id))
+
+    if snapshot is not None:
+        problems.extend(check_snapshot(feature_specs, package_specs, snapshot))
+
+    problems.sort(key=lambda p: (p['check'], p['kind'], p['name'], p['detail']))
+
+    return problems
+
+
+def check_snapshot(feature_specs, package_specs, snapshot):
+    """Compare spec drive ids with the files and parents in a storage_report snapshot."""
+    problems = []
+    files = snapshot['files']
+    for kind, specs in (('feature', feature_specs), ('package', package_specs)):
+        for spec in specs:
+            name = spec['sgid_name'] if kind == 'feature' else spec['name']
+            for key, drive_id in _spec_ids(spec):
+                if drive_id not in files:
+                    problems.append(_problem('drive_file_not_found', kind, name,
+                                             '{} {} is not in the snapshot'.format(key, drive_id),
+                                             key=key, drive_id=drive_id))
+                elif kind == 'feature' and key in ('gdb_id', 'shape_id', 'delta_id') and spec['parent_ids'] and \
+                        not set(spec['parent_ids']) & set(files[drive_id].get('parents', [])):
+                    problems.append(_problem('drive_parent_mismatch', kind, name,
+                                             '{} {} is not in the feature folder'.format(key, drive_id),
+                                             key=key, drive_id=drive_id))
+
+    features = dict((spec['sgid_name'].lower(), spec) for spec in feature_specs)
+    for package in package_specs:
+        feature_classes = package['feature_classes'] if package['feature_classes'] != '' else []
+        for feature_class in feature_classes:
+            feature = features.get(feature_class.lower())
+            if feature is None:
+                continue
+            for key in REQUIRED_ID_KEYS:
+                drive_id = feature[key]
+                if drive_id in files and package[key] and package[key] not in files[drive_id].get('parents', []):
+                    problems.append(_problem('package_link_missing', 'package', package['name'],
+                                             '{} {} of {} is not in the package folder'.format(
+                                                 key, drive_id, feature['sgid_name']),
+                                             key=key, drive_id=drive_id, feature=feature['sgid_name']))
+
+    return problems
+
+
+def summarize(problems):
+    """Count problems by check and severity."""
+    counts = {ERROR: 0, WARNING: 0}
+    checks = {}
+    for problem in problems:
+        counts[problem['severity']] += 1
+        checks[problem['check']] = checks.get(problem['check'], 0) + 1
+
+    return {'errors': counts[ERROR], 'warnings': counts[WARNING], 'checks': checks}
+
+
+def _load_feature_specs():
+    """Every feature spec including specs that repeat an sgid_name, which spec_manager indexes only once."""
+    if spec_manager.get_store() is not None:
+        return spec_manager.get_store().specs(spec_store.FEATURE)
+
+    return [spec_manager.load_feature_json(p) for p in spec_manager.get_feature_spec_path_list()]
+
+
+def run_check(snapshot_path=None, use_snapshot=True):
+    """
+    Check the specs spec_manager reads against each other and the snapshot.
+
+    snapshot_path: storage_report snapshot json, defaults to the latest saved snapshot when use_snapshot
+    returns: {'problems': [...], 'summary': {...}, 'snapshot': taken time or None, 'seconds': float}
+    """
+    start = perf_counter()
+    feature_specs = _load_feature_specs()
+    package_specs = spec_manager.get_package_specs()
+    snapshot = None
+    if snapshot_path:
+        snapshot = storage_report.load_snapshot(snapshot_path)
+    elif use_snapshot:
+        snapshot = storage_report.load_latest_snapshot()
+    problems = check_specs(feature_specs, package_specs, snapshot)
+
+    return {'problems': problems,
+            'summary': summarize(problems),
+            'features': len(feature_specs),
+            'packages': len(package_specs),
+            'snapshot': snapshot['taken'] if snapshot else None,
+            'seconds': round(perf_counter() - start, 3)}
+
+
+def print_result(result):
+    for problem in result['problems']:
+        print('{:<8}{:<30}{:<8}{} {}'.format(problem['severity'], problem['check'], problem['kind'], problem['name'],
+                                             problem['detail']))
+    summary = result['summary']
+    print('\n{} features, {} packages, snapshot {}: {} errors, {} warnings in {}s'.format(
+        result['features'], result['packages'], result['snapshot'], summary['errors'], summary['warnings'],
+        result['seconds']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check feature and package specs for consistency')
+    parser.add_argument('--snapshot', action='store', dest='snapshot',
+                        help='storage_report snapshot json to compare drive ids with. Defaults to the latest saved')
+    parser.add_argument('--no_snapshot', action='store_false', dest='use_snapshot',
+                        help='Only check specs against each other')
+    parser.add_argument('--json', action='store', dest='json_path',
+                        help='Write results as json to this path, - for stdout')
+    parser.add_argument('--spec_db', action='store', dest='spec_db',
+                        help='Check specs in this SQLite spec database instead of the json folders')
+    parser.add_argument('--warnings', action='store_true', dest='fail_on_warnings',
+                        help='Exit non-zero for warnings as well as errors')
+    args = parser.parse_args()
+
+    spec_manager.SPEC_DB = args.spec_db
+    result = run_check(args.snapshot, args.use_snapshot)
+    if args.json_path == '-':
+        print(json.dumps(result, sort_keys=True, indent=4))
+    else:
+        print_result(result)
+        if args.json_path:
+            with open(args.json_path, 'w') as f_out:
+                f_out.write(json.dumps(result, sort_keys=True, indent=4))
+
+    summary = result['summary']
+    sys.exit(1 if summary['errors'] or (args.fail_on_warnings and summary['warnings']) else 0)
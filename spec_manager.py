@@ -1,13 +1,73 @@
 """Code to manage spec json files"""
 import os
+import copy
 import json
 import argparse
+from contextlib import contextmanager
+
+import locks
+import profiling
+import spec_store
 
 
 PACKAGE_SPEC_FOLDER = 'packages'
 FEATURE_SPEC_FOLDER = 'features'
 FEATURE_SPEC_TEMPLATE = 'templates/feature_template.json'
 PACKAGE_SPEC_TEMPLATE = 'templates/package_template.json'
+#: Lock files for json specs, kept in this folder inside each spec folder
+LOCK_FOLDER = '.locks'
+#: Seconds to wait for another process to finish writing a spec
+LOCK_TIMEOUT = 300
+#: SQLite spec_store database used instead of the json spec folders, None for json files
+SPEC_DB = None
+_stores = {}
+#: Keep spec json and spec folder listings in memory between calls, the resident service turns this on.
+#: Files and folders are read again when their modification time or size changes and after saves made here
+CACHE_SPECS = False
+#: json path to ((mtime, size), text)
+_json_cache = {}
+#: folder to (mtime, file names)
+_folder_cache = {}
+
+
+class UPDATE_CYCLES(object):
+    """Values for the update_cycle of a feature spec."""
+    DAY = 'day'
+    WEEK = 'week'
+    MONTH = 'month'
+    QUARTER = 'quarter'
+    BIANNUAL = 'biannual'
+    ANNUAL = 'annual'
+    NEVER = 'never'
+    DEMAND = 'demand'
+
+
+def get_store():
+    """The spec_store.SpecStore for SPEC_DB or None when specs are json files."""
+    if SPEC_DB is None:
+        return None
+    if SPEC_DB not in _stores:
+        _stores[SPEC_DB] = spec_store.SpecStore(SPEC_DB)
+
+    return _stores[SPEC_DB]
+
+
+@contextmanager
+def transaction():
+    """Save several specs together when specs are in SPEC_DB. Json specs are saved as each one is written."""
+    store = get_store()
+    if store is None:
+        yield
+    else:
+        with store.transaction():
+            yield
+
+
+def save_specs(specs):
+    """Save specs in one transaction."""
+    with transaction():
+        for spec in specs:
+            save_spec_json(spec)
 
 
 def valitdate_spec(spec):
@@ -16,27 +76,140 @@ def valitdate_spec(spec):
         raise Exception(msg)
 
 
+def _spec_file_name(spec):
+    if 'sgid_name' in spec:
+        return create_feature_spec_name(spec['sgid_name'])
+
+    return spec['name'] + '.json'
+
+
 def save_spec_json(spec, json_path=None):
+    """Save spec to SPEC_DB or its json file. json_path always writes json."""
     save_path = json_path
+    if save_path is None and get_store() is not None:
+        get_store().save(spec, _spec_file_name(spec))
+        return
     if save_path is None:
-        folder = None
-        file_name = None
-        if 'sgid_name' in spec:
-            folder = FEATURE_SPEC_FOLDER
-            file_name = create_feature_spec_name(spec['sgid_name'])
+        save_path = _spec_path(spec)
+
+    with spec_lock(save_path):
+        locks.atomic_write(save_path, spec_store.dumps(spec))
+        _forget(save_path)
+
+
+def _spec_path(spec):
+    folder = FEATURE_SPEC_FOLDER if 'sgid_name' in spec else PACKAGE_SPEC_FOLDER
+
+    return os.path.join(folder, _spec_file_name(spec))
+
+
+def spec_lock(json_path):
+    """
+    locks.FileLock for the json spec at json_path, matched without case like spec file names.
+
+    Hold it around reading, changing and saving a spec so other threads and processes do not overwrite the change.
+    """
+    folder, file_name = os.path.split(json_path)
+    return locks.FileLock(os.path.join(folder, LOCK_FOLDER, file_name.lower() + '.lock'), timeout=LOCK_TIMEOUT)
+
+
+def update_spec(spec, change):
+    """
+    Read the latest saved copy of spec, apply change to it and save it while holding the spec lock.
+
+    spec: feature or package spec, saved as is when it has not been saved before
+    change: function that edits a spec dict in place
+    returns: the saved spec
+    """
+    store = get_store()
+    if store is not None:
+        with store.transaction():
+            current = store.get(spec_store.kind_of(spec), _spec_file_name(spec)) or copy.deepcopy(spec)
+            change(current)
+            store.save(current, _spec_file_name(spec))
+        return current
+
+    path = _spec_path(spec)
+    if 'sgid_name' in spec:
+        path = _find_spec_path(FEATURE_SPEC_FOLDER, os.path.basename(path))
+    with spec_lock(path):
+        current = load_feature_json(path) if os.path.exists(path) else copy.deepcopy(spec)
+        change(current)
+        locks.atomic_write(path, spec_store.dumps(current))
+        _forget(path)
+
+    return current
+
+
+def merge_changes(current, spec, base):
+    """
+    Apply the edits made to spec since it was loaded as base onto current.
+
+    Lists such as packages and parent_ids keep items other writers added or removed, values that were changed
+    replace the current ones and other keys are left alone.
+    """
+    for key, value in spec.items():
+        if key in base and base[key] == value:
+            continue
+        if isinstance(value, list) and isinstance(base.get(key), list) and isinstance(current.get(key), list):
+            removed = [item for item in base[key] if item not in value]
+            added = [item for item in value if item not in base[key]]
+            current[key] = [item for item in current[key] if item not in removed]
+            current[key].extend(item for item in added if item not in current[key])
         else:
-            folder = PACKAGE_SPEC_FOLDER
-            file_name = spec['name'] + '.json'
+            current[key] = copy.deepcopy(value)
+    for key in base:
+        if key not in spec:
+            current.pop(key, None)
+
+    return current
+
+
+def save_spec_changes(spec, base):
+    """
+    Save the edits made to spec since it was loaded as base without losing edits saved by others since then.
 
-        save_path = os.path.join(folder,
-                                 file_name)
+    base: deep copy of spec taken when it was loaded
+    returns: the saved spec, spec and base are updated to match it so later edits can be saved the same way
+    """
+    saved = update_spec(spec, lambda current: merge_changes(current, spec, base))
+    for edited in (spec, base):
+        edited.clear()
+        edited.update(copy.deepcopy(saved))
 
-    with open(save_path, 'w') as f_out:
-        f_out.write(json.dumps(spec, sort_keys=True, indent=4))
-        f_out.write('\n')
+    return saved
+
+
+def _forget(json_path):
+    """Drop cached copies of a spec file and its folder listing after it is written or deleted."""
+    _json_cache.pop(json_path, None)
+    _folder_cache.pop(os.path.dirname(json_path), None)
+
+
+def _folder_files(folder):
+    """Names in folder, from the cache while the folder is unchanged when CACHE_SPECS is on."""
+    if not os.path.exists(folder):
+        return []
+    if not CACHE_SPECS:
+        return os.listdir(folder)
+    mtime = os.stat(folder).st_mtime_ns
+    cached = _folder_cache.get(folder)
+    if cached is None or cached[0] != mtime:
+        cached = _folder_cache[folder] = (mtime, os.listdir(folder))
+
+    return list(cached[1])
 
 
 def load_feature_json(json_path):
+    """Load a spec, each call returns a new dict even when CACHE_SPECS keeps the file text in memory."""
+    if CACHE_SPECS:
+        status = os.stat(json_path)
+        key = (status.st_mtime_ns, status.st_size)
+        cached = _json_cache.get(json_path)
+        if cached is None or cached[0] != key:
+            with open(json_path, 'r') as json_file:
+                cached = _json_cache[json_path] = (key, json_file.read())
+        return json.loads(cached[1])
     with open(json_path, 'r') as json_file:
         feature = json.load(json_file)
 
@@ -44,6 +217,9 @@ def load_feature_json(json_path):
 
 
 def delete_spec_json(spec):
+    if get_store() is not None:
+        get_store().delete(spec_store.kind_of(spec), _spec_file_name(spec))
+        return
     folder = None
     file_name = None
     if 'sgid_name' in spec:
@@ -56,6 +232,7 @@ def delete_spec_json(spec):
     delete_path = os.path.join(folder,
                                file_name)
     os.remove(delete_path)
+    _forget(delete_path)
 
 
 def create_feature_spec_name(source_name):
@@ -65,7 +242,11 @@ def create_feature_spec_name(source_name):
 
 def create_package_spec(name, feature_classes, category):
     json_path = os.path.join(PACKAGE_SPEC_FOLDER, name + '.json')
-    if not os.path.exists(os.path.join('packages', name + '.json')):
+    if get_store() is not None:
+        exists = get_store().get(spec_store.PACKAGE, name + '.json') is not None
+    else:
+        exists = os.path.exists(os.path.join('packages', name + '.json'))
+    if not exists:
         empty_spec = PACKAGE_SPEC_TEMPLATE
         package = load_feature_json(empty_spec)
         package['name'] = name
@@ -85,7 +266,11 @@ def get_package(package_name):
     package_spec = os.path.join(PACKAGE_SPEC_FOLDER, spec_name)
 
     package = None
-    if not os.path.exists(package_spec):
+    if get_store() is not None:
+        package = get_store().get(spec_store.PACKAGE, spec_name)
+        if package is None:
+            raise Exception('Package spec does not exist in {}: {}'.format(SPEC_DB, package_name))
+    elif not os.path.exists(package_spec):
         msg = 'Package spec does not exist at {}'.format(package_spec)
         raise Exception(msg)
     else:
@@ -95,135 +280,187 @@ def get_package(package_name):
     return package
 
 
+def _find_spec_path(folder, spec_name):
+    """Path to spec_name in folder matched without case like it is on Windows."""
+    spec_path = os.path.join(folder, spec_name)
+    if not os.path.exists(spec_path):
+        for filename in _folder_files(folder):
+            if filename.lower() == spec_name.lower():
+                return os.path.join(folder, filename)
+
+    return spec_path
+
+
+def _load_feature(source_name):
+    """Saved spec for source_name from SPEC_DB or the feature spec folder, None when there is none."""
+    if get_store() is not None:
+        return get_store().get(spec_store.FEATURE, create_feature_spec_name(source_name))
+    feature_spec = _find_spec_path(FEATURE_SPEC_FOLDER, create_feature_spec_name(source_name))
+    if not os.path.exists(feature_spec):
+        return None
+    try:
+        return load_feature_json(feature_spec)
+    except ValueError as e:
+        print('!bad json!:', source_name)
+        raise(e)
+
+
 def get_feature(source_name, packages=[]):
     empty_spec = FEATURE_SPEC_TEMPLATE
-    spec_name = create_feature_spec_name(source_name)
-    feature_spec = os.path.join(FEATURE_SPEC_FOLDER, spec_name)
-    feature = None
-    if not os.path.exists(feature_spec):
+    feature = _load_feature(source_name)
+    if feature is None:
         feature = load_feature_json(empty_spec)
         feature['sgid_name'] = source_name
         feature['name'] = source_name.split('.')[-1]
         feature['category'] = source_name.split('.')[-2]
-        feature['packages'].extend(packages)
-    else:
-        try:
-            feature = load_feature_json(feature_spec)
-        except ValueError as e:
-            print('!bad json!:', source_name)
-            raise(e)
+
+    def add_packages(current):
         for p in packages:
-            if p not in feature['packages']:
-                feature['packages'].append(p)
-    valitdate_spec(feature)
-    save_spec_json(feature)
-    return feature
+            if p not in current['packages']:
+                current['packages'].append(p)
+        valitdate_spec(current)
+
+    # Saved under the spec lock so a spec saved by another run since it was read is not overwritten
+    return update_spec(feature, add_packages)
 
 
 def get_package_spec_path_list():
     packages = []
-    for _, _, files in os.walk(PACKAGE_SPEC_FOLDER):
-        for filename in files:
-            if filename == '.DS_Store':
-                continue
-            packages.append(os.path.join(PACKAGE_SPEC_FOLDER, filename))
-        break
+    for filename in _folder_files(PACKAGE_SPEC_FOLDER):
+        if not filename.endswith('.json'):
+            continue
+        packages.append(os.path.join(PACKAGE_SPEC_FOLDER, filename))
     return packages
 
 
 def get_feature_spec_path_list():
     features = []
-    for _, _, files in os.walk(FEATURE_SPEC_FOLDER):
-        for filename in files:
-            if filename == '.DS_Store':
-                continue
-            features.append(os.path.join(FEATURE_SPEC_FOLDER, filename))
-        break
+    for filename in _folder_files(FEATURE_SPEC_FOLDER):
+        if not filename.endswith('.json'):
+            continue
+        features.append(os.path.join(FEATURE_SPEC_FOLDER, filename))
     return features
 
 
-def get_feature_specs(changed_tables):
-    feature_specs = []
+@profiling.memory_stage('get_feature_spec_index')
+def get_feature_spec_index():
+    """Map lowercase sgid_name to feature spec for every feature spec."""
+    if get_store() is not None:
+        return dict((spec['sgid_name'].lower(), spec) for spec in get_store().specs(spec_store.FEATURE))
+    index = {}
     for f in get_feature_spec_path_list():
         spec = load_feature_json(f)
-        if spec['sgid_name'].lower() in changed_tables:
-            feature_specs.append(spec)
+        index[spec['sgid_name'].lower()] = spec
 
-    return feature_specs
+    return index
 
 
-def get_package_specs(changed_tables):
-    package_specs = []
-    for p in get_package_spec_path_list():
-        spec = load_feature_json(p)
-        changed = False
+def get_package_spec_index():
+    """Map lowercase feature class name to the package specs that contain it."""
+    index = {}
+    for spec in get_package_specs():
         for feature_class in spec['feature_classes']:
-            if feature_class.lower() in changed_tables:
-                changed = True
-                break
-        if changed:
-            package_specs.append(spec)
+            index.setdefault(feature_class.lower(), []).append(spec)
+
+    return index
+
+
+def get_drive_id_index(feature_specs=None, package_specs=None):
+    """Map each drive id in specs to (spec, key) where key is gdb_id, shape_id, hash_id, delta_id or parent_ids."""
+    if feature_specs is None:
+        feature_specs = get_feature_specs()
+    if package_specs is None:
+        package_specs = get_package_specs()
+    index = {}
+    for spec in list(feature_specs) + list(package_specs):
+        for key in ('gdb_id', 'shape_id', 'hash_id', 'delta_id'):
+            if spec.get(key):
+                index[spec[key]] = (spec, key)
+        for parent_id in spec['parent_ids']:
+            index.setdefault(parent_id, (spec, 'parent_ids'))
+
+    return index
+
+
+def get_feature_specs(changed_tables=None):
+    """
+    Get feature specs for changed_tables or every feature spec when changed_tables is None.
 
-    return package_specs
+    changed_tables: iterable of lowercase sgid names such as the set from zip_loader.get_changed_tables
+    """
+    index = get_feature_spec_index()
+    if changed_tables is None:
+        return list(index.values())
+
+    return [index[name] for name in sorted(set(changed_tables)) if name in index]
+
+
+@profiling.memory_stage('get_package_specs')
+def get_package_specs(changed_tables=None):
+    """
+    Get package specs containing any of changed_tables or every package spec when changed_tables is None.
+
+    changed_tables: iterable of lowercase sgid names such as the set from zip_loader.get_changed_tables
+    """
+    if get_store() is not None:
+        if changed_tables is None:
+            return get_store().specs(spec_store.PACKAGE)
+        return get_store().packages_containing(changed_tables)
+    if changed_tables is None:
+        return [load_feature_json(p) for p in get_package_spec_path_list()]
+
+    index = get_package_spec_index()
+    package_specs = {}
+    for name in sorted(set(changed_tables)):
+        for spec in index.get(name, []):
+            package_specs[spec['name']] = spec
+
+    return [package_specs[name] for name in sorted(package_specs)]
 
 
 def add_update():
-    for f in get_feature_spec_path_list():
-        spec = load_feature_json(f)
-        if 'update_cycle' not in spec:
-            spec['update_cycle'] = ""
-            save_spec_json(spec)
+    with transaction():
+        for spec in get_feature_specs():
+            if 'update_cycle' not in spec:
+                spec['update_cycle'] = ""
+                save_spec_json(spec)
 
 
 def _list_packages_with_nonexistant_features(workspace, package_list=None):
     """List packages with features that do not exist in the workspace."""
-    import arcpy
-    bad_features = []
-    bad_packages = {}
+    import workspace_index
     packages_to_check = package_list
-    if package_list is None:
+    if packages_to_check is None:
         packages_to_check = get_package_spec_path_list()
 
+    package_specs = []
     for p in packages_to_check:
         if not p.endswith('.json'):
             p += '.json'
-        packages_spec = get_package(os.path.basename(p))
-        fcs = packages_spec['feature_classes']
-        if fcs != '' and len(fcs) > 0:
-            for f in fcs:
-                if f in bad_features or not arcpy.Exists(os.path.join(workspace, f)):
-                    if f not in bad_features:
-                        print(f)
-                        bad_features.append(f)
-                    if p not in bad_packages:
-                        bad_packages[p] = []
-                    bad_packages[p].append(f)
-    print
-    for p in bad_packages:
-        print(p)
-        for f in bad_packages[p]:
-            print(' ', f)
+        package_specs.append(get_package(os.path.basename(p)))
+    feature_classes = [f for spec in package_specs if spec['feature_classes'] != '' for f in spec['feature_classes']]
+    problems = workspace_index.WorkspaceIndex(workspace).scan().check(feature_classes)
+    workspace_index.print_missing_table(workspace_index.get_missing_rows(problems, package_specs=package_specs))
 
 
 def _list_nonexistant_features(workspace):
     """List features that do not exist in the workspace."""
-    import arcpy
-    bad_features = []
-    features_to_check = get_feature_specs()
-    for feature_spec in features_to_check:
-        fc = feature_spec['sgid_name']
-        if fc in bad_features or not arcpy.Exists(os.path.join(workspace, fc)):
-            if fc in bad_features:
-                print('TWICE!!!!', fc)
-            bad_features.append(fc)
-
-    for f in bad_features:
-        print(f)
+    import workspace_index
+    feature_specs = get_feature_specs()
+    sgid_names = set()
+    for spec in feature_specs:
+        if spec['sgid_name'] in sgid_names:
+            print('TWICE!!!!', spec['sgid_name'])
+        sgid_names.add(spec['sgid_name'])
+    problems = workspace_index.WorkspaceIndex(workspace).scan().check(sgid_names)
+    workspace_index.print_missing_table(workspace_index.get_missing_rows(problems, feature_specs=feature_specs))
 
 
 def _clear_driveids(path, spec):
     if 'hash_id' in spec:
         spec['hash_id'] = ''
+    if 'delta_id' in spec:
+        spec['delta_id'] = ''
 
     spec['gdb_id'] = ''
     spec['shape_id'] = ''
@@ -232,13 +469,30 @@ def _clear_driveids(path, spec):
 
 
 def clear_all_drive_ids():
-    for path in get_feature_spec_path_list():
-        spec = load_feature_json(path)
-        _clear_driveids(path, spec)
+    with transaction():
+        for spec in get_feature_specs():
+            _clear_driveids(None, spec)
+
+        for spec in get_package_specs():
+            _clear_driveids(None, spec)
+
+
+def import_spec_db(db_path):
+    """Load the feature and package json folders into a spec_store database, replacing what it held."""
+    store = spec_store.SpecStore(db_path)
+    features = store.import_folder(spec_store.FEATURE, FEATURE_SPEC_FOLDER)
+    packages = store.import_folder(spec_store.PACKAGE, PACKAGE_SPEC_FOLDER)
+    store.close()
+    print('Imported {} features and {} packages into {}'.format(features, packages, db_path))
+
 
-    for path in get_package_spec_path_list():
-        spec = load_feature_json(path)
-        _clear_driveids(path, spec)
+def export_spec_db(db_path):
+    """Write a spec_store database back to the feature and package json folders for review in git."""
+    store = spec_store.SpecStore(db_path)
+    features = store.export_folder(spec_store.FEATURE, FEATURE_SPEC_FOLDER)
+    packages = store.export_folder(spec_store.PACKAGE, PACKAGE_SPEC_FOLDER)
+    store.close()
+    print('Exported {} features and {} packages from {}'.format(features, packages, db_path))
 
 
 if __name__ == '__main__':
@@ -246,9 +500,17 @@ if __name__ == '__main__':
 
     parser.add_argument('-c', action='store_true', dest='create',
                         help='Create a feature spec if it does not exist')
-    parser.add_argument('source_name', action='store',
+    parser.add_argument('--import_db', action='store', dest='import_db',
+                        help='Copy the json spec folders into a SQLite spec database')
+    parser.add_argument('--export_db', action='store', dest='export_db',
+                        help='Write a SQLite spec database back to the json spec folders')
+    parser.add_argument('source_name', action='store', nargs='?',
                         help='Source name for the feature')
 
     args = parser.parse_args()
+    if args.import_db:
+        import_spec_db(args.import_db)
+    if args.export_db:
+        export_spec_db(args.export_db)
     if args.create:
         get_feature(args.source_name, create=True)
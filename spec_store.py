@@ -0,0 +1,236 @@
+"""Keep feature and package specs in one SQLite database with import from and export to the json spec folders"""
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+FEATURE = 'feature'
+PACKAGE = 'package'
+ID_KEYS = ('gdb_id', 'shape_id', 'hash_id', 'delta_id')
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS specs (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    name TEXT,
+    sgid_name TEXT,
+    category TEXT,
+    gdb_id TEXT,
+    shape_id TEXT,
+    hash_id TEXT,
+    delta_id TEXT,
+    spec TEXT NOT NULL,
+    PRIMARY KEY (kind, key)
+);
+CREATE INDEX IF NOT EXISTS specs_sgid_name ON specs (sgid_name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS specs_category ON specs (kind, category);
+CREATE INDEX IF NOT EXISTS specs_gdb_id ON specs (gdb_id);
+CREATE INDEX IF NOT EXISTS specs_shape_id ON specs (shape_id);
+CREATE INDEX IF NOT EXISTS specs_hash_id ON specs (hash_id);
+CREATE INDEX IF NOT EXISTS specs_delta_id ON specs (delta_id);
+CREATE TABLE IF NOT EXISTS package_features (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    package TEXT NOT NULL,
+    feature TEXT NOT NULL,
+    PRIMARY KEY (kind, key, package, feature)
+);
+CREATE INDEX IF NOT EXISTS package_features_feature ON package_features (feature);
+"""
+
+
+def dumps(spec):
+    """Spec json text exactly as spec_manager.save_spec_json writes it."""
+    return json.dumps(spec, sort_keys=True, indent=4) + '\n'
+
+
+def kind_of(spec):
+    return FEATURE if 'sgid_name' in spec else PACKAGE
+
+
+def spec_name(spec):
+    """Lowercase sgid_name for features and name for packages."""
+    return spec['sgid_name'].lower() if kind_of(spec) == FEATURE else spec['name'].lower()
+
+
+def _memberships(spec):
+    """(package, feature) pairs in lower case for the package lists in spec."""
+    if kind_of(spec) == FEATURE:
+        return [(p.lower(), spec['sgid_name'].lower()) for p in spec['packages']]
+    feature_classes = spec['feature_classes'] if spec['feature_classes'] != '' else []
+
+    return [(spec['name'].lower(), f.lower()) for f in feature_classes]
+
+
+class SpecStore(object):
+    """
+    Specs in a SQLite database.
+
+    Specs are keyed by their lowercase json file name, the same way spec_manager finds json specs, and kept as
+    their json text so an export writes back the same files that were imported. sgid_name, category, drive ids and
+    package membership are copied to indexed columns for lookups.
+    path: database file, created when it does not exist
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        #: WAL lets readers continue while a transaction writes
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+        self._lock = threading.RLock()
+        self._depth = 0
+
+    def close(self):
+        self.connection.close()
+
+    @contextmanager
+    def transaction(self):
+        """Apply every save and delete in the block together or not at all. Nested blocks join the outer one."""
+        with self._lock:
+            if self._depth:
+                self._depth += 1
+                try:
+                    yield self
+                finally:
+                    self._depth -= 1
+                return
+            self.connection.execute('BEGIN IMMEDIATE')
+            self._depth = 1
+            try:
+                yield self
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            else:
+                self.connection.execute('COMMIT')
+            finally:
+                self._depth = 0
+
+    def save(self, spec, file_name, text=None):
+        """
+        Insert or replace spec.
+
+        file_name: json file name such as spec_manager.create_feature_spec_name gives, matched without case
+        text: json text to keep instead of dumps(spec), used by import to keep files byte for byte
+        """
+        kind = kind_of(spec)
+        key = file_name.lower()
+        with self.transaction():
+            row = self.connection.execute('SELECT file_name FROM specs WHERE kind = ? AND key = ?',
+                                          (kind, key)).fetchone()
+            self.connection.execute(
+                'INSERT OR REPLACE INTO specs '
+                '(kind, key, file_name, name, sgid_name, category, gdb_id, shape_id, hash_id, delta_id, spec) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (kind, key, row[0] if row else file_name, spec.get('name'), spec.get('sgid_name'),
+                 spec.get('category')) + tuple(spec.get(id_key) or None for id_key in ID_KEYS) +
+                (text if text is not None else dumps(spec),))
+            self.connection.execute('DELETE FROM package_features WHERE kind = ? AND key = ?', (kind, key))
+            self.connection.executemany('INSERT OR IGNORE INTO package_features VALUES (?, ?, ?, ?)',
+                                        [(kind, key) + pair for pair in _memberships(spec)])
+
+    def delete(self, kind, file_name):
+        with self.transaction():
+            for table in ('specs', 'package_features'):
+                self.connection.execute('DELETE FROM {} WHERE kind = ? AND key = ?'.format(table),
+                                        (kind, file_name.lower()))
+
+    def get(self, kind, file_name):
+        """Spec dict saved under file_name or None."""
+        with self._lock:
+            row = self.connection.execute('SELECT spec FROM specs WHERE kind = ? AND key = ?',
+                                          (kind, file_name.lower())).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+    def specs(self, kind, names=None, category=None):
+        """
+        Specs of one kind ordered by file name.
+
+        names: only specs with these sgid names for features or names for packages, without case
+        category: only specs in this category
+        """
+        query = 'SELECT spec FROM specs WHERE kind = ?'
+        values = [kind]
+        if category is not None:
+            query += ' AND category = ? COLLATE NOCASE'
+            values.append(category)
+        with self._lock:
+            specs = [json.loads(row[0]) for row in self.connection.execute(query + ' ORDER BY key', values)]
+        if names is not None:
+            names = set(n.lower() for n in names)
+            specs = [spec for spec in specs if spec_name(spec) in names]
+
+        return specs
+
+    def packages_containing(self, sgid_names):
+        """Package specs whose feature_classes list any of sgid_names, ordered by name."""
+        sgid_names = sorted(set(n.lower() for n in sgid_names))
+        packages = set()
+        with self._lock:
+            for start in range(0, len(sgid_names), 500):
+                chunk = sgid_names[start:start + 500]
+                query = 'SELECT DISTINCT package FROM package_features WHERE kind = ? AND feature IN ({})'
+                packages.update(row[0] for row in self.connection.execute(
+                    query.format(', '.join('?' * len(chunk))), [PACKAGE] + chunk))
+
+        return self.specs(PACKAGE, names=packages)
+
+    def find_drive_id(self, drive_id):
+        """(spec, id key) for the spec holding drive_id in gdb_id, shape_id, hash_id or delta_id, or None."""
+        with self._lock:
+            for id_key in ID_KEYS:
+                row = self.connection.execute('SELECT spec FROM specs WHERE {} = ?'.format(id_key),
+                                              (drive_id,)).fetchone()
+                if row:
+                    return json.loads(row[0]), id_key
+
+        return None
+
+    def count(self, kind):
+        with self._lock:
+            return self.connection.execute('SELECT COUNT(*) FROM specs WHERE kind = ?', (kind,)).fetchone()[0]
+
+    def import_folder(self, kind, folder):
+        """Replace every spec of kind with the json files in folder in one transaction. Returns the number imported."""
+        names = sorted(name for name in os.listdir(folder) if name.endswith('.json'))
+        with self.transaction():
+            self.connection.execute('DELETE FROM specs WHERE kind = ?', (kind,))
+            self.connection.execute('DELETE FROM package_features WHERE kind = ?', (kind,))
+            for name in names:
+                with open(os.path.join(folder, name), 'r') as json_file:
+                    text = json_file.read()
+                try:
+                    spec = json.loads(text)
+                except ValueError:
+                    raise Exception('Invalid json in spec {}'.format(os.path.join(folder, name)))
+                if kind_of(spec) != kind:
+                    raise Exception('Not a {} spec: {}'.format(kind, os.path.join(folder, name)))
+                self.save(spec, name, text)
+
+        return len(names)
+
+    def export_folder(self, kind, folder):
+        """
+        Write each spec of kind to folder as json and delete json files of specs that are not in the database.
+
+        returns: number of specs written
+        """
+        with self._lock:
+            rows = self.connection.execute('SELECT file_name, spec FROM specs WHERE kind = ? ORDER BY key',
+                                           (kind,)).fetchall()
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        written = set()
+        for file_name, text in rows:
+            with open(os.path.join(folder, file_name), 'w') as f_out:
+                f_out.write(text)
+            written.add(file_name)
+        for name in os.listdir(folder):
+            if name.endswith('.json') and name not in written:
+                os.remove(os.path.join(folder, name))
+
+        return len(rows)
@@ -0,0 +1,216 @@
+"""Report Drive storage for SGID features, packages and categories from a listing of the SGID folders"""
+import argparse
+import csv
+import json
+import os
+from datetime import datetime
+
+import spec_manager
+
+#: zip_loader.UTM_DRIVE_FOLDER and zip_loader.HASH_DRIVE_FOLDER
+SGID_FOLDER_IDS = ('0ByStJjVZ7c7mNlZRd2ZYOUdyX2M', '0ByStJjVZ7c7mMVRpZjlVdVZ5Y0E')
+SNAPSHOT_FOLDER = 'data/drive_snapshots'
+REPORT_FOLDER = 'data/storage'
+SNAPSHOT_FIELDS = 'id, name, mimeType, parents, size, md5Checksum, modifiedTime'
+FOLDER_MIME = 'application/vnd.google-apps.folder'
+#: Folders listed together in one files.list query while walking the SGID folders
+PARENTS_PER_QUERY = 40
+
+
+def _parent_query(parent_ids):
+    return 'trashed=false and ({})'.format(' or '.join("'{}' in parents".format(i) for i in parent_ids))
+
+
+def get_snapshot(drive, root_ids=SGID_FOLDER_IDS):
+    """
+    List the files under root_ids, walking the folder tree breadth first.
+
+    Each level is listed with queries for up to PARENTS_PER_QUERY parent folders at a time, so the cost follows the
+    size of the SGID folders and not of everything the account can see.
+    drive: driver.AgrcDriver
+    returns: {'taken': iso time, 'files': {id: file}} with size as an int
+    """
+    files = {}
+    seen = set(root_ids)
+    level = list(root_ids)
+    while level:
+        next_level = []
+        for start in range(0, len(level), PARENTS_PER_QUERY):
+            query = _parent_query(level[start:start + PARENTS_PER_QUERY])
+            for f in drive.list_files(query=query, fields=SNAPSHOT_FIELDS):
+                f['size'] = int(f.get('size', 0))
+                files[f['id']] = f
+                if f.get('mimeType') == FOLDER_MIME and f['id'] not in seen:
+                    seen.add(f['id'])
+                    next_level.append(f['id'])
+        level = next_level
+
+    return {'taken': datetime.now().isoformat(), 'files': files}
+
+
+def snapshot_name(taken):
+    """File name without .json for a snapshot taken at the iso time taken, names sort in the order taken."""
+    return taken[:19].replace(':', '')
+
+
+def save_snapshot(snapshot, folder=SNAPSHOT_FOLDER):
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    path = os.path.join(folder, snapshot_name(snapshot['taken']) + '.json')
+    with open(path, 'w') as f_out:
+        json.dump(snapshot, f_out, sort_keys=True)
+
+    return path
+
+
+def load_snapshot(path):
+    with open(path, 'r') as json_file:
+        return json.load(json_file)
+
+
+def list_snapshots(folder=SNAPSHOT_FOLDER):
+    if not os.path.exists(folder):
+        return []
+
+    return sorted(os.path.join(folder, name) for name in os.listdir(folder) if name.endswith('.json'))
+
+
+def load_latest_snapshot(folder=SNAPSHOT_FOLDER, before=None):
+    """Most recent saved snapshot, or the most recent taken before the iso date or time string before."""
+    paths = [p for p in list_snapshots(folder)
+             if before is None or os.path.splitext(os.path.basename(p))[0] < snapshot_name(before)]
+    if not paths:
+        return None
+
+    return load_snapshot(paths[-1])
+
+
+def build_report(snapshot, feature_specs, package_specs):
+    """
+    Total bytes per feature, package and category.
+
+    Package totals are the zips filed in the package gdb and shape folders.
+    Category totals count each feature zip once.
+    """
+    files = snapshot['files']
+    children = {}
+    for f in files.values():
+        for parent_id in f.get('parents', []):
+            children.setdefault(parent_id, []).append(f)
+
+    def size(file_id):
+        return files[file_id]['size'] if file_id in files else 0
+
+    features = {}
+    categories = {}
+    for spec in feature_specs:
+        row = {'category': spec['category'],
+               'gdb_bytes': size(spec['gdb_id']),
+               'shp_bytes': size(spec['shape_id']),
+               'hash_bytes': size(spec.get('hash_id', '')),
+               'delta_bytes': size(spec.get('delta_id', '')),
+               'missing': ' '.join(k for k in ('gdb_id', 'shape_id') if spec[k] not in files)}
+        row['total_bytes'] = row['gdb_bytes'] + row['shp_bytes'] + row['hash_bytes'] + row['delta_bytes']
+        features[spec['sgid_name']] = row
+        category = categories.setdefault(spec['category'], {'features': 0, 'total_bytes': 0})
+        category['features'] += 1
+        category['total_bytes'] += row['total_bytes']
+
+    packages = {}
+    for spec in package_specs:
+        gdb_zips = children.get(spec['gdb_id'], []) if spec['gdb_id'] else []
+        shp_zips = children.get(spec['shape_id'], []) if spec['shape_id'] else []
+        row = {'category': spec['category'],
+               'zips': len(gdb_zips) + len(shp_zips),
+               'gdb_bytes': sum(f['size'] for f in gdb_zips),
+               'shp_bytes': sum(f['size'] for f in shp_zips)}
+        row['total_bytes'] = row['gdb_bytes'] + row['shp_bytes']
+        packages[spec['name']] = row
+
+    drive_ids = spec_manager.get_drive_id_index(feature_specs, package_specs)
+    unmatched = [f for f in files.values() if f['id'] not in drive_ids and f.get('mimeType') != FOLDER_MIME]
+
+    return {'taken': snapshot['taken'],
+            'features': features,
+            'packages': packages,
+            'categories': categories,
+            'unmatched_files': len(unmatched),
+            'unmatched_bytes': sum(f['size'] for f in unmatched),
+            'total_bytes': sum(f['size'] for f in files.values())}
+
+
+def add_growth(report, previous):
+    """Add growth_bytes to each row from a report built on an earlier snapshot."""
+    report['previous'] = previous['taken'] if previous else None
+    for section in ('features', 'packages', 'categories'):
+        for name, row in report[section].items():
+            before = previous[section].get(name) if previous else None
+            row['growth_bytes'] = row['total_bytes'] - before['total_bytes'] if before else ''
+    report['growth_bytes'] = report['total_bytes'] - previous['total_bytes'] if previous else ''
+
+    return report
+
+
+def write_report(report, folder=REPORT_FOLDER):
+    """Write a csv per section and the whole report as json."""
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    for section, key in (('features', 'sgid_name'), ('packages', 'name'), ('categories', 'category')):
+        rows = report[section]
+        columns = sorted(set(c for row in rows.values() for c in row) - set([key]))
+        with open(os.path.join(folder, section + '.csv'), 'w', newline='') as out_table:
+            table = csv.writer(out_table)
+            table.writerow([key] + columns)
+            for name in sorted(rows, key=lambda n: rows[n]['total_bytes'], reverse=True):
+                table.writerow([name] + [rows[name].get(c, '') for c in columns])
+    with open(os.path.join(folder, 'storage_report.json'), 'w') as f_out:
+        f_out.write(json.dumps(report, sort_keys=True, indent=4))
+
+    return folder
+
+
+def run_report(drive=None, snapshot_path=None, output_folder=REPORT_FOLDER):
+    """Take or load a snapshot, compare it with the previous saved snapshot and write the report."""
+    if snapshot_path:
+        snapshot = load_snapshot(snapshot_path)
+    else:
+        snapshot = get_snapshot(drive)
+        print('Snapshot saved to', save_snapshot(snapshot))
+
+    feature_specs = spec_manager.get_feature_specs()
+    package_specs = spec_manager.get_package_specs()
+    report = build_report(snapshot, feature_specs, package_specs)
+    previous_snapshot = load_latest_snapshot(before=snapshot['taken'])
+    previous = build_report(previous_snapshot, feature_specs, package_specs) if previous_snapshot else None
+    add_growth(report, previous)
+    write_report(report, output_folder)
+    print('{} files, {:.1f} MB, report written to {}'.format(len(snapshot['files']),
+                                                             report['total_bytes'] / 1048576.0,
+                                                             output_folder))
+
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report Drive storage for SGID specs')
+    parser.add_argument('--snapshot', action='store', dest='snapshot',
+                        help='Report on a saved snapshot json instead of listing Drive')
+    parser.add_argument('--output', action='store', dest='output', default=REPORT_FOLDER,
+                        help='Folder for csv and json reports')
+    args = parser.parse_args()
+
+    drive = None
+    if not args.snapshot:
+        import driver
+        api_secrets = driver.SERVICE_ACCOUNT_SECRET_FILE
+        api_oauth = False
+        if not os.path.exists(api_secrets):
+            api_secrets = driver.OAUTH_CLIENT_SECRET_FILE
+            api_oauth = True
+        api_services = driver.ApiService((driver.APIS.drive,),
+                                         secrets=api_secrets,
+                                         scopes=driver.AgrcDriver.FULL_SCOPE,
+                                         use_oauth=api_oauth)
+        drive = driver.AgrcDriver(api_services.services[0])
+
+    run_report(drive, args.snapshot, args.output)
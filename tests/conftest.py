@@ -0,0 +1,5 @@
+"""Offline stand-ins for arcpy and the Drive and Sheets services so zip_loader imports without ArcGIS or Google."""
+from benchmarks import fake_arcpy, fake_drive
+
+fake_arcpy.install()
+fake_drive.install(fake_drive.FakeServer())
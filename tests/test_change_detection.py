@@ -0,0 +1,65 @@
+import json
+from datetime import date
+
+import pytest
+
+import spec_manager
+import zip_loader
+
+
+@pytest.fixture
+def change_table(tmp_path):
+    path = str(tmp_path / 'changes.csv')
+    with open(path, 'w') as f_out:
+        f_out.write('table_name,last_modified\n')
+        f_out.write('SGID.BOUNDARIES.Counties,2024-03-04 22:15:00\n')
+        f_out.write('SGID.Water.StreamsNHD,2024-03-06\n')
+        f_out.write('SGID.TRANSPORTATION.Roads,2024-03-07\n')
+        f_out.write('SGID.Society.Schools,2024-03-01\n')
+    return path
+
+
+@pytest.fixture
+def feature_specs(tmp_path, monkeypatch):
+    folder = tmp_path / 'features'
+    folder.mkdir()
+    for category, name in (('BOUNDARIES', 'Counties'), ('WATER', 'StreamsNHD'), ('SOCIETY', 'Schools')):
+        spec = {'category': category, 'name': name, 'sgid_name': 'SGID.{}.{}'.format(category, name),
+                'gdb_id': '', 'shape_id': '', 'hash_id': '', 'packages': [], 'parent_ids': []}
+        with open(str(folder / '{}_{}.json'.format(category, name)), 'w') as f_out:
+            json.dump(spec, f_out)
+    monkeypatch.setattr(spec_manager, 'FEATURE_SPEC_FOLDER', str(folder))
+
+
+def test_changed_tables_in_window(change_table):
+    changed = zip_loader.get_changed_tables(None, date(2024, 3, 4), date(2024, 3, 6), change_table)
+
+    assert changed == {'sgid.boundaries.counties', 'sgid.water.streamsnhd'}
+
+
+def test_changed_tables_default_to_end_date(change_table):
+    assert zip_loader.get_changed_tables(None, end_date=date(2024, 3, 7), change_table=change_table) == \
+        {'sgid.transportation.roads'}
+
+
+def test_changed_tables_outside_window(change_table):
+    assert zip_loader.get_changed_tables(None, date(2024, 3, 8), date(2024, 3, 9), change_table) == set()
+
+
+def test_changed_tables_resolve_to_specs(change_table, feature_specs):
+    changed = zip_loader.get_changed_tables(None, date(2024, 3, 1), date(2024, 3, 7), change_table)
+    index = spec_manager.get_feature_spec_index()
+
+    assert sorted(name for name in changed if name in index) == ['sgid.boundaries.counties',
+                                                                 'sgid.society.schools',
+                                                                 'sgid.water.streamsnhd']
+    assert [spec['sgid_name'] for spec in spec_manager.get_feature_specs(changed)] == ['SGID.BOUNDARIES.Counties',
+                                                                                       'SGID.SOCIETY.Schools',
+                                                                                       'SGID.WATER.StreamsNHD']
+
+
+def test_select_features_by_category(change_table, feature_specs):
+    features = zip_loader.select_features(None, category='water', since=date(2024, 3, 1), until=date(2024, 3, 7),
+                                          change_table=change_table)
+
+    assert features == ['SGID.WATER.StreamsNHD']
@@ -0,0 +1,75 @@
+import json
+from datetime import date
+
+import numpy as np
+
+import delta
+import manifest
+import rowhash
+
+
+def get_block(keys, hashes, names, wkbs=None):
+    rows = np.array([(name,) for name in names], dtype=[('NAME', '<U10')])
+    return rowhash.Block(np.array(keys, dtype=np.int64), np.array(hashes, dtype=np.uint64), rows, ['NAME'], wkbs)
+
+
+def read_changeset(path):
+    with open(path) as f_in:
+        lines = [json.loads(line) for line in f_in]
+    return lines[0], lines[1:]
+
+
+def test_is_delta_feature():
+    assert delta.is_delta_feature({'delta': True, 'primary_key': 'UNIQUE_ID'})
+    assert not delta.is_delta_feature({'delta': True})
+    assert not delta.is_delta_feature({'primary_key': 'UNIQUE_ID'})
+
+
+def test_needs_full_refresh():
+    baseline = {'base': date(2024, 3, 1), 'primary_key': 'UNIQUE_ID', 'hashes': {}}
+
+    assert delta.needs_full_refresh(None, 'UNIQUE_ID', date(2024, 3, 2))
+    assert delta.needs_full_refresh(baseline, 'OTHER_ID', date(2024, 3, 2))
+    assert not delta.needs_full_refresh(baseline, 'UNIQUE_ID', date(2024, 3, 7))
+    assert delta.needs_full_refresh(baseline, 'UNIQUE_ID', date(2024, 3, 8))
+    assert delta.needs_full_refresh(baseline, 'UNIQUE_ID', date(2024, 3, 3), full_refresh_days=2)
+
+
+def test_write_changeset(tmp_path):
+    baseline = {'base': date(2024, 3, 1), 'primary_key': 'UNIQUE_ID', 'hashes': {1: 10, 2: 20, 3: 30}}
+    path = str(tmp_path / 'changes.jsonl')
+    blocks = [get_block([1, 2], [10, 21], ['a', 'b'], [b'\x01', b'\x02']), get_block([4], [40], ['d'], [None])]
+
+    counts = delta.write_changeset(blocks, baseline, path, {'sgid_name': 'SGID.WATER.StreamsNHD'})
+
+    header, rows = read_changeset(path)
+    assert (counts['insert'], counts['update'], counts['delete']) == (1, 1, 1)
+    assert counts['rows'] == 3
+    assert counts['duplicate_keys'] == 0
+    assert counts['hashes'] == [(1, 10), (2, 21), (4, 40)]
+    assert header['sgid_name'] == 'SGID.WATER.StreamsNHD'
+    assert header['version'] == delta.FORMAT_VERSION
+    assert rows == [{'op': 'update', 'key': 2, 'attributes': {'NAME': 'b'}, 'wkb': '02'},
+                    {'op': 'insert', 'key': 4, 'attributes': {'NAME': 'd'}, 'wkb': None},
+                    {'op': 'delete', 'key': 3}]
+    assert delta.change_ratio(counts, baseline) == 1.0
+
+
+def test_write_changeset_counts_duplicate_keys(tmp_path):
+    counts = delta.write_changeset([get_block([1, 1], [10, 11], ['a', 'b'])], None, str(tmp_path / 'changes.jsonl'),
+                                   {})
+
+    assert counts['insert'] == 2
+    assert counts['duplicate_keys'] == 1
+    assert delta.change_ratio(counts, None) == 1.0
+
+
+def test_load_baseline(tmp_path):
+    folder = str(tmp_path / 'manifests')
+    built = manifest.from_pairs([(1, 10), (2, 20)], 'UNIQUE_ID', created='2024-03-01T02:00:00')
+    manifest.save_cached('SGID.WATER.StreamsNHD', manifest.write(built, str(tmp_path / 'built.manifest')), folder)
+
+    assert delta.load_baseline('SGID.WATER.Missing', folder) is None
+    assert delta.load_baseline('SGID.WATER.StreamsNHD', folder) == {'base': date(2024, 3, 1),
+                                                                    'primary_key': 'UNIQUE_ID',
+                                                                    'hashes': {1: 10, 2: 20}}
@@ -0,0 +1,197 @@
+from time import sleep
+
+import pytest
+from apiclient import errors
+
+import driver
+import metrics
+import quota
+import tracing
+from benchmarks import fake_drive
+
+
+@pytest.fixture(autouse=True)
+def fresh_driver(monkeypatch):
+    """Fresh concurrency limit, breakers and tracer without shared quota files or retry sleeps."""
+    monkeypatch.setattr(driver, 'concurrency', driver.ConcurrencyLimit())
+    monkeypatch.setattr(driver, 'breakers', {'drive': driver.CircuitBreaker('drive'),
+                                             'sheets': driver.CircuitBreaker('sheets')})
+    monkeypatch.setattr(quota, 'RATES', dict((bucket, None) for bucket in quota.RATES))
+    monkeypatch.setattr(tracing, 'tracer', tracing.Tracer())
+    monkeypatch.setattr(metrics, 'registry', metrics.Registry())
+    monkeypatch.setattr(driver, 'retry_sleep', lambda backoff: None)
+
+
+def get_request(server, method='drive.files.get'):
+    return fake_drive._Request(server, method, lambda: {'id': 'fake'})
+
+
+def test_limit_increases_by_one_over_limit():
+    server = fake_drive.FakeServer()
+    expected = float(driver.INITIAL_CONCURRENCY)
+    for _ in range(10):
+        assert driver.execute(get_request(server)) == {'id': 'fake'}
+        expected = min(driver.MAX_CONCURRENCY, expected + 1.0 / expected)
+
+    assert driver.concurrency.limit == pytest.approx(expected)
+    assert int(driver.concurrency.limit) == driver.INITIAL_CONCURRENCY + 2
+    assert tracing.tracer.counters['drive.concurrency_limit'] == round(expected, 2)
+    assert 'zip_loader_drive_concurrency_limit {}'.format(round(expected, 2)) in metrics.registry.render()
+
+
+def test_limit_stops_at_maximum(monkeypatch):
+    server = fake_drive.FakeServer()
+    monkeypatch.setattr(driver, 'concurrency', driver.ConcurrencyLimit(initial=driver.MAX_CONCURRENCY - 0.01))
+    for _ in range(3):
+        driver.execute(get_request(server))
+
+    assert driver.concurrency.limit == driver.MAX_CONCURRENCY
+
+
+def test_quota_window_halves_limit(monkeypatch):
+    server = fake_drive.FakeServer(quota_calls=2, quota_window=0.05, quota_status=403)
+    # The retry waits out the quota window like the backoff does against Drive
+    monkeypatch.setattr(driver, 'retry_sleep', lambda backoff: sleep(0.06))
+    driver.execute(get_request(server))
+    driver.execute(get_request(server))
+    limit = driver.concurrency.limit
+    driver.execute(get_request(server))
+
+    decreased = limit * driver.CONCURRENCY_DECREASE
+    assert driver.concurrency.decreases == 1
+    assert driver.concurrency.limit == pytest.approx(decreased + 1.0 / decreased)
+    assert tracing.tracer.counters['drive.rate_limited'] == 1
+    assert tracing.tracer.counters['drive.concurrency_decreases'] == 1
+
+
+def test_server_errors_cut_limit_to_minimum():
+    server = fake_drive.FakeServer(error_rate=1.0)
+    with pytest.raises(driver.DriveUnavailable):
+        driver.execute(get_request(server))
+
+    assert driver.concurrency.decreases == driver.RATE_LIMIT_ATTEMPTS
+    assert driver.concurrency.limit == driver.MIN_CONCURRENCY
+    assert tracing.tracer.counters['drive.concurrency_limit'] == driver.MIN_CONCURRENCY
+
+
+def test_errors_in_flight_together_cut_once():
+    limit = driver.ConcurrencyLimit(initial=8)
+    error = fake_drive.http_error(503, 'backendError')
+    requests = [limit.request() for _ in range(3)]
+    for request in requests:
+        request.__enter__()
+    assert limit.in_flight == 3
+    for request in requests:
+        assert not request.__exit__(type(error), error, None)
+
+    assert limit.limit == 8 * driver.CONCURRENCY_DECREASE
+    assert limit.decreases == 1
+    assert limit.in_flight == 0
+
+
+def test_client_errors_leave_limit():
+    limit = driver.ConcurrencyLimit(initial=4)
+    with pytest.raises(errors.HttpError):
+        with limit.request():
+            raise fake_drive.http_error(404, 'notFound')
+
+    assert limit.limit == 4
+
+
+class FailingBatchServer(fake_drive.FakeServer):
+    """Fails the first batch envelopes with failure, as a 503 or a dropped connection."""
+
+    def __init__(self, failures, failure):
+        super(FailingBatchServer, self).__init__()
+        self.failures = failures
+        self.failure = failure
+
+    def call(self, method, latency=True):
+        if method == 'batch' and self.failures:
+            self.failures -= 1
+            self.calls[method] = self.calls.get(method, 0) + 1
+            raise self.failure
+        super(FailingBatchServer, self).call(method, latency)
+
+
+def get_drive(server):
+    drive = driver.AgrcDriver.__new__(driver.AgrcDriver)
+    drive.service = fake_drive.FakeDriveService(server)
+    return drive
+
+
+@pytest.mark.parametrize('failure', [fake_drive.http_error(503, 'backendError'), ConnectionResetError('reset')])
+def test_batch_envelope_failures_are_retried(failure):
+    server = FailingBatchServer(1, failure)
+    file_id = server.add_file(name='test.zip')
+    drive = get_drive(server)
+
+    assert drive.list_permissions([file_id]) == {file_id: []}
+    assert server.calls['batch'] == 2
+    counters = tracing.tracer.counters
+    assert counters.get('drive.server_errors', 0) + counters.get('drive.network_errors', 0) == 1
+    assert driver.breakers['drive'].results.count(False) == 1
+
+
+def test_batch_envelope_errors_cut_limit():
+    server = FailingBatchServer(driver.RATE_LIMIT_ATTEMPTS, fake_drive.http_error(503, 'backendError'))
+    file_id = server.add_file(name='test.zip')
+
+    with pytest.raises(driver.DriveUnavailable):
+        get_drive(server).list_permissions([file_id])
+    assert driver.concurrency.limit == driver.MIN_CONCURRENCY
+
+
+class ChunkServer(fake_drive.FakeServer):
+    """Records the size of each upload chunk and fails the upload calls numbered in failures."""
+
+    def __init__(self, failures=()):
+        super(ChunkServer, self).__init__()
+        self.failures = set(failures)
+        self.uploads = 0
+        self.chunks = []
+
+    def call(self, method, latency=True):
+        if method.endswith('.media'):
+            self.uploads += 1
+            if self.uploads in self.failures:
+                raise fake_drive.http_error(503, 'backendError')
+        super(ChunkServer, self).call(method, latency)
+
+    def transfer(self, byte_count):
+        self.chunks.append(byte_count)
+
+
+def test_upload_chunk_size_changes_between_chunks(tmp_path, monkeypatch):
+    # The first size is read when the media upload is made
+    sizes = iter([driver.MB, driver.MB, 2 * driver.MB, driver.MB])
+    monkeypatch.setattr(driver, 'get_chunk_size', lambda: next(sizes))
+    local_file = str(tmp_path / 'test.zip')
+    with open(local_file, 'wb') as f_out:
+        f_out.write(b'z' * (3 * driver.MB + 10))
+    server = ChunkServer()
+    file_id = server.add_file(name='test.zip')
+
+    get_drive(server).update_file(file_id, local_file, 'application/zip')
+
+    assert server.chunks == [driver.MB, 2 * driver.MB, 10]
+    assert tracing.tracer.counters['drive.bytes_uploaded'] == 3 * driver.MB + 10
+
+
+def test_failed_upload_chunks_not_counted(tmp_path, monkeypatch):
+    monkeypatch.setattr(driver, 'get_chunk_size', lambda: driver.MB)
+    local_file = str(tmp_path / 'test.zip')
+    with open(local_file, 'wb') as f_out:
+        f_out.write(b'z' * (2 * driver.MB))
+    server = ChunkServer(failures=[2])
+    file_id = server.add_file(name='test.zip')
+    get_drive(server).update_file(file_id, local_file, 'application/zip')
+
+    assert server.chunks == [driver.MB, driver.MB]
+    assert tracing.tracer.counters['drive.bytes_uploaded'] == 2 * driver.MB
+
+    server = ChunkServer(failures=[2, 3, 4, 5, 6])
+    file_id = server.add_file(name='test.zip')
+    with pytest.raises(driver.DriveUnavailable):
+        get_drive(server).update_file(file_id, local_file, 'application/zip')
+    assert tracing.tracer.counters['drive.bytes_uploaded'] == 3 * driver.MB
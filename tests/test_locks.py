@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+import locks
+
+
+def test_atomic_write(tmp_path):
+    path = str(tmp_path / 'spec.json')
+    locks.atomic_write(path, 'one')
+    locks.atomic_write(path, 'two')
+
+    with open(path) as f_in:
+        assert f_in.read() == 'two'
+    assert os.listdir(str(tmp_path)) == ['spec.json']
+
+
+def test_replace_retries_while_destination_is_open(tmp_path, monkeypatch):
+    attempts = []
+    os_replace = os.replace
+
+    def busy_replace(source, destination):
+        attempts.append(destination)
+        if len(attempts) < 3:
+            raise PermissionError('in use')
+        os_replace(source, destination)
+
+    monkeypatch.setattr(locks.os, 'replace', busy_replace)
+    monkeypatch.setattr(locks, 'POLL_SECONDS', 0)
+    path = str(tmp_path / 'spec.json')
+    locks.atomic_write(path, 'text')
+
+    assert len(attempts) == 3
+    with open(path) as f_in:
+        assert f_in.read() == 'text'
+
+
+def test_replace_gives_up_and_removes_temp_file(tmp_path, monkeypatch):
+    def busy_replace(source, destination):
+        raise PermissionError('in use')
+
+    monkeypatch.setattr(locks.os, 'replace', busy_replace)
+    monkeypatch.setattr(locks, 'POLL_SECONDS', 0)
+    temp_path = str(tmp_path / 'spec.json.tmp')
+    with open(temp_path, 'w') as f_out:
+        f_out.write('text')
+
+    with pytest.raises(PermissionError):
+        locks.replace(temp_path, str(tmp_path / 'spec.json'), timeout=0.01)
+    assert os.listdir(str(tmp_path)) == []
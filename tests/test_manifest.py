@@ -0,0 +1,99 @@
+import numpy as np
+
+import manifest
+import rowhash
+
+
+def get_manifest(pairs, key_field='UNIQUE_ID', **header):
+    return manifest.from_pairs(pairs, key_field, **header)
+
+
+def test_from_pairs_sorts_and_counts_duplicates():
+    built = get_manifest([(3, 30), (1, 10), (2, 20), (1, 11)])
+
+    assert built.keys == [1, 1, 2, 3]
+    assert built.hashes == [10, 11, 20, 30]
+    assert built.header['key_type'] == 'int'
+    assert built.header['rows'] == 4
+    assert built.header['duplicate_keys'] == 1
+
+
+def test_from_pairs_mixed_keys_are_strings():
+    built = get_manifest([(10, 1), ('9', 2)])
+
+    assert built.header['key_type'] == 'str'
+    assert built.keys == ['10', '9']
+
+
+def test_from_blocks_matches_pairs():
+    keys = np.array([5, 3, 9], dtype=np.int64)
+    hashes = np.array([50, 30, 90], dtype=np.uint64)
+    block = rowhash.Block(keys, hashes, None, [])
+
+    built = manifest.from_blocks([block], 'UNIQUE_ID')
+    assert built.keys == [3, 5, 9]
+    assert built.hashes == [30, 50, 90]
+
+
+def test_from_blocks_matches_from_pairs():
+    rand = np.random.default_rng(0)
+    blocks = [rowhash.Block(rand.integers(0, 50, 40).astype(dtype), rand.integers(0, 2 ** 63, 40, dtype=np.uint64),
+                            None, []) for dtype in ('<i4', '<i8', '<u4')]
+    texts = [rowhash.Block(np.array(['b', 'a\xe9', 'a', 'b']), np.array([2, 1, 3, 0], dtype=np.uint64), None, [])]
+    floats = [rowhash.Block(np.array([2.5, 1.0]), np.array([1, 2], dtype=np.uint64), None, [])]
+
+    for case in (blocks, texts, floats):
+        pairs = [pair for block in case for pair in zip(block.keys.tolist(), block.hashes.tolist())]
+        built = manifest.from_blocks(case, 'UNIQUE_ID', created='2024-03-01')
+        expected = manifest.from_pairs(pairs, 'UNIQUE_ID', created='2024-03-01')
+
+        assert built.keys == expected.keys
+        assert built.hashes == expected.hashes
+        assert built.header == expected.header
+        assert all(type(key) is type(expected.keys[0]) for key in built.keys)
+
+
+def test_from_blocks_empty():
+    built = manifest.from_blocks([], 'UNIQUE_ID')
+
+    assert (built.keys, built.hashes, built.header['key_type'], built.header['rows']) == ([], [], 'int', 0)
+
+
+def test_write_read_round_trip(tmp_path):
+    for pairs in ([(2, 2 ** 64 - 1), (1, 0)], [('b', 1), ('a\xe9', 2)]):
+        built = get_manifest(pairs, sgid_name='SGID.WATER.StreamsNHD')
+        read = manifest.read(manifest.write(built, str(tmp_path / 'test.manifest')))
+
+        assert read.keys == built.keys
+        assert read.hashes == built.hashes
+        assert read.header == built.header
+
+
+def test_diff_counts():
+    old = get_manifest([(1, 10), (2, 20), (3, 30)])
+    new = get_manifest([(2, 20), (3, 31), (4, 40), (5, 50)])
+
+    assert manifest.diff(old, new) == {'added': 2, 'changed': 1, 'deleted': 1, 'unchanged': 1}
+
+
+def test_not_comparable():
+    new = get_manifest([(1, 10)])
+
+    assert manifest.diff(None, new) is None
+    assert not manifest.comparable(get_manifest([(1, 10)], 'OTHER_ID'), new)
+    assert not manifest.comparable(get_manifest([(1, 10)], manifest.DEFAULT_KEY_FIELD),
+                                   get_manifest([(1, 10)], manifest.DEFAULT_KEY_FIELD))
+    assert not manifest.comparable(get_manifest([('1', 10)]), new)
+    assert not manifest.comparable(get_manifest([(1, 10), (1, 11)]), new)
+    assert not manifest.comparable(get_manifest([(1, 10)], source=manifest.SOURCE_EXPORT), new)
+    assert manifest.comparable(get_manifest([(1, 10)], source=manifest.SOURCE_WORKSPACE), new)
+
+
+def test_cached(tmp_path):
+    folder = str(tmp_path / 'manifests')
+    built = get_manifest([(1, 10)])
+    path = manifest.write(built, str(tmp_path / 'built.manifest'))
+
+    assert manifest.load_cached('SGID.WATER.StreamsNHD', folder) is None
+    manifest.save_cached('SGID.WATER.StreamsNHD', path, folder)
+    assert manifest.load_cached('SGID.WATER.StreamsNHD', folder).to_dict() == {1: 10}
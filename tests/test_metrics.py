@@ -0,0 +1,25 @@
+import metrics
+import tracing
+
+
+def test_render_mixed_status_labels():
+    registry = metrics.Registry()
+    registry.inc('api_calls', api='drive', method='drive.files.get', status='ok')
+    registry.inc('api_calls', api='drive', method='drive.files.get', status=503)
+    registry.inc('api_calls', api='drive', method='drive.files.get', status=503)
+
+    text = registry.render(tracing.Tracer())
+
+    assert 'zip_loader_api_calls_total{api="drive",method="drive.files.get",status="ok"} 1' in text
+    assert 'zip_loader_api_calls_total{api="drive",method="drive.files.get",status="503"} 2' in text
+
+
+def test_render_depth_peak():
+    registry = metrics.Registry()
+    registry.depth('export_queue', 3)
+    registry.depth('export_queue', 1)
+
+    text = registry.render(tracing.Tracer())
+
+    assert 'zip_loader_export_queue 1' in text
+    assert 'zip_loader_export_queue_peak 3' in text
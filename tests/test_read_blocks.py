@@ -0,0 +1,45 @@
+import json
+import os
+
+import zip_loader
+from benchmarks import synthetic
+
+INT_NULL = zip_loader.NULL_VALUES['Integer']
+
+
+def make_dataset(workspace, records, is_table=False):
+    path = synthetic.make_dataset(str(workspace), 'SGID.TEST.Nulls', len(records), is_table=is_table)
+    with open(os.path.join(path, synthetic.DATASET_META), 'w') as f_out:
+        json.dump({'rows': len(records), 'type': 'Table' if is_table else 'FeatureClass', 'records': records}, f_out)
+    return path
+
+
+def get_attributes(path, key_field='UNIQUE_ID'):
+    return [block.attributes(i) for block in zip_loader._read_blocks(path, key_field) for i in range(len(block))]
+
+
+def test_nulls_restored_from_cursor(tmp_path):
+    path = make_dataset(tmp_path, [{'UNIQUE_ID': 1, 'NAME': '', 'COUNT': INT_NULL, 'SHAPE@WKT': 'POINT (1 2)'},
+                                   {'UNIQUE_ID': 2, 'NAME': None, 'COUNT': None, 'SHAPE@WKT': 'POINT (3 4)'},
+                                   {'UNIQUE_ID': 3, 'NAME': 'Main', 'COUNT': 7, 'SHAPE@WKT': None}])
+
+    blocks = list(zip_loader._read_blocks(path, 'UNIQUE_ID'))
+    assert blocks[0].wkbs == [b'POINT (1 2)', b'POINT (3 4)', None]
+    assert get_attributes(path) == [{'COUNT': INT_NULL, 'NAME': '', 'UNIQUE_ID': 1},
+                                    {'COUNT': None, 'NAME': None, 'UNIQUE_ID': 2},
+                                    {'COUNT': 7, 'NAME': 'Main', 'UNIQUE_ID': 3}]
+
+
+def test_table_without_stand_ins_has_no_masks(tmp_path):
+    path = make_dataset(tmp_path, [{'UNIQUE_ID': 1, 'NAME': 'A'}, {'UNIQUE_ID': 2, 'NAME': 'B'}], is_table=True)
+
+    blocks = list(zip_loader._read_blocks(path, 'UNIQUE_ID'))
+    assert blocks[0].null_masks == {}
+    assert blocks[0].wkbs is None
+    assert get_attributes(path) == [{'NAME': 'A', 'UNIQUE_ID': 1}, {'NAME': 'B', 'UNIQUE_ID': 2}]
+
+
+def test_table_nulls(tmp_path):
+    path = make_dataset(tmp_path, [{'UNIQUE_ID': 1, 'NAME': ''}, {'UNIQUE_ID': 2, 'NAME': None}], is_table=True)
+
+    assert get_attributes(path) == [{'NAME': '', 'UNIQUE_ID': 1}, {'NAME': None, 'UNIQUE_ID': 2}]
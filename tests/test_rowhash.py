@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from xxhash import xxh64
+
+import rowhash
+from benchmarks import synthetic
+
+
+@pytest.mark.parametrize('length', [0, 1, 3, 4, 7, 8, 15, 31, 32, 33, 63, 64, 100])
+def test_xxh64_rows_matches_xxhash(length):
+    data = np.random.default_rng(length).integers(0, 256, (5, length), dtype=np.uint8)
+
+    assert rowhash.xxh64_rows(data).tolist() == [xxh64(row.tobytes()).intdigest() for row in data]
+
+
+def test_xxh64_rows_seed():
+    data = np.arange(40, dtype=np.uint8).reshape(2, 20)
+
+    assert rowhash.xxh64_rows(data, seed=7).tolist() == [xxh64(row.tobytes(), seed=7).intdigest() for row in data]
+
+
+def test_hash_wkb_groups_match_single_rows(monkeypatch):
+    _, wkbs = synthetic.make_rows(200)
+    wkbs = wkbs + [b'\x01\x02', None]
+    grouped = rowhash.hash_wkb(wkbs)
+    monkeypatch.setattr(rowhash, 'MIN_GROUP_ROWS', len(wkbs) + 1)
+
+    assert grouped.tolist() == rowhash.hash_wkb(wkbs).tolist()
+    assert grouped[-1] == xxh64(b'').intdigest()
+
+
+def test_hash_block_changes_with_one_value():
+    rows, wkbs = synthetic.make_rows(50)
+    fields = [name for name in rows.dtype.names if name != 'OID@']
+    hashes = rowhash.hash_block(rows, fields, wkbs)
+    rows['ADDNUM'][10] += 1
+
+    changed = rowhash.hash_block(rows, fields, wkbs) != hashes
+    assert changed.tolist() == [i == 10 for i in range(50)]
+
+
+def test_hash_block_independent_of_text_width():
+    rows, _ = synthetic.make_rows(20)
+    fields = ['NAME', 'TYPE']
+    wide = rows.astype([('OID@', '<i4'), ('ADDNUM', '<i4'), ('NAME', '<U80'), ('TYPE', '<U30'),
+                        ('ELEV', '<f8'), ('EDITED', '<M8[us]')])
+    widths = {'NAME': 50, 'TYPE': 10}
+
+    assert rowhash.hash_block(rows, fields, widths=widths).tolist() == \
+        rowhash.hash_block(wide, fields, widths=widths).tolist()
+
+
+def test_hash_text_mixed_latin_and_wide_characters():
+    column = np.array(['caf\xe9', 'kōwhai', ''], dtype='<U8')
+    hashes = rowhash._hash_text(column)
+
+    assert len(set(hashes.tolist())) == 3
+    assert hashes[0] == rowhash._hash_text(column[:1])[0]
@@ -0,0 +1,57 @@
+import json
+from datetime import date
+
+import run_state
+
+
+def test_window_starts_after_watermark():
+    state = {}
+    run_state.set_watermark(state, date(2024, 3, 4))
+
+    assert run_state.get_change_window(state, date(2024, 3, 7)) == (date(2024, 3, 5), date(2024, 3, 7))
+
+
+def test_window_without_watermark_is_end_date():
+    assert run_state.get_change_window({}, date(2024, 3, 7)) == (date(2024, 3, 7), date(2024, 3, 7))
+
+
+def test_since_overrides_watermark():
+    state = {}
+    run_state.set_watermark(state, date(2024, 3, 4))
+
+    assert run_state.get_change_window(state, date(2024, 3, 7), date(2024, 3, 1)) == (date(2024, 3, 1),
+                                                                                        date(2024, 3, 7))
+
+
+def test_watermarks_by_mode():
+    state = {}
+    run_state.set_watermark(state, date(2024, 3, 6), run_state.PACKAGES)
+
+    assert run_state.get_watermark(state, run_state.FEATURES) is None
+    assert run_state.get_change_window(state, date(2024, 3, 7), mode=run_state.FEATURES)[0] == date(2024, 3, 7)
+    assert run_state.get_change_window(state, date(2024, 3, 7), mode=run_state.PACKAGES)[0] == date(2024, 3, 7)
+    assert run_state.get_watermark(state, run_state.PACKAGES) == date(2024, 3, 6)
+
+
+def test_legacy_watermark_applies_to_both_modes():
+    state = {'watermark': '2024-03-04'}
+
+    assert run_state.get_watermark(state, run_state.FEATURES) == date(2024, 3, 4)
+    assert run_state.get_watermark(state, run_state.PACKAGES) == date(2024, 3, 4)
+
+    run_state.set_watermark(state, date(2024, 3, 6), run_state.PACKAGES)
+
+    assert 'watermark' not in state
+    assert run_state.get_watermark(state, run_state.FEATURES) == date(2024, 3, 4)
+    assert run_state.get_watermark(state, run_state.PACKAGES) == date(2024, 3, 6)
+
+
+def test_update_state_saves(tmp_path):
+    path = str(tmp_path / 'run_state.json')
+    run_state.update_state(lambda state: run_state.set_watermark(state, date(2024, 3, 4)), path)
+    run_state.record_publish('SGID.Boundaries.Counties', date(2024, 3, 5), path)
+
+    with open(path) as f_in:
+        saved = json.load(f_in)
+    assert saved['watermarks'] == {'features': '2024-03-04'}
+    assert run_state.get_published(run_state.load_state(path), 'sgid.boundaries.counties') == date(2024, 3, 5)
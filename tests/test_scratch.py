@@ -0,0 +1,59 @@
+import os
+
+import pytest
+
+import scratch
+import zip_loader
+
+
+def touch(path):
+    with open(path, 'w') as f_out:
+        f_out.write('zip')
+    return path
+
+
+def test_run_zips_only_latest_run(tmp_path):
+    space = scratch.ScratchSpace(str(tmp_path))
+    full = [touch(space.zip_path('Roads', suffix)) for suffix in ('gdb', 'shp', 'hash')]
+    for path in full:
+        space.keep_zip(path)
+    space.record_run('Roads', full)
+    delta_zip = touch(space.zip_path('Roads', 'delta'))
+    space.record_run('Roads', [delta_zip])
+
+    assert space.run_zips('Roads') == [delta_zip]
+    assert space.run_zips('Schools') is None
+
+
+def test_run_zips_survive_reset(tmp_path):
+    space = scratch.ScratchSpace(str(tmp_path))
+    delta_zip = touch(space.zip_path('Roads', 'delta'))
+    space.keep_zip(delta_zip, pinned=True)
+    space.record_run('Roads', [delta_zip])
+    space.reset()
+
+    assert scratch.ScratchSpace(str(tmp_path)).run_zips('Roads') == [delta_zip]
+
+
+def test_upload_zip_skips_cached_full_zips(tmp_path, monkeypatch):
+    output_directory = str(tmp_path)
+    feature = {'name': 'Roads', 'sgid_name': 'SGID.TRANSPORTATION.Roads', 'parent_ids': ['parent'], 'gdb_id': 'g',
+               'shape_id': 's', 'hash_id': 'h', 'delta': True, 'primary_key': 'UNIQUE_ID'}
+    uploaded = []
+    monkeypatch.setattr(zip_loader, 'scratch_spaces', {})
+    monkeypatch.setattr(zip_loader.spec_manager, 'get_feature', lambda name: dict(feature))
+    monkeypatch.setattr(zip_loader.spec_manager, 'save_spec_changes', lambda spec, base: None)
+    monkeypatch.setattr(zip_loader.run_state, 'record_publish', lambda name: None)
+    monkeypatch.setattr(zip_loader, 'load_zip_to_drive',
+                        lambda spec, id_key, new_zip, parents: uploaded.append(os.path.basename(new_zip)))
+    space = zip_loader.get_scratch_space(output_directory)
+    for suffix in ('gdb', 'shp'):
+        space.keep_zip(touch(space.zip_path('Roads', suffix)))
+    space.record_run('Roads', [touch(space.zip_path('Roads', 'delta'))])
+
+    zip_loader.upload_zip(feature['sgid_name'], output_directory)
+    assert uploaded == ['Roads_delta.zip']
+
+    space.record_run('Roads', [])
+    with pytest.raises(Exception):
+        zip_loader.upload_zip(feature['sgid_name'], output_directory)
@@ -0,0 +1,51 @@
+import argparse
+
+import service
+import zip_loader
+
+
+def get_args(**options):
+    args = dict(service.JOB_DEFAULTS, force=False, load=False, poll_minutes=60)
+    args.update(options)
+    return argparse.Namespace(**args)
+
+
+def test_poll_job_keeps_start_options():
+    args = get_args(check_features=True, feature_category='Water', schedule=True)
+
+    assert zip_loader.get_poll_job(args) == {'check_features': True,
+                                             'check_packages': False,
+                                             'feature_category': 'Water',
+                                             'schedule': True}
+    assert zip_loader.get_poll_job(get_args(feature_category='Water')) is None
+
+
+def test_poll_runs_with_start_options():
+    args = get_args(check_features=True, feature_category='Water', schedule=True)
+    job_args = zip_loader.get_job_args(args, zip_loader.get_poll_job(args))
+
+    assert job_args.check_features
+    assert job_args.feature_category == 'Water'
+    assert job_args.schedule
+    assert not job_args.force
+
+
+def test_client_poll_takes_service_category():
+    args = get_args(check_features=True, check_packages=True, feature_category='Water', schedule=True)
+    job = {'check_features': True, 'check_packages': True, 'force': True}
+    job_args = zip_loader.get_job_args(args, job, zip_loader.get_poll_job(args))
+
+    assert job_args.feature_category == 'Water'
+    assert job_args.schedule
+    assert job_args.force
+
+
+def test_feature_jobs_drop_start_options():
+    args = get_args(check_features=True, feature_category='Water', schedule=True)
+    job_args = zip_loader.get_job_args(args, {'feature': 'SGID.Water.StreamsNHD'}, zip_loader.get_poll_job(args))
+
+    assert job_args.feature == 'SGID.Water.StreamsNHD'
+    assert not job_args.check_features
+    assert job_args.feature_category is None
+    assert not job_args.schedule
+    assert not job_args.load
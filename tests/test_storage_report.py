@@ -0,0 +1,25 @@
+import driver
+import storage_report
+from benchmarks import fake_drive
+
+
+def test_snapshot_walks_sgid_folders(monkeypatch):
+    monkeypatch.setattr(storage_report, 'PARENTS_PER_QUERY', 2)
+    server = fake_drive.FakeServer(page_size=2)
+    roots = [server.add_file(name='root{}'.format(i), mime_type=fake_drive.FOLDER_MIME) for i in range(2)]
+    folders = [server.add_file(name='folder{}'.format(i), parents=[roots[i % 2]], mime_type=fake_drive.FOLDER_MIME)
+               for i in range(3)]
+    nested = server.add_file(name='nested', parents=[folders[0]], mime_type=fake_drive.FOLDER_MIME)
+    zips = [server.add_file(name='z{}.zip'.format(i), parents=[folder], size=10 + i)
+            for i, folder in enumerate(folders + [nested, roots[1]])]
+    outside = server.add_file(name='outside')
+    server.add_file(name='other.zip', parents=[outside], size=99)
+    drive = driver.AgrcDriver.__new__(driver.AgrcDriver)
+    drive.service = fake_drive.FakeDriveService(server)
+
+    snapshot = storage_report.get_snapshot(drive, roots)
+
+    assert set(snapshot['files']) == set(folders + [nested] + zips)
+    assert sum(f['size'] for f in snapshot['files'].values()) == sum(range(10, 15))
+    # Levels of 2, 3 and 1 folders take 1, 2 and 1 queries, two of them need a second page
+    assert server.calls['files.list'] == 6
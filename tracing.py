@@ -0,0 +1,205 @@
+"""Low overhead stage timing and counters for zip_loader runs"""
+import json
+import os
+import threading
+from functools import wraps
+from time import perf_counter
+
+#: Upper bounds in seconds of the duration histogram kept for each span name
+STAGE_BUCKETS = (.05, .25, 1, 5, 15, 60, 300, 900, 3600, 4 * 3600)
+
+
+class Span(object):
+    """Timed region of a run. Add values to args while the span is open."""
+
+    __slots__ = ('tracer', 'name', 'args', 'start', 'end')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = None
+        self.end = None
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end = perf_counter()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.record(self)
+        return False
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+class Tracer(object):
+    """
+    Collect spans and counters and export them as JSON lines or Chrome trace json.
+
+    spans holds the spans of the current run for trace files and reset_spans empties it. stages keeps running
+    totals for every span name, so a resident service reports stage durations without holding every span.
+    """
+
+    def __init__(self):
+        self.spans = []
+        #: Span name to [calls, seconds, calls within each STAGE_BUCKETS bound]
+        self.stages = {}
+        self.counters = {}
+        #: Names in counters set by gauge rather than added to
+        self.gauges = set()
+        self.origin = perf_counter()
+        self._lock = threading.Lock()
+
+    def span(self, name, **args):
+        return Span(self, name, args)
+
+    def _add_stage(self, name, duration):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = [0, 0.0, [0] * len(STAGE_BUCKETS)]
+        stage[0] += 1
+        stage[1] += duration
+        for i, bound in enumerate(STAGE_BUCKETS):
+            if duration <= bound:
+                stage[2][i] += 1
+
+    def record(self, span):
+        with self._lock:
+            self.spans.append((span.name,
+                               span.start - self.origin,
+                               span.end - span.start,
+                               os.getpid(),
+                               threading.get_ident(),
+                               span.args))
+            self._add_stage(span.name, span.end - span.start)
+
+    def reset_spans(self):
+        """Drop the spans kept for trace files, stage totals and counters carry on."""
+        with self._lock:
+            self.spans = []
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        """Set a counter to the latest value of a level such as a concurrency limit."""
+        with self._lock:
+            self.counters[name] = value
+            self.gauges.add(name)
+
+    def merge(self, origin, spans, counters, gauges=()):
+        """
+        Add spans and counters recorded by a tracer in another process, such as an export worker.
+
+        gauges: names in counters that hold a level, they replace the value here instead of adding to it
+        """
+        shift = origin - self.origin
+        with self._lock:
+            for name, start, duration, pid, tid, args in spans:
+                self.spans.append((name, start + shift, duration, pid, tid, args))
+                self._add_stage(name, duration)
+            for name, value in counters.items():
+                if name in gauges:
+                    self.counters[name] = value
+                    self.gauges.add(name)
+                else:
+                    self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        """Total seconds and call count for each span name."""
+        with self._lock:
+            return dict((name, (stage[1], stage[0])) for name, stage in self.stages.items())
+
+    def print_summary(self):
+        totals = self.summary()
+        print('\n{:<40}{:>8}{:>12}'.format('stage', 'calls', 'seconds'))
+        for name in sorted(totals, key=lambda n: totals[n][0], reverse=True):
+            seconds, calls = totals[name]
+            print('{:<40}{:>8}{:>12.3f}'.format(name, calls, seconds))
+        for name in sorted(self.counters):
+            print('{:<40}{:>20}'.format(name, self.counters[name]))
+
+    def write_jsonl(self, path):
+        """Write one json object per span followed by one per counter."""
+        with open(path, 'w') as f_out:
+            for name, start, duration, pid, tid, args in self.spans:
+                f_out.write(json.dumps({'type': 'span',
+                                        'name': name,
+                                        'start': round(start, 6),
+                                        'duration': round(duration, 6),
+                                        'pid': pid,
+                                        'tid': tid,
+                                        'args': args}, sort_keys=True))
+                f_out.write('\n')
+            for name in sorted(self.counters):
+                f_out.write(json.dumps({'type': 'counter', 'name': name, 'value': self.counters[name]}))
+                f_out.write('\n')
+
+    def write_chrome_trace(self, path):
+        """Write spans as complete events that chrome://tracing and Perfetto can open."""
+        events = []
+        end = 0
+        for name, start, duration, pid, tid, args in self.spans:
+            events.append({'name': name,
+                           'cat': name.split('.')[0],
+                           'ph': 'X',
+                           'ts': int(start * 1e6),
+                           'dur': int(duration * 1e6),
+                           'pid': pid,
+                           'tid': tid,
+                           'args': args})
+            end = max(end, start + duration)
+        for name in sorted(self.counters):
+            events.append({'name': name,
+                           'ph': 'C',
+                           'ts': int(end * 1e6),
+                           'pid': os.getpid(),
+                           'args': {'value': self.counters[name]}})
+        with open(path, 'w') as f_out:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f_out)
+
+
+tracer = Tracer()
+
+
+def span(name, **args):
+    """Time a block with the module tracer."""
+    return tracer.span(name, **args)
+
+
+def count(name, value=1):
+    """Add value to a counter on the module tracer."""
+    tracer.count(name, value)
+
+
+def gauge(name, value):
+    """Set a counter on the module tracer to value."""
+    tracer.gauge(name, value)
+
+
+def traced(name):
+    """Decorate a function so each call is recorded as a span and counted as a call."""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            tracer.count(name + '.calls')
+            with tracer.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def export(path_prefix):
+    """Write <path_prefix>.jsonl and <path_prefix>.trace.json for the module tracer."""
+    directory = os.path.dirname(path_prefix)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    tracer.write_jsonl(path_prefix + '.jsonl')
+    tracer.write_chrome_trace(path_prefix + '.trace.json')
+    tracer.print_summary()
@@ -0,0 +1,102 @@
+"""List the tables in a workspace once and answer existence checks for a run from memory"""
+import csv
+import os
+
+import arcpy
+
+import tracing
+
+MISSING = 'missing'
+UNREADABLE = 'unreadable'
+
+
+class WorkspaceIndex(object):
+    """
+    Names of the feature classes and tables in a workspace.
+
+    The workspace is walked once on first use. Readability is checked with a cursor the first time a table is asked
+    about and remembered for the rest of the run.
+    """
+
+    def __init__(self, workspace):
+        self.workspace = workspace
+        self.names = None
+        self.readable = {}
+
+    def scan(self):
+        """Walk the workspace, including feature datasets, and index names in lower case."""
+        with tracing.span('workspace_index.scan', workspace=self.workspace) as span:
+            self.names = {}
+            for dirpath, _, filenames in arcpy.da.Walk(self.workspace, datatype=['FeatureClass', 'Table']):
+                for filename in filenames:
+                    self.names[filename.lower()] = os.path.join(dirpath, filename)
+            span.args['tables'] = len(self.names)
+
+        return self
+
+    def exists(self, name):
+        if self.names is None:
+            self.scan()
+
+        return name.lower() in self.names
+
+    def is_readable(self, name):
+        """True when name is in the workspace and a cursor can open it."""
+        key = name.lower()
+        if key not in self.readable:
+            self.readable[key] = self.exists(name) and self._probe(self.names[key])
+
+        return self.readable[key]
+
+    def _probe(self, data_path):
+        with tracing.span('workspace_index.probe', path=data_path):
+            try:
+                with arcpy.da.SearchCursor(data_path, 'OID@'):
+                    pass
+            except RuntimeError:
+                return False
+
+        return True
+
+    def check(self, names):
+        """Get {name: MISSING or UNREADABLE} for names that can not be exported."""
+        problems = {}
+        for name in names:
+            if not self.exists(name):
+                problems[name] = MISSING
+            elif not self.is_readable(name):
+                problems[name] = UNREADABLE
+
+        return problems
+
+
+def get_missing_rows(problems, feature_specs=None, package_specs=None):
+    """Rows of sgid_name, status and the packages that list it for a missing features table."""
+    packages = {}
+    for package in package_specs or []:
+        for feature_class in package['feature_classes']:
+            packages.setdefault(feature_class.lower(), []).append(package['name'])
+    for feature in feature_specs or []:
+        for package_name in feature['packages']:
+            if package_name not in packages.setdefault(feature['sgid_name'].lower(), []):
+                packages[feature['sgid_name'].lower()].append(package_name)
+
+    return [[name, problems[name], ' '.join(sorted(packages.get(name.lower(), [])))] for name in sorted(problems)]
+
+
+def print_missing_table(rows):
+    if not rows:
+        print('All features exist in the workspace')
+        return
+    widths = [max(len(str(row[i])) for row in rows + [['sgid_name', 'status', 'packages']]) for i in range(3)]
+    for row in [['sgid_name', 'status', 'packages']] + rows:
+        print('  '.join(str(value).ljust(width) for value, width in zip(row, widths)))
+
+
+def write_missing_csv(rows, path):
+    with open(path, 'w', newline='') as out_table:
+        table = csv.writer(out_table)
+        table.writerow(['sgid_name', 'status', 'packages'])
+        table.writerows(rows)
+
+    return path
@@ -1,44 +1,115 @@
 import arcpy
-import shutil
 import os
 import zipfile
 import csv
-from time import clock
+from time import perf_counter, sleep, time
 from datetime import datetime, date, timedelta
 # from hashlib import md5
 from xxhash import xxh64
+import numpy as np
 import json
 import ntpath
 import argparse
+import copy
 import re
 
+import delta
+import export_worker
+import manifest
+import metrics
+import planner
+import profiling
+import rowhash
+import run_state
+import schedule
+import scratch
+import service
 import spec_manager
+import tracing
+import workspace_index
+from export_worker import create_outputs, unzip, zip_folder
 from oauth2client import tools
 import driver
 
-api_secrets = driver.SERVICE_ACCOUNT_SECRET_FILE
-api_oauth = False
-# If service account key file does not exist use a user account and OAuth2 instead.
-if not os.path.exists(api_secrets):
-    api_secrets = driver.OAUTH_CLIENT_SECRET_FILE
-    api_oauth = True
-# Declare all services and scopes required.
-api_services = driver.ApiService((driver.APIS.drive, driver.APIS.sheets),
-                                 secrets=api_secrets,
-                                 scopes=' '.join((driver.AgrcDriver.FULL_SCOPE, driver.AgrcSheets.FULL_SCOPE)),
-                                 use_oauth=api_oauth)
-drive = driver.AgrcDriver(api_services.services[0])
-sheets = driver.AgrcSheets(api_services.services[1])
-user_drive = None
-# If main drive service is a user account use it for file creation as well
-if api_secrets == driver.OAUTH_CLIENT_SECRET_FILE:
-    user_drive = drive
+drive = sheets = user_drive = None
+# Export workers started with spawn import this module as __mp_main__ and need no API services
+if __name__ != '__mp_main__':
+    api_secrets = driver.SERVICE_ACCOUNT_SECRET_FILE
+    api_oauth = False
+    # If service account key file does not exist use a user account and OAuth2 instead.
+    if not os.path.exists(api_secrets):
+        api_secrets = driver.OAUTH_CLIENT_SECRET_FILE
+        api_oauth = True
+    # Declare all services and scopes required.
+    api_services = driver.ApiService((driver.APIS.drive, driver.APIS.sheets),
+                                     secrets=api_secrets,
+                                     scopes=' '.join((driver.AgrcDriver.FULL_SCOPE, driver.AgrcSheets.FULL_SCOPE)),
+                                     use_oauth=api_oauth)
+    drive = driver.AgrcDriver(api_services.services[0])
+    sheets = driver.AgrcSheets(api_services.services[1])
+    # If main drive service is a user account use it for file creation as well
+    if api_secrets == driver.OAUTH_CLIENT_SECRET_FILE:
+        user_drive = drive
 
 #IDs for drive objects
 HASH_DRIVE_FOLDER = '0ByStJjVZ7c7mMVRpZjlVdVZ5Y0E'
 UTM_DRIVE_FOLDER = '0ByStJjVZ7c7mNlZRd2ZYOUdyX2M'
 LOG_SHEET_ID = '11ASS7LnxgpnD0jN4utzklREgMf1pcvYjcXcIcESHweQ'
 LOG_SHEET_NAME = 'Drive Update'
+OWNER_EMAIL = 'agrc@utah.gov'
+#: Files and folders created this run that still need ownership transferred
+pending_owner_ids = []
+#: Temp space limits, set from the command line
+TEMP_BUDGET_BYTES = None
+KEEP_ZIPS = 8
+scratch_spaces = {}
+#: Lowercase sgid names updated so far in this run mapped to the packages they returned
+published_features = {}
+#: workspace_index.WorkspaceIndex for each workspace used this run
+workspace_indexes = {}
+#: Missing features table written by preflight
+MISSING_FEATURES_CSV = 'missing_features.csv'
+#: Row hashing reads this many rows per TableToNumPyArray call
+HASH_BLOCK_ROWS = 100000
+#: Stand ins for null when reading rows to numpy, numpy arrays have no null for these types
+NULL_VALUES = {'SmallInteger': -32768,
+               'Integer': -2147483648,
+               'BigInteger': -9223372036854775808,
+               'Single': float('nan'),
+               'Double': float('nan'),
+               'Date': datetime(1, 1, 1),
+               'String': '',
+               'GUID': '',
+               'GlobalID': ''}
+TEXT_FIELD_TYPES = ('String', 'GUID', 'GlobalID')
+UNHASHED_FIELD_TYPES = ('Blob', 'Geometry', 'OID', 'Raster')
+#: Export worker processes, 1 exports in this process
+EXPORT_WORKERS = 1
+#: Exports a worker runs before it is replaced to contain arcpy memory growth
+JOBS_PER_WORKER = 20
+#: Seconds to wait for one worker export before reporting it as failed
+EXPORT_TIMEOUT = 4 * 3600
+#: Function export workers run before importing arcpy, benchmarks install a stand in
+EXPORT_WORKER_SETUP = None
+#: Change detection source
+CHANGE_DETECTION_TABLE = 'SGID.META.ChangeDetection'
+CHANGE_NAME_FIELD = 'table_name'
+CHANGE_MODIFIED_FIELD = 'last_modified'
+#: sgid names with zips waiting on Drive, pinned in the temp directory until they are uploaded
+deferred_uploads = []
+#: sgid names whose worker exports failed or timed out this run, they hold back the watermark like deferred uploads
+failed_exports = []
+#: Seconds a run waits at the end for Drive to recover before leaving deferred zips for --upload_zip
+DRAIN_TIMEOUT = 1800
+
+
+def get_scratch_space(output_directory):
+    """Get the shared scratch.ScratchSpace for output_directory."""
+    if output_directory not in scratch_spaces:
+        scratch_spaces[output_directory] = scratch.ScratchSpace(output_directory,
+                                                                budget_bytes=TEMP_BUDGET_BYTES,
+                                                                keep_zips=KEEP_ZIPS)
+    return scratch_spaces[output_directory]
 
 
 def get_user_drive(user_drive=user_drive):
@@ -81,70 +152,102 @@ def _is_naughty_field(fld):
     return fld.upper().startswith('SHAPE') or fld.upper().startswith('SHAPE_') or fld.startswith('OBJECTID')
 
 
-def zip_folder(folder_path, zip_name):
-    """Zip a folder with compression to reduce storage size."""
-    zf = zipfile.ZipFile(zip_name, "w", zipfile.ZIP_DEFLATED)
-    for root, _, files in os.walk(folder_path):
-        for filename in files:
-            if not filename.endswith('.lock'):
-                zf.write(os.path.join(root, filename),
-                         os.path.relpath(os.path.join(root, filename), os.path.join(folder_path, '..')))
-    original_size = 0
-    compress_size = 0
-    for info in zf.infolist():
-        original_size += info.file_size
-        compress_size += info.compress_size
-    zf.close()
+def _get_key_field(feature):
+    return feature.get('primary_key') or manifest.DEFAULT_KEY_FIELD
 
 
-def unzip(zip_path, output_path):
-    """Unzip a folder that was zipped by zip_folder."""
-    with zipfile.ZipFile(zip_path, 'r', zipfile.ZIP_DEFLATED) as zipped:
-        zipped.extractall(output_path)
+def _get_oid_blocks(data_path, block_rows):
+    """Yield (first, last) object ids covering up to block_rows rows each."""
+    oids = arcpy.da.TableToNumPyArray(data_path, ['OID@'])['OID@']
+    oids.sort()
+    for start in range(0, len(oids), block_rows):
+        yield int(oids[start]), int(oids[min(start + block_rows, len(oids)) - 1])
 
 
-def _get_copier(is_table):
-    if is_table:
-        return arcpy.CopyRows_management
-    else:
-        return arcpy.CopyFeatures_management
+def _has_stand_in(column, null):
+    """True when any value of a numpy column equals the null stand-in it was read with."""
+    if isinstance(null, float) and null != null:
+        return bool(np.isnan(column).any())
 
+    return bool((column == np.array(null, dtype=column.dtype)).any())
 
-def create_outputs(output_directory, input_feature, output_name):
-    """Create output file GDB and directory with shapefile."""
-    # Create output GDB and feature class
-    is_table = arcpy.Describe(input_feature).datasetType.lower() == 'table'
-    copier = _get_copier(is_table)
 
-    output_gdb = arcpy.CreateFileGDB_management(output_directory, output_name)[0]
-    output_fc = copier(input_feature, os.path.join(output_gdb, output_name))[0]
-    # Create directory to contain shape file
-    shape_directory = os.path.join(output_directory, output_name)
-    if not os.path.exists(shape_directory):
-        os.makedirs(shape_directory)
-    copier(output_fc, os.path.join(shape_directory, output_name))
+def _read_blocks(data_path, key_field):
+    """
+    Yield rowhash.Block objects for data_path read HASH_BLOCK_ROWS at a time.
 
-    return (output_gdb, shape_directory)
+    Attributes come from TableToNumPyArray limited to the fields kept by _filter_fields,
+    geometry from SHAPE@WKB in the same object id range. Fields holding their NULL_VALUES stand-in are read again
+    with the geometry so real nulls are told apart from real values equal to the stand-in.
+    """
+    field_info = dict((field.name, field) for field in arcpy.ListFields(data_path))
+    fields = [f for f in _filter_fields(list(field_info)) if field_info[f].type not in UNHASHED_FIELD_TYPES]
+    key_token = 'OID@' if key_field == manifest.DEFAULT_KEY_FIELD else key_field
+    if key_token != 'OID@' and key_field not in field_info:
+        raise Exception('Primary key {} is not a field of {}'.format(key_field, data_path))
+    array_fields = ['OID@'] + fields + ([key_token] if key_token not in fields + ['OID@'] else [])
+    nulls = dict((f, NULL_VALUES[field_info[f].type]) for f in array_fields
+                 if f in field_info and field_info[f].type in NULL_VALUES)
+    widths = dict((f, field_info[f].length) for f in fields if field_info[f].type in TEXT_FIELD_TYPES)
+    describe = arcpy.Describe(data_path)
+    is_table = describe.datasetType.lower() == 'table'
+    for first, last in _get_oid_blocks(data_path, HASH_BLOCK_ROWS):
+        where = '{0} >= {1} AND {0} <= {2}'.format(describe.OIDFieldName, first, last)
+        rows = arcpy.da.TableToNumPyArray(data_path, array_fields, where_clause=where, null_value=nulls)
+        rows = rows[rows['OID@'].argsort()]
+        wkbs = None
+        ambiguous = [f for f in fields if f in nulls and _has_stand_in(rows[f], nulls[f])]
+        cursor_fields = ([] if is_table else ['SHAPE@WKB']) + ambiguous
+        null_masks = {}
+        if cursor_fields:
+            with arcpy.da.SearchCursor(data_path, ['OID@'] + cursor_fields, where_clause=where) as cursor:
+                values = dict((row[0], row[1:]) for row in cursor)
+            missing = (None,) * len(cursor_fields)
+            records = [values.get(oid, missing) for oid in rows['OID@'].tolist()]
+            if not is_table:
+                wkbs = [record[0] for record in records]
+            for i, field in enumerate(ambiguous, len(cursor_fields) - len(ambiguous)):
+                null_masks[field] = np.array([record[i] is None for record in records], dtype=bool)
+        yield rowhash.Block(rows[key_token], rowhash.hash_block(rows, fields, wkbs, widths), rows, fields,
+                            wkbs=wkbs, null_masks=null_masks)
 
 
 def load_zip_to_drive(spec, id_key, new_zip, parent_folder_ids):
     """Create or update a zip file on drive."""
-    # File should exist if id is in spec so use any account to update.
-    if spec[id_key]:
-        drive.update_file(spec[id_key], new_zip, 'application/zip')
-    # File does not exist so create it with a user account in order to have control over ownership.
-    else:
-        temp_id = get_user_drive().create_drive_file(ntpath.basename(new_zip),
-                                                     parent_folder_ids,
-                                                     new_zip,
-                                                     'application/zip')
-        # Make agrc gmail account the owner
-        get_user_drive().create_owner(temp_id, "agrc@utah.gov")
-        spec[id_key] = temp_id
+    with tracing.span('load_zip_to_drive', zip=ntpath.basename(new_zip), bytes=os.path.getsize(new_zip)) as span:
+        # File should exist if id is in spec so use any account to update.
+        if spec[id_key]:
+            drive.update_file(spec[id_key], new_zip, 'application/zip')
+        # File does not exist so create it with a user account in order to have control over ownership.
+        else:
+            span.args['created'] = True
+            temp_id = get_user_drive().create_drive_file(ntpath.basename(new_zip),
+                                                         parent_folder_ids,
+                                                         new_zip,
+                                                         'application/zip')
+            # Make agrc gmail account the owner
+            pending_owner_ids.append(temp_id)
+            spec[id_key] = temp_id
 
     # drive.keep_revision(spec[id_key])
 
 
+def transfer_ownership():
+    """Make OWNER_EMAIL the owner of everything created this run with batched permission requests."""
+    if not pending_owner_ids:
+        return
+    try:
+        result = get_user_drive().grant_permissions(pending_owner_ids, OWNER_EMAIL, 'owner')
+    except driver.DriveUnavailable as e:
+        # Kept for the next run in this process, a new process has to transfer them by hand
+        print('Ownership transfer deferred for {} files: {}'.format(len(pending_owner_ids), e))
+        print('\n'.join(pending_owner_ids))
+        return
+    del pending_owner_ids[:]
+    for file_id in result['failed']:
+        print('Ownership transfer failed for {}: {}'.format(file_id, result['failed'][file_id]))
+
+
 def get_category_folder_id(category, parent_id):
     """Get drive id for a folder with name of category and in parent_id drive folder."""
     category_id = drive.get_file_id_by_name_and_directory(category, parent_id)
@@ -152,17 +255,27 @@ def get_category_folder_id(category, parent_id):
         print('Creating drive folder: {}'.format(category))
         category_id = get_user_drive().create_drive_folder(category, [parent_id])
         # Make agrc gmail account the owner
-        get_user_drive().create_owner(category_id, "agrc@utah.gov")
+        pending_owner_ids.append(category_id)
 
     return category_id
 
 
+def ensure_feature_folder(feature):
+    """Add the Drive folder for feature, creating it and its category folder when needed, to its parent_ids."""
+    category_id = get_category_folder_id(feature['category'], UTM_DRIVE_FOLDER)
+    # Check for name folder
+    name_id = get_category_folder_id(feature['name'], category_id)
+    if name_id not in feature['parent_ids']:
+        feature['parent_ids'].append(name_id)
+
+
 def init_drive_package(package):
     """
     Create Drive folders for package and get Drive ids.
 
     package: package spec
     """
+    base = copy.deepcopy(package)
     category_id = get_category_folder_id(package['category'], UTM_DRIVE_FOLDER)
     category_packages_id = get_category_folder_id('packages', category_id)
     drive_folder_id = get_category_folder_id(package['name'], category_packages_id)
@@ -174,7 +287,7 @@ def init_drive_package(package):
         package['gdb_id'] = gdb_folder_id
     if shp_folder_id != package['shape_id']:
         package['shape_id'] = shp_folder_id
-    spec_manager.save_spec_json(package)
+    spec_manager.save_spec_changes(package, base)
 
 
 def sync_package_and_features(package_spec):
@@ -183,22 +296,31 @@ def sync_package_and_features(package_spec):
     current_gdb_ids = []
     current_shp_ids = []
 
-    for feature_spec in [spec_manager.get_feature(f) for f in feature_list]:
+    edited_specs = []
+    feature_specs = [spec_manager.get_feature(f) for f in feature_list]
+    # Look up the parents of every zip in the package together
+    file_ids = [spec[key] for spec in feature_specs for key in ('gdb_id', 'shape_id')]
+    parents = dict(zip(file_ids, driver.map_calls(drive.get_parents, file_ids)))
+    for feature_spec in feature_specs:
+        edited_specs.append((feature_spec, copy.deepcopy(feature_spec)))
         package_list = [p.lower() for p in feature_spec['packages']]
         if package_spec['name'].lower() not in package_list:
             feature_spec['packages'].append(package_spec['name'])
 
-        if package_spec['gdb_id'] not in drive.get_parents(feature_spec['gdb_id']):
+        if package_spec['gdb_id'] not in parents[feature_spec['gdb_id']]:
             get_user_drive().add_file_parent(feature_spec['gdb_id'], package_spec['gdb_id'])
             print('add package gdb_id')
-        if package_spec['shape_id'] not in drive.get_parents(feature_spec['shape_id']):
+        if package_spec['shape_id'] not in parents[feature_spec['shape_id']]:
             get_user_drive().add_file_parent(feature_spec['shape_id'], package_spec['shape_id'])
             print('add package shape_id')
 
         current_gdb_ids.append(feature_spec['gdb_id'])
         current_shp_ids.append(feature_spec['shape_id'])
 
-        spec_manager.save_spec_json(feature_spec)
+    # Merge with edits other runs saved to the same specs meanwhile
+    with spec_manager.transaction():
+        for feature_spec, base in edited_specs:
+            spec_manager.save_spec_changes(feature_spec, base)
 
     folder_gdb_ids = [name_id[1] for name_id in drive.list_files_in_directory(package_spec['gdb_id'])]
     for gdb_id in folder_gdb_ids:
@@ -216,6 +338,7 @@ def sync_package_and_features(package_spec):
 def sync_feature_to_package(feature_spec, package_spec):
     """Remove packages from feature if feature is not listed in package."""
     feature_list = [f.lower() for f in package_spec['feature_classes']]
+    base = copy.deepcopy(feature_spec)
 
     if feature_spec['sgid_name'].lower() not in feature_list:
         feature_spec['packages'].remove(package_spec['name'])
@@ -226,166 +349,556 @@ def sync_feature_to_package(feature_spec, package_spec):
             get_user_drive().remove_file_parent(feature_spec['shape_id'], package_spec['shape_id'])
             print('remove package shape_id')
 
-    spec_manager.save_spec_json(feature_spec)
+    spec_manager.save_spec_changes(feature_spec, base)
+
+
+def get_workspace_index(workspace):
+    """Get the workspace_index.WorkspaceIndex shared by this run for workspace."""
+    if workspace not in workspace_indexes:
+        workspace_indexes[workspace] = workspace_index.WorkspaceIndex(workspace)
+    return workspace_indexes[workspace]
 
 
 def src_data_exists(data_path):
-    """Check for extistance and accessibility of data."""
-    if not arcpy.Exists(data_path):
-        return False
+    """Check for extistance and accessibility of data from the workspace index."""
+    workspace, name = os.path.split(data_path)
+
+    return get_workspace_index(workspace).is_readable(name)
+
+
+def preflight(workspace, feature_names, output_directory):
+    """
+    Check every feature a run needs against one scan of workspace and report the missing ones as a table.
+
+    returns: {sgid name: workspace_index.MISSING or workspace_index.UNREADABLE}
+    """
+    with tracing.span('preflight', features=len(feature_names)) as span:
+        problems = get_workspace_index(workspace).check(feature_names)
+        span.args['missing'] = len(problems)
+    print('\nPreflight: {} of {} features can not be exported'.format(len(problems), len(feature_names)))
+    if problems:
+        rows = workspace_index.get_missing_rows(problems,
+                                                spec_manager.get_feature_specs(),
+                                                spec_manager.get_package_specs())
+        workspace_index.print_missing_table(rows)
+        print('Written to', workspace_index.write_missing_csv(rows, os.path.join(output_directory, MISSING_FEATURES_CSV)))
+
+    return problems
+
+
+def log_update(feature, feature_time):
+    now = datetime.now()
+    log_sheet_values = [['{}.{}'.format(feature['category'], feature['name']),
+                        now.strftime('%m/%d/%Y'),
+                        now.strftime('%H:%M:%S.%f'),
+                        perf_counter() - feature_time]]
     try:
-        with arcpy.da.SearchCursor(data_path, 'OID@'):
-            pass
-    except RuntimeError:
-        return False
+        sheets.append_row(LOG_SHEET_ID, LOG_SHEET_NAME, log_sheet_values)
+    except driver.DriveUnavailable as e:
+        print('Update not logged: {}'.format(e))
 
-    return True
 
+def defer_upload(feature, error):
+    """Record that feature's zips could not be uploaded because Drive is unavailable. returns: False"""
+    print('Uploads deferred for {}: {}'.format(feature['sgid_name'], error))
+    if feature['sgid_name'] not in deferred_uploads:
+        deferred_uploads.append(feature['sgid_name'])
+    metrics.depth('deferred_uploads', len(deferred_uploads))
+
+    return False
+
+
+def count_feature(feature, load_to_drive):
+    """Count a feature that update_feature finished in metrics as published, deferred or zipped without uploading."""
+    if load_to_drive:
+        outcome = 'published'
+    elif feature['sgid_name'] in deferred_uploads:
+        outcome = 'deferred'
+    else:
+        outcome = 'zipped'
+    metrics.inc('features', outcome=outcome)
+
+
+def get_previous_manifest(feature, scratch_directory):
+    """Last published manifest from the local cache, or from the feature's _hash.zip on drive on a new machine."""
+    previous = manifest.load_cached(feature['sgid_name'])
+    if previous is None and feature['hash_id']:
+        old_zip = os.path.join(scratch_directory, 'previous_hash.zip')
+        try:
+            drive.download_file(feature['hash_id'], old_zip)
+            previous = manifest.read_zip(old_zip, scratch_directory)
+        except Exception as e:
+            print('No previous manifest for {}: {}'.format(feature['sgid_name'], e))
+
+    return previous
+
+
+def write_manifest(feature, data_path, output_directory, hash_zip, row_hashes=None, source=manifest.SOURCE_EXPORT):
+    """
+    Hash each row of a feature into a manifest zipped at hash_zip and count changes since the last published one.
+
+    data_path: feature class or table to read rows from, normally the file GDB copy made by the export
+    row_hashes: (key, hash) pairs already computed for this export, otherwise the rows are read
+    source: manifest.SOURCE_EXPORT or SOURCE_WORKSPACE for where data_path or row_hashes came from
+    returns: (manifest path, manifest.diff counts or None without a primary_key or a comparable previous manifest)
+    """
+    key_field = _get_key_field(feature)
+    manifest_path = os.path.join(output_directory, '{}.manifest'.format(feature['name']))
+    with tracing.span('write_manifest', feature=feature['name']) as span:
+        if row_hashes is not None:
+            new_manifest = manifest.from_pairs(row_hashes, key_field, sgid_name=feature['sgid_name'], source=source)
+        else:
+            new_manifest = manifest.from_blocks(_read_blocks(data_path, key_field), key_field,
+                                                sgid_name=feature['sgid_name'], source=source)
+        manifest.write(new_manifest, manifest_path)
+        manifest.zip_manifest(manifest_path, hash_zip)
+        counts = None
+        if new_manifest.header['duplicate_keys']:
+            print('{} rows repeat a {} value, row changes not counted'.format(new_manifest.header['duplicate_keys'],
+                                                                             key_field))
+            span.args['duplicate_keys'] = new_manifest.header['duplicate_keys']
+        elif feature.get('primary_key'):
+            # Object ids change when tables are reloaded so only a primary_key is compared between runs
+            counts = manifest.diff(get_previous_manifest(feature, output_directory), new_manifest)
+        span.args['rows'] = len(new_manifest)
+        if counts:
+            span.args.update(counts)
+    if counts:
+        for change in ('added', 'changed', 'deleted'):
+            tracing.count('rows_' + change, counts[change])
+
+    return manifest_path, counts
+
+
+def write_delta(feature, input_feature_path, space, work_directory, baseline, blocks=None):
+    """
+    Write the changeset zip for a delta feature.
 
-def update_feature(workspace, feature_name, output_directory, load_to_drive=True, force_update=False):
+    work_directory: folder for the uncompressed changeset
+    baseline: delta.load_baseline result, None writes an empty changeset for freshly published full zips
+    blocks: rowhash.Block objects to compare, defaults to reading input_feature_path.
+        Pass [] with baseline None for an empty changeset
+    returns: (delta zip path, delta.write_changeset counts)
+    """
+    output_name = feature['name']
+    if blocks is None:
+        blocks = _read_blocks(input_feature_path, feature['primary_key'])
+    header = {'sgid_name': feature['sgid_name'],
+              'primary_key': feature['primary_key'],
+              'base': baseline['base'] if baseline else date.today(),
+              'created': datetime.now().isoformat()}
+    with tracing.span('write_delta', feature=output_name) as span:
+        changeset = os.path.join(work_directory, '{}_delta.jsonl'.format(output_name))
+        counts = delta.write_changeset(blocks, baseline, changeset, header)
+        delta_zip = space.zip_path(output_name, 'delta')
+        delta.zip_changeset(changeset, delta_zip)
+        for op in ('insert', 'update', 'delete'):
+            span.args[op] = counts[op]
+    tracing.count('rows_changed', counts['insert'] + counts['update'] + counts['delete'])
+
+    return delta_zip, counts
+
+
+def update_feature(workspace, feature_name, output_directory, load_to_drive=True, force_update=False,
+                   export_pool=None):
     """
     Update a feature class on drive if it has changed.
 
     workspace: string path or connection to a workspace that contains feature_name
     feature_name: string SGID name such as SGID.BOUNDARIES.ZipCodes
+    export_pool: export_worker.ExportPool that may already be exporting feature_name
     """
     print('\nStarting feature:', feature_name)
-    feature_time = clock()
+    feature_time = perf_counter()
 
     input_feature_path = os.path.join(workspace, feature_name)
 
     feature = spec_manager.get_feature(feature_name)
     if not src_data_exists(input_feature_path):
-        now = datetime.now()
-        log_sheet_values = [['{}.{}'.format(feature['category'], feature['name']),
-                             now.strftime('%m/%d/%Y'),
-                             now.strftime('%H:%M:%S.%f'),
-                             clock() - feature_time]]
-        sheets.append_row(LOG_SHEET_ID, LOG_SHEET_NAME, log_sheet_values)
+        metrics.inc('features', outcome='skipped')
+        log_update(feature, feature_time)
         return []
     # Handle new packages and changes to feature['packages'] list
     for package in [spec_manager.get_package(p) for p in feature['packages']]:
-        sync_feature_to_package(feature, package)
-
-    category_id = get_category_folder_id(feature['category'], UTM_DRIVE_FOLDER)
-    # Check for name folder
-    name_id = get_category_folder_id(feature['name'], category_id)
-    if name_id not in feature['parent_ids']:
-        feature['parent_ids'].append(name_id)
+        try:
+            sync_feature_to_package(feature, package)
+        except driver.DriveUnavailable as e:
+            print('Package {} not synced: {}'.format(package['name'], e))
+    #: Saves merge this run's edits into the spec as it is saved then
+    base = copy.deepcopy(feature)
+
+    # Exports and zips go ahead while Drive is down, load_to_drive is cleared so the zips stay pinned for later
+    try:
+        ensure_feature_folder(feature)
+    except driver.DriveUnavailable as e:
+        load_to_drive = load_to_drive and defer_upload(feature, e)
 
     output_name = feature['name']
 
     packages = feature['packages']
-    # Copy data local
-    print('Copying...')
-    fc_directory, shape_directory = create_outputs(
-                                                    output_directory,
-                                                    input_feature_path,
-                                                    output_name)
-
-    # Zip up outputs
-    new_gdb_zip = os.path.join(output_directory, '{}_gdb.zip'.format(output_name))
-    new_shape_zip = os.path.join(output_directory, '{}_shp.zip'.format(output_name))
-    print('Zipping...')
-    zip_folder(fc_directory, new_gdb_zip)
-    zip_folder(shape_directory, new_shape_zip)
-    # Upload to drive
-    if load_to_drive:
-        load_zip_to_drive(feature, 'gdb_id', new_gdb_zip, feature['parent_ids'])
-        load_zip_to_drive(feature, 'shape_id', new_shape_zip, feature['parent_ids'])
-        print('All zips loaded')
+    space = get_scratch_space(output_directory)
+    is_delta = delta.is_delta_feature(feature)
+    if is_delta:
+        feature.setdefault('delta_id', '')
+    prefetched = export_pool is not None and feature_name in export_pool
+    # Wait for temp space before copying, prefetched exports reserved it when they were submitted
+    if not prefetched:
+        space.reserve(output_name)
+    # Until this run makes new zips --upload_zip has nothing to send, cached zips were already published
+    space.record_run(output_name, [])
+    keep_scratch = False
+    try:
+        row_hashes = None
+        if is_delta and not force_update:
+            # Publish only changed rows until full zips are due or too much has changed
+            baseline = delta.load_baseline(feature['sgid_name'])
+            if not delta.needs_full_refresh(baseline, feature['primary_key'], date.today()):
+                delta_zip, counts = write_delta(feature, input_feature_path, space, space.feature_dir(output_name),
+                                                baseline)
+                ratio = delta.change_ratio(counts, baseline)
+                print('Delta: {insert} inserts, {update} updates, {delete} deletes'.format(**counts))
+                if counts['duplicate_keys']:
+                    print('{} rows repeat a {} value, publishing full zips'.format(counts['duplicate_keys'],
+                                                                                  feature['primary_key']))
+                elif ratio <= delta.MAX_CHANGE_RATIO:
+                    if load_to_drive:
+                        try:
+                            load_zip_to_drive(feature, 'delta_id', delta_zip, feature['parent_ids'])
+                        except driver.DriveUnavailable as e:
+                            load_to_drive = defer_upload(feature, e)
+                    space.keep_zip(delta_zip, pinned=not load_to_drive)
+                    space.record_run(output_name, [delta_zip])
+                    spec_manager.save_spec_changes(feature, base)
+                    if load_to_drive:
+                        run_state.record_publish(feature['sgid_name'])
+                    count_feature(feature, load_to_drive)
+                    log_update(feature, feature_time)
+                    return packages
+                else:
+                    print('{:.0%} of rows changed, publishing full zips'.format(ratio))
+                row_hashes = counts['hashes']
+        # Copy data local and zip up outputs
+        new_gdb_zip = space.zip_path(output_name, 'gdb')
+        new_shape_zip = space.zip_path(output_name, 'shp')
+        if prefetched:
+            result = export_pool.result(feature_name)
+            if result['error']:
+                print('Export failed for {}:\n{}'.format(feature_name, result['error']))
+                metrics.inc('features', outcome='failed')
+                failed_exports.append(feature['sgid_name'])
+                # A timed out worker may still be writing here, update_features releases it after the pool stops
+                keep_scratch = result.get('timed_out', False)
+                return []
+            print('Exported by worker {pid} in {seconds:.1f}s'.format(**result))
+            fc_directory, shape_directory = result['fc_directory'], result['shape_directory']
+        else:
+            fc_directory, shape_directory = export_worker.export_feature(workspace,
+                                                                         feature_name,
+                                                                         output_name,
+                                                                         space.feature_dir(output_name),
+                                                                         new_gdb_zip,
+                                                                         new_shape_zip)
+        # Row hashes to count changes and, once uploaded, for the next run to compare against. Rows are read from
+        # the local file GDB copy instead of the workspace a second time. Delta features hash the workspace so
+        # their manifests match the deltas read from it between full refreshes.
+        new_hash_zip = space.zip_path(output_name, 'hash')
+        if is_delta:
+            manifest_path, changes = write_manifest(feature, input_feature_path, os.path.dirname(fc_directory),
+                                                    new_hash_zip, row_hashes, source=manifest.SOURCE_WORKSPACE)
+        else:
+            manifest_path, changes = write_manifest(feature, os.path.join(fc_directory, output_name),
+                                                    os.path.dirname(fc_directory), new_hash_zip)
+        if changes:
+            print('Rows: {added} added, {changed} changed, {deleted} deleted'.format(**changes))
+        # Upload to drive
+        new_zips = [new_gdb_zip, new_shape_zip, new_hash_zip]
+        if is_delta:
+            # Full zips are the new baseline so the published changeset starts over empty
+            delta_zip, _ = write_delta(feature, input_feature_path, space, os.path.dirname(fc_directory), None,
+                                           blocks=[])
+            new_zips.append(delta_zip)
+        if load_to_drive:
+            try:
+                load_zip_to_drive(feature, 'gdb_id', new_gdb_zip, feature['parent_ids'])
+                load_zip_to_drive(feature, 'shape_id', new_shape_zip, feature['parent_ids'])
+                load_zip_to_drive(feature, 'hash_id', new_hash_zip, [HASH_DRIVE_FOLDER])
+                manifest.save_cached(feature['sgid_name'], manifest_path)
+                if is_delta:
+                    load_zip_to_drive(feature, 'delta_id', delta_zip, feature['parent_ids'])
+                run_state.record_publish(feature['sgid_name'])
+                print('All zips loaded')
+            except driver.DriveUnavailable as e:
+                # Zips already uploaded are sent again with the rest, their new ids are saved with the spec below
+                load_to_drive = defer_upload(feature, e)
+        # Zips that were not uploaded stay on disk for --upload_zip
+        for new_zip in new_zips:
+            space.keep_zip(new_zip, pinned=not load_to_drive)
+        space.record_run(output_name, new_zips)
+    finally:
+        if not keep_scratch:
+            space.release(output_name)
+
+    spec_manager.save_spec_changes(feature, base)
+    count_feature(feature, load_to_drive)
+    log_update(feature, feature_time)
 
-    spec_manager.save_spec_json(feature)
-    now = datetime.now()
-    log_sheet_values = [['{}.{}'.format(feature['category'], feature['name']),
-                        now.strftime('%m/%d/%Y'),
-                        now.strftime('%H:%M:%S.%f'),
-                        clock() - feature_time]]
-    sheets.append_row(LOG_SHEET_ID, LOG_SHEET_NAME, log_sheet_values)
+    return packages
+
+
+def _read_change_csv(change_table, start_date, end_date):
+    """Read a csv stand-in for the change detection table with table_name and last_modified columns."""
+    changed = set()
+    with open(change_table, 'r', newline='') as csv_file:
+        for row in csv.DictReader(csv_file):
+            modified = datetime.strptime(row[CHANGE_MODIFIED_FIELD][:10], '%Y-%m-%d').date()
+            if start_date <= modified <= end_date:
+                changed.add(row[CHANGE_NAME_FIELD].lower())
+
+    return changed
+
+
+def _can_prefetch(workspace, feature_name, force):
+    """True for features that will export full zips: readable, and not publishing a delta this run."""
+    if not src_data_exists(os.path.join(workspace, feature_name)):
+        return False
+    feature = spec_manager.get_feature(feature_name)
+    if force or not delta.is_delta_feature(feature):
+        return True
+
+    return delta.needs_full_refresh(delta.load_baseline(feature['sgid_name']), feature['primary_key'], date.today())
+
+
+def _submit_export(export_pool, workspace, feature_name, output_directory):
+    """
+    Queue the export of feature_name when temp space can be reserved without waiting.
+
+    returns: False when the temp budget has no room, the feature is exported in its turn instead
+    """
+    output_name = spec_manager.get_feature(feature_name)['name']
+    space = get_scratch_space(output_directory)
+    if not space.try_reserve(output_name):
+        return False
+    export_pool.submit(workspace=workspace,
+                       feature_name=feature_name,
+                       output_name=output_name,
+                       feature_directory=space.feature_dir(output_name),
+                       gdb_zip=space.zip_path(output_name, 'gdb'),
+                       shape_zip=space.zip_path(output_name, 'shp'))
+
+    return True
+
+
+def update_features(workspace, features, output_directory, load=True, force=False):
+    """
+    Update each feature once per run.
+
+    Changes repeated across a catch up window or features shared by --all and --all_packages are exported once.
+    With EXPORT_WORKERS above 1 the next features export in worker processes while the current one uploads.
+    returns: packages of the features updated by this call
+    """
+    packages = []
+    to_update = []
+    for feature in features:
+        if feature.lower() not in published_features and feature.lower() not in [f.lower() for f in to_update]:
+            to_update.append(feature)
+    export_pool = None
+    if EXPORT_WORKERS > 1 and len(to_update) > 1:
+        export_pool = export_worker.ExportPool(EXPORT_WORKERS,
+                                               jobs_per_worker=JOBS_PER_WORKER,
+                                               timeout=EXPORT_TIMEOUT,
+                                               setup=EXPORT_WORKER_SETUP)
+    next_export = 0
+    try:
+        for i, feature in enumerate(to_update):
+            # Keep one export queued behind each busy worker without waiting on the temp budget.
+            # Features that can not be prefetched are exported here when their turn comes.
+            next_export = max(next_export, i + 1)
+            while export_pool is not None and next_export < len(to_update) and len(export_pool) <= EXPORT_WORKERS:
+                if _can_prefetch(workspace, to_update[next_export], force) and \
+                        not _submit_export(export_pool, workspace, to_update[next_export], output_directory):
+                    break
+                next_export += 1
+            metrics.depth('features_waiting', len(to_update) - i - 1)
+            if export_pool is not None:
+                metrics.depth('exports_queued', len(export_pool))
+            try:
+                with profiling.feature(feature):
+                    published_features[feature.lower()] = update_feature(workspace,
+                                                                         feature,
+                                                                         output_directory,
+                                                                         load_to_drive=load,
+                                                                         force_update=force,
+                                                                         export_pool=export_pool)
+            except Exception:
+                metrics.inc('features', outcome='failed')
+                raise
+            packages.extend(published_features[feature.lower()])
+    finally:
+        if export_pool is not None:
+            export_pool.close()
+            space = get_scratch_space(output_directory)
+            for feature in export_pool.timed_out:
+                space.release(spec_manager.get_feature(feature)['name'])
+    drain_deferred_uploads(output_directory)
 
     return packages
 
 
-def get_changed_tables(workspace):
-    change_detection_table = 'SGID.META.ChangeDetection'
-    table_name = 'table_name'
-    yesterday = date.today() - timedelta(days=1)
-    query = f"last_modified = '{yesterday.strftime('%Y-%m-%d')}'"
-    with arcpy.da.SearchCursor(os.path.join(workspace, change_detection_table), [table_name], where_clause=query) as cursor:
-        return [table for table, in cursor]
+def drain_deferred_uploads(output_directory, timeout=None):
+    """
+    Upload zips deferred while Drive was unavailable once its circuit breaker lets requests through again.
+
+    timeout: seconds to wait for Drive to recover, defaults to DRAIN_TIMEOUT
+    Features still deferred afterwards keep their zips pinned for --upload_zip and hold back the run watermark.
+    """
+    deadline = perf_counter() + (DRAIN_TIMEOUT if timeout is None else timeout)
+    while deferred_uploads:
+        wait = driver.breakers['drive'].seconds_until_probe()
+        if perf_counter() + wait > deadline:
+            break
+        if wait:
+            print('Waiting {:.0f}s for Drive before uploading {} deferred features'.format(wait, len(deferred_uploads)))
+            sleep(wait)
+        try:
+            upload_zip(deferred_uploads[0], output_directory)
+        except driver.DriveUnavailable as e:
+            print('Deferred upload failed for {}: {}'.format(deferred_uploads[0], e))
+            continue
+        del deferred_uploads[0]
+        tracing.count('deferred_uploads_drained')
+        metrics.depth('deferred_uploads', len(deferred_uploads))
+    if deferred_uploads:
+        print('Uploads still deferred, retry with --upload_zip: {}'.format(', '.join(deferred_uploads)))
+
+
+def get_changed_tables(workspace, start_date=None, end_date=None, change_table=None):
+    """
+    Get lowercase names of tables changed between start_date and end_date inclusive.
+
+    Both dates default to yesterday.
+    change_table: change detection table path, defaults to CHANGE_DETECTION_TABLE in workspace.
+        A .csv path with table_name and last_modified columns can stand in for offline runs.
+    returns: set of lowercase sgid names
+    """
+    end_date = end_date or date.today() - timedelta(days=1)
+    start_date = start_date or end_date
+    change_table = change_table or os.path.join(workspace, CHANGE_DETECTION_TABLE)
+    with tracing.span('get_changed_tables', start=str(start_date), end=str(end_date)) as span:
+        if change_table.lower().endswith('.csv'):
+            changed = _read_change_csv(change_table, start_date, end_date)
+        else:
+            query = "{0} >= '{1}' AND {0} < '{2}'".format(CHANGE_MODIFIED_FIELD,
+                                                          start_date.strftime('%Y-%m-%d'),
+                                                          (end_date + timedelta(days=1)).strftime('%Y-%m-%d'))
+            with arcpy.da.SearchCursor(change_table, [CHANGE_NAME_FIELD], where_clause=query) as cursor:
+                changed = set(table.lower() for table, in cursor)
+        span.args['tables'] = len(changed)
+
+    return changed
 
 
-def run_features(workspace, output_directory, feature_list_json=None, load=True, force=False, category=None):
+def run_features(workspace, output_directory, feature_list_json=None, load=True, force=False, category=None,
+                 since=None, until=None, change_table=None, scheduled=False):
     """
     CLI option to update all features in spec_manager.FEATURE_SPEC_FOLDER or just those in feature_list_json.
 
     feature_list_json: json file with array named "features"
+    since: first date of the change detection window, defaults to yesterday
+    until: last date of the change detection window, defaults to yesterday
+    change_table: change detection table or csv stand-in, see get_changed_tables
+    scheduled: order changed features by update_cycle and add overdue features, see schedule.plan_features
     """
-    run_all_lists = None
+    features = select_features(workspace, feature_list_json, category, since, until, change_table, scheduled)
+
+    # Missing features still go through update_feature so they are logged
+    preflight(workspace, features, output_directory)
+    packages = update_features(workspace, features, output_directory, load=load, force=force)
+    print('{} packages updated'.format(len(packages)))
+
+
+def select_features(workspace, feature_list_json=None, category=None, since=None, until=None, change_table=None,
+                    scheduled=False):
+    """SGID names run_features updates, in order. See run_features for the options."""
     features = []
     if not feature_list_json:
-        for feature_spec in spec_manager.get_feature_specs(get_changed_tables(workspace)):
-            if feature_spec['sgid_name'] != '' and\
-                    (category is None or category.upper() == feature_spec['category'].upper()):
-                features.append(feature_spec['sgid_name'])
+        changed_tables = get_changed_tables(workspace, start_date=since, end_date=until, change_table=change_table)
+        feature_specs = [s for s in spec_manager.get_feature_specs(None if scheduled else changed_tables)
+                         if s['sgid_name'] != '' and (category is None or category.upper() == s['category'].upper())]
+        if scheduled:
+            plan = schedule.plan_features(feature_specs, run_state.load_state(), date.today(), changed_tables)
+            schedule.print_plan(plan, limit=20)
+            features = plan['features']
+        else:
+            features = [feature_spec['sgid_name'] for feature_spec in feature_specs]
     else:
         with open(feature_list_json, 'r') as json_file:
             run_all_lists = json.load(json_file)
             features = run_all_lists['features']
 
-    packages = []
-    for feature in features:
-        packages.extend(update_feature(workspace, feature, output_directory, load_to_drive=load, force_update=force))
-    print('{} packages updated'.format(len(packages)))
+    return features
 
 
-def run_packages(workspace, output_directory, package_list_json=None, load=True, force=False):
+def run_packages(workspace, output_directory, package_list_json=None, load=True, force=False,
+                 since=None, until=None, change_table=None):
     """
     CLI option to update all packages in spec_manager.PACKAGE_SPEC_FOLDER or just those in package_list_json.
 
     All features contianed in a package will also be updated if they have changed.
     package_list_json: json file with array named "packages"
+    since: first date of the change detection window, defaults to yesterday
+    until: last date of the change detection window, defaults to yesterday
+    change_table: change detection table or csv stand-in, see get_changed_tables
     """
-    run_all_lists = None
     features = []
-    packages_to_check = []
-    if not package_list_json:
-        packages_to_check = spec_manager.get_package_specs(get_changed_tables(workspace))
-    else:
-        with open(package_list_json, 'r') as json_file:
-            run_all_lists = json.load(json_file)
-            for name in run_all_lists['packages']:
-                packages_to_check.append(spec_manager.get_package(name))
+    packages_to_check = select_packages(workspace, package_list_json, since, until, change_table)
 
+    package_features = [f for p in packages_to_check if p['feature_classes'] != '' for f in p['feature_classes']]
+    missing = preflight(workspace, package_features, output_directory)
     for package_spec in packages_to_check:
-
-        if len(package_spec['parent_ids']) == 0 or package_spec['gdb_id'] == '' or package_spec['shape_id'] == '':
-            init_drive_package(package_spec)
-        sync_package_and_features(package_spec)
+        try:
+            if len(package_spec['parent_ids']) == 0 or package_spec['gdb_id'] == '' or package_spec['shape_id'] == '':
+                init_drive_package(package_spec)
+            sync_package_and_features(package_spec)
+        except driver.DriveUnavailable as e:
+            # Features still export, the package is synced on a later run
+            print('Package {} not synced: {}'.format(package_spec['name'], e))
 
         fcs = package_spec['feature_classes']
         if fcs != '' and len(fcs) > 0:
             for f in fcs:
-                if src_data_exists(os.path.join(workspace, f)):
+                if f not in missing:
                     features.append(f)
                 else:
-                    print('Package {}, feature {} does not exist'.format(package_spec, f))
+                    print('Package {}, feature {} {}'.format(package_spec['name'], f, missing[f]))
 
-    features = set(features)
-    packages = []
-    for feature in features:
-        packages.extend(update_feature(workspace, feature, output_directory, load_to_drive=load, force_update=force))
+    packages = update_features(workspace, features, output_directory, load=load, force=force)
     print('{} packages updated'.format(len(packages)))
 
 
+def select_packages(workspace, package_list_json=None, since=None, until=None, change_table=None):
+    """Package specs run_packages syncs. See run_packages for the options."""
+    packages_to_check = []
+    if not package_list_json:
+        changed_tables = get_changed_tables(workspace, start_date=since, end_date=until, change_table=change_table)
+        packages_to_check = spec_manager.get_package_specs(changed_tables)
+    else:
+        with open(package_list_json, 'r') as json_file:
+            run_all_lists = json.load(json_file)
+            for name in run_all_lists['packages']:
+                packages_to_check.append(spec_manager.get_package(name))
+
+    return packages_to_check
+
+
 def run_feature(workspace, source_name, output_directory, load=True, force=False):
     """CLI option to update one feature."""
     if src_data_exists(os.path.join(workspace, source_name)):
-        packages = update_feature(workspace,
-                                  source_name,
-                                  output_directory,
-                                  load_to_drive=load,
-                                  force_update=force)
+        with profiling.feature(source_name):
+            packages = update_feature(workspace,
+                                      source_name,
+                                      output_directory,
+                                      load_to_drive=load,
+                                      force_update=force)
         for p in packages:
             print('Package updated: {}'.format(p))
     else:
@@ -408,26 +921,40 @@ def run_package(workspace, package_name, output_directory, load=True, force=Fals
 def upload_zip(source_name, output_directory):
     """CLI option to upload zip files from update process run with load_to_drive=False."""
     feature = spec_manager.get_feature(source_name)
+    base = copy.deepcopy(feature)
     output_name = feature['name']
-    # Zip up outputs
-    new_gdb_zip = os.path.join(output_directory, '{}_gdb.zip'.format(output_name))
-    new_shape_zip = os.path.join(output_directory, '{}_shp.zip'.format(output_name))
-    new_hash_zip = os.path.join(output_directory, '{}_hash.zip'.format(output_name))
-
-    if not os.path.exists(new_gdb_zip) and \
-       not os.path.exists(new_shape_zip) and \
-       not os.path.exists(new_hash_zip):
+    if not feature['parent_ids']:
+        ensure_feature_folder(feature)
+    if delta.is_delta_feature(feature):
+        feature.setdefault('delta_id', '')
+    # Only zips the last update of the feature made, a delta run makes only the delta zip while full zips of
+    # earlier runs can still be cached
+    space = get_scratch_space(output_directory)
+    made = space.run_zips(output_name)
+    uploads = (('GDB', 'gdb_id', '_gdb.zip', feature['parent_ids']),
+               ('Shape', 'shape_id', '_shp.zip', feature['parent_ids']),
+               ('Hash', 'hash_id', '_hash.zip', [HASH_DRIVE_FOLDER]),
+               ('Delta', 'delta_id', '_delta.zip', feature['parent_ids']))
+    uploads = [(label, id_key, os.path.join(output_directory, output_name + suffix), parents)
+               for label, id_key, suffix, parents in uploads if id_key in feature]
+    if made is None:
+        uploads = [upload for upload in uploads if os.path.exists(upload[2])]
+    else:
+        made = set(os.path.normcase(os.path.abspath(path)) for path in made)
+        uploads = [upload for upload in uploads if os.path.normcase(os.path.abspath(upload[2])) in made]
+    if not uploads:
         raise(Exception('Required zip file do not exist at {}'.format(output_directory)))
 
     # Upload to drive
-    load_zip_to_drive(feature, 'gdb_id', new_gdb_zip, feature['parent_ids'])
-    print('GDB loaded')
-    load_zip_to_drive(feature, 'shape_id', new_shape_zip, feature['parent_ids'])
-    print('Shape loaded')
-    load_zip_to_drive(feature, 'hash_id', new_hash_zip, [HASH_DRIVE_FOLDER])
-    print('Hash loaded')
+    for label, id_key, new_zip, parents in uploads:
+        load_zip_to_drive(feature, id_key, new_zip, parents)
+        space.keep_zip(new_zip)
+        if id_key == 'hash_id':
+            manifest.save_cached(feature['sgid_name'], manifest.extract_zip(new_zip, output_directory))
+        print('{} loaded'.format(label))
+    run_state.record_publish(feature['sgid_name'])
 
-    spec_manager.save_spec_json(feature)
+    spec_manager.save_spec_changes(feature, base)
 
 
 def delete_feature(source_name):
@@ -444,6 +971,8 @@ def delete_feature(source_name):
     drive_delete_user.delete_file(feature['gdb_id'])
     drive_delete_user.delete_file(feature['hash_id'])
     drive_delete_user.delete_file(feature['shape_id'])
+    if feature.get('delta_id'):
+        drive_delete_user.delete_file(feature['delta_id'])
     drive_delete_user.delete_file(feature['parent_ids'][0])
 
     for package_name in feature['packages']:
@@ -454,6 +983,233 @@ def delete_feature(source_name):
     spec_manager.delete_spec_json(feature)
 
 
+def get_change_window(args, mode):
+    """
+    Change detection days a run with args covers for mode, every day since the last one fully published for it.
+
+    mode: run_state.FEATURES for --all or run_state.PACKAGES for --all_packages
+    returns: (uses_change_detection, since, until, catch_up_start) where uses_change_detection is False when
+        args do not check changes for mode or its window is already published
+    """
+    history = run_state.load_state()
+    until = date.today() - timedelta(days=1)
+    catch_up_start, _ = run_state.get_change_window(history, until, mode=mode)
+    since, until = run_state.get_change_window(history, until, args.since, mode)
+    uses_change_detection = args.check_features if mode == run_state.FEATURES else args.check_packages
+    if uses_change_detection and since > until:
+        print('Changes through {} are already published for {}'.format(until, mode))
+        uses_change_detection = False
+    elif uses_change_detection and since != until:
+        print('Checking {} changes from {} through {}'.format(mode, since, until))
+
+    return uses_change_detection, since, until, catch_up_start
+
+
+def plan_run(workspace, args):
+    """
+    CLI option to report what run_once would do with args without exporting, uploading or changing Drive.
+
+    Features and packages are chosen as run_once chooses them. Folders, parents and zip sizes come from the latest
+    storage_report snapshot, see planner.plan_run.
+    returns: the plan dict
+    """
+    start = perf_counter()
+    check_features, since, until, _ = get_change_window(args, run_state.FEATURES)
+    check_packages, package_since, package_until, _ = get_change_window(args, run_state.PACKAGES)
+    features = []
+    package_specs = []
+    if args.check_features and check_features:
+        features.extend(select_features(workspace, category=args.feature_category, since=since, until=until,
+                                        change_table=args.change_table, scheduled=args.schedule))
+    elif args.feature_list:
+        features.extend(select_features(workspace, feature_list_json=args.feature_list))
+    if args.check_packages and check_packages:
+        package_specs.extend(select_packages(workspace, since=package_since, until=package_until,
+                                             change_table=args.change_table))
+    elif args.package_list:
+        package_specs.extend(select_packages(workspace, package_list_json=args.package_list))
+    if args.feature:
+        features.append(args.feature)
+    if args.package:
+        package_specs.append(spec_manager.get_package(args.package))
+    features.extend(f for p in package_specs if p['feature_classes'] != '' for f in p['feature_classes'])
+
+    # Each feature once, skipping those the run could not export
+    feature_index = spec_manager.get_feature_spec_index()
+    index = get_workspace_index(workspace)
+    feature_specs = []
+    skipped = {}
+    seen = set()
+    for name in features:
+        if name.lower() in seen:
+            continue
+        seen.add(name.lower())
+        if name.lower() not in feature_index:
+            skipped[name] = 'no spec'
+        elif not index.exists(name):
+            skipped[name] = workspace_index.MISSING
+        else:
+            feature_specs.append(feature_index[name.lower()])
+
+    plan = planner.plan_run(feature_specs,
+                            package_specs,
+                            planner.load_drive_index(args.snapshot),
+                            UTM_DRIVE_FOLDER,
+                            driver.get_chunk_size(),
+                            date.today(),
+                            force=args.force,
+                            full_refresh_days=delta.FULL_REFRESH_DAYS,
+                            all_package_specs=spec_manager.get_package_specs(),
+                            feature_index=feature_index)
+    plan['skipped'] = skipped
+    planner.print_plan(plan)
+    for name in sorted(skipped):
+        print('Skipped {}: {}'.format(name, skipped[name]))
+    print('Planned in {:.1f}s'.format(perf_counter() - start))
+
+    return plan
+
+
+def run_once(workspace, output_directory, args):
+    """
+    Run the jobs selected by zip_loader command line args once, as a nightly run or one service job does.
+
+    args: argparse namespace with the zip_loader options
+    """
+    # Every run starts from a clean temp directory and fresh run state
+    published_features.clear()
+    workspace_indexes.clear()
+    del deferred_uploads[:]
+    del failed_exports[:]
+    tracing.tracer.reset_spans()
+    if not args.zip_feature:
+        get_scratch_space(output_directory).reset()
+        os.makedirs(os.path.join(output_directory, 'output_packages'))
+
+    succeeded = False
+    try:
+        check_features, since, until, catch_up_start = get_change_window(args, run_state.FEATURES)
+        check_packages, package_since, package_until, package_catch_up_start = get_change_window(
+            args, run_state.PACKAGES)
+
+        if args.check_features:
+            if check_features:
+                run_features(workspace,
+                             output_directory,
+                             load=args.load,
+                             force=args.force,
+                             category=args.feature_category,
+                             since=since,
+                             until=until,
+                             change_table=args.change_table,
+                             scheduled=args.schedule)
+        elif args.feature_list:
+            run_features(workspace,
+                         output_directory,
+                         load=args.load,
+                         force=args.force,
+                         feature_list_json=args.feature_list)
+
+        if args.check_packages:
+            if check_packages:
+                run_packages(workspace, output_directory, load=args.load, force=args.force,
+                             since=package_since, until=package_until, change_table=args.change_table)
+        elif args.package_list:
+            run_packages(workspace, output_directory, package_list_json=args.package_list, load=args.load, force=args.force)
+
+        # Each watermark only advances after exports and uploads for its whole window succeeded, so a mode that did
+        # not run or failed is retried from the start of its window
+        published = args.load and not deferred_uploads and not failed_exports
+        advanced = []
+        if check_features and published and not args.feature_category and since <= catch_up_start:
+            advanced.append((run_state.FEATURES, until))
+        if check_packages and published and package_since <= package_catch_up_start:
+            advanced.append((run_state.PACKAGES, package_until))
+        if advanced:
+            def set_watermarks(state):
+                for mode, watermark in advanced:
+                    run_state.set_watermark(state, watermark, mode)
+            run_state.update_state(set_watermarks)
+        if failed_exports:
+            print('Exports failed, their changes stay in the next change detection window: {}'.format(
+                ', '.join(failed_exports)))
+
+        if args.feature:
+            run_feature(workspace, args.feature, output_directory, load=args.load, force=args.force)
+
+        if args.package:
+            run_package(workspace, args.package, output_directory, load=args.load, force=args.force)
+
+        if args.zip_feature:
+            upload_zip(args.zip_feature, output_directory)
+
+        if args.delete_feature:
+            delete_feature(args.delete_feature)
+        succeeded = True
+    finally:
+        # Ownership is transferred in bulk even when the run fails part way
+        transfer_ownership()
+        metrics.set_gauge('last_run_success', int(succeeded and not deferred_uploads and not failed_exports))
+        metrics.set_gauge('last_run_timestamp_seconds', round(time()))
+        if args.metrics:
+            metrics.write_textfile(args.metrics)
+        if args.trace:
+            tracing.export(args.trace)
+
+
+def get_poll_job(args):
+    """
+    Change detection job a service started with args polls with, None without --all or --all_packages.
+
+    The poll keeps the --category and --schedule options of the start so it checks what a one shot run would.
+    """
+    if not args.check_features and not args.check_packages:
+        return None
+
+    return {'check_features': args.check_features,
+            'check_packages': args.check_packages,
+            'feature_category': args.feature_category,
+            'schedule': args.schedule}
+
+
+def get_job_args(args, job, poll_job=None):
+    """
+    Options for one service job: the start options with the job's options or their service.JOB_DEFAULTS.
+
+    poll_job: get_poll_job result, change detection jobs from clients such as --poll take its category and schedule
+    """
+    if poll_job and (job.get('check_features') or job.get('check_packages')):
+        job = dict(dict((key, poll_job[key]) for key in ('feature_category', 'schedule')), **job)
+    job_args = argparse.Namespace(**vars(args))
+    for key in service.JOB_KEYS:
+        if key in service.JOB_DEFAULTS:
+            setattr(job_args, key, job.get(key, service.JOB_DEFAULTS[key]))
+    job_args.force = job.get('force', args.force)
+    job_args.load = job.get('load', args.load)
+
+    return job_args
+
+
+def serve(workspace, output_directory, args):
+    """
+    Stay resident with arcpy, the API clients and specs loaded and run jobs from service clients.
+
+    Change detection polls run every --poll_minutes with the --all, --all_packages, --category and --schedule
+    options given at start. Jobs from service.py clients name a feature, package or list and run one at a time
+    between polls.
+    """
+    # Spec files are parsed from memory between jobs and read again only once they change
+    spec_manager.CACHE_SPECS = True
+
+    poll_job = get_poll_job(args)
+
+    def run_job(job):
+        run_once(workspace, output_directory, get_job_args(args, job, poll_job))
+
+    service.Service(run_job, poll_job=poll_job, poll_minutes=args.poll_minutes,
+                    address=('localhost', args.port)).serve()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Update zip files on drive', parents=[tools.argparser])
 
@@ -480,6 +1236,75 @@ if __name__ == '__main__':
                         help='Check one package for changes and update if needed. Takes one package name')
     parser.add_argument('--upload_zip', action='store', dest='zip_feature',
                         help='Upload zip files for provided feature. Will fail if zip files do not exist in ./package_temp')
+    parser.add_argument('--since', action='store', dest='since',
+                        type=lambda d: datetime.strptime(d, '%Y-%m-%d').date(),
+                        help='With --all or --all_packages, include changes from this date (YYYY-MM-DD) through '
+                             'yesterday. Defaults to the day after the last successful run')
+    parser.add_argument('--change_table', action='store', dest='change_table',
+                        help='Change detection table or csv with table_name and last_modified columns to use '
+                             'instead of SGID.META.ChangeDetection')
+    parser.add_argument('--temp_budget', action='store', dest='temp_budget', type=int,
+                        help='Pause exports while package_temp uses more than this many MB')
+    parser.add_argument('--keep_zips', action='store', dest='keep_zips', type=int, default=KEEP_ZIPS,
+                        help='Number of recently uploaded zips to keep in package_temp for --upload_zip retries')
+    parser.add_argument('--delta_refresh_days', action='store', dest='delta_refresh_days', type=int,
+                        default=delta.FULL_REFRESH_DAYS,
+                        help='Days between full zip refreshes for features with "delta" in their spec. '
+                             'Other days only changed rows are published. -f always publishes full zips')
+    parser.add_argument('--export_workers', action='store', dest='export_workers', type=int, default=EXPORT_WORKERS,
+                        help='Processes exporting features ahead of uploads. 1 exports one feature at a time')
+    parser.add_argument('--jobs_per_worker', action='store', dest='jobs_per_worker', type=int,
+                        default=JOBS_PER_WORKER,
+                        help='Exports an export worker runs before it is restarted')
+    parser.add_argument('--spec_db', action='store', dest='spec_db',
+                        help='Read and save specs in this SQLite database instead of the features and packages '
+                             'folders. Create it with spec_manager.py --import_db')
+    parser.add_argument('--schedule', action='store_true', dest='schedule',
+                        help='With --all publish changed features by update_cycle, never and demand layers last, '
+                             'and refresh overdue features spread over the week')
+    parser.add_argument('--default_cycle', action='store', dest='default_cycle',
+                        help='update_cycle used by --schedule for specs without one, such as month')
+    parser.add_argument('--serve', action='store_true', dest='serve',
+                        help='Stay running and take --feature and --package jobs from service.py. With --all or '
+                             '--all_packages also check change detection every --poll_minutes')
+    parser.add_argument('--poll_minutes', action='store', dest='poll_minutes', type=float,
+                        default=service.POLL_MINUTES,
+                        help='Minutes between change detection checks with --serve')
+    parser.add_argument('--port', action='store', dest='port', type=int, default=service.PORT,
+                        help='Local port --serve listens on for jobs')
+    parser.add_argument('--upload_cap', action='store', dest='upload_cap', type=float,
+                        help='Cap on upload MB per second shared by all uploads')
+    parser.add_argument('--upload_schedule', action='store', dest='upload_schedule',
+                        help='Upload caps by hour of day as start-end:MB/s pairs, such as 7-18:2,18-7: for 2 MB/s '
+                             'during office hours and no cap overnight. Hours not listed use --upload_cap')
+    parser.add_argument('--upload_in_flight', action='store', dest='upload_in_flight', type=float,
+                        help='MB of uploads that can be in progress at once')
+    parser.add_argument('--drain_minutes', action='store', dest='drain_minutes', type=float,
+                        default=DRAIN_TIMEOUT / 60,
+                        help='Minutes to wait at the end of a run for Drive to recover and take uploads deferred '
+                             'while it was failing')
+    parser.add_argument('--metrics', action='store', dest='metrics',
+                        help='Write run health metrics in the Prometheus text format to this file after each run, '
+                             'such as a .prom file in the node_exporter textfile collector directory')
+    parser.add_argument('--profile', action='store', dest='profile',
+                        help='Write cProfile stats to this folder: one <feature>.pstats per feature and run.pstats '
+                             'for the rest of the run. Open them with python -m pstats')
+    parser.add_argument('--profile_features', action='store', dest='profile_features',
+                        help='With --profile, profile only these comma separated SGID feature names')
+    parser.add_argument('--profile_memory', action='store_true', dest='profile_memory',
+                        help='Print tracemalloc peaks and top allocators for exports, zips, downloads and spec '
+                             'loading. Slows the run down')
+    parser.add_argument('--plan', action='store_true', dest='plan',
+                        help='Print the features, packages, new Drive folders, parent changes, upload MB and API '
+                             'calls the other options would lead to, without exporting or touching Drive')
+    parser.add_argument('--plan_json', action='store', dest='plan_json',
+                        help='With --plan also write the plan to this json file')
+    parser.add_argument('--snapshot', action='store', dest='snapshot',
+                        help='storage_report snapshot json for --plan, defaults to the latest in '
+                             'data/drive_snapshots')
+    parser.add_argument('--trace', action='store', dest='trace',
+                        help='Write stage timings to TRACE.jsonl and TRACE.trace.json (Chrome trace format) after '
+                             'each run, with --serve after each job')
     parser.add_argument('workspace', action='store',
                         help='Set the workspace where all features are located')
 
@@ -488,49 +1313,37 @@ if __name__ == '__main__':
 
     workspace = args.workspace #: SGID
     output_directory = r'package_temp'
-    temp_package_directory = os.path.join(output_directory, 'output_packages')
+    if args.temp_budget is not None:
+        TEMP_BUDGET_BYTES = args.temp_budget * 1048576
+    KEEP_ZIPS = args.keep_zips
+    delta.FULL_REFRESH_DAYS = args.delta_refresh_days
+    EXPORT_WORKERS = args.export_workers
+    spec_manager.SPEC_DB = args.spec_db
+    JOBS_PER_WORKER = args.jobs_per_worker
+    schedule.DEFAULT_CYCLE = args.default_cycle
+    DRAIN_TIMEOUT = args.drain_minutes * 60
+    driver.upload_governor = driver.UploadGovernor(
+        bytes_per_second=args.upload_cap * driver.MB if args.upload_cap else None,
+        schedule=driver.parse_upload_schedule(args.upload_schedule) if args.upload_schedule else None,
+        max_in_flight=args.upload_in_flight * driver.MB if args.upload_in_flight else None)
+
+    if args.profile or args.profile_memory:
+        profiling.configure(folder=args.profile,
+                            features=args.profile_features.split(',') if args.profile_features else None,
+                            memory=args.profile_memory)
+        profiling.start_run()
 
-    def renew_temp_directory(directory, package_dir):
-        """Delete and recreate required temp directories."""
-        if not os.path.exists(directory):
-            os.makedirs(temp_package_directory)
+    try:
+        if args.plan:
+            plan = plan_run(workspace, args)
+            if args.plan_json:
+                with open(args.plan_json, 'w') as f_out:
+                    f_out.write(json.dumps(plan, sort_keys=True, indent=4))
+        elif args.serve:
+            serve(workspace, output_directory, args)
         else:
-            shutil.rmtree(directory)
-            print('Temp directory removed')
-            os.makedirs(package_dir)
-    if not args.zip_feature:
-        renew_temp_directory(output_directory, temp_package_directory)
-
-    start_time = clock()
-
-    if args.check_features:
-        run_features(workspace,
-                     output_directory,
-                     load=args.load,
-                     force=args.force,
-                     category=args.feature_category)
-    elif args.feature_list:
-        run_features(workspace,
-                     output_directory,
-                     load=args.load,
-                     force=args.force,
-                     feature_list_json=args.feature_list)
-
-    if args.check_packages:
-        run_packages(workspace, output_directory, load=args.load, force=args.force)
-    elif args.package_list:
-        run_packages(workspace, output_directory, package_list_json=args.package_list, load=args.load, force=args.force)
-
-    if args.feature:
-        run_feature(workspace, args.feature, output_directory, load=args.load, force=args.force)
-
-    if args.package:
-        run_package(workspace, args.package, output_directory, load=args.load, force=args.force)
-
-    if args.zip_feature:
-        upload_zip(args.zip_feature, output_directory)
-
-    if args.delete_feature:
-        delete_feature(args.delete_feature)
-
-    print('\nComplete!', clock() - start_time)
+            start_time = perf_counter()
+            run_once(workspace, output_directory, args)
+            print('\nComplete!', perf_counter() - start_time)
+    finally:
+        profiling.stop_run()